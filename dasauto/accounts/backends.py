@@ -0,0 +1,77 @@
+"""
+Аутентификация с кэшем пользователя.
+
+Django на каждый запрос с сессией загружает пользователя из БД.
+CachedModelBackend берет строку CustomUser из кэша сессий
+(SESSION_CACHE_ALIAS) на AUTH_USER_CACHE_TIMEOUT секунд. Хэш пароля в кэш
+не попадает: вместо него хранится готовый хэш для проверки сессии, а сам
+пароль остается отложенным полем и загружается из БД, только когда нужен
+(смена пароля). CustomUser.save() и delete() сбрасывают запись (в том числе
+после фиксации транзакции), поэтому изменение профиля или пароля видно
+сразу во всех воркерах (кэш общий). Изменения через QuerySet.update() кэш
+не сбрасывают — после них вызывается invalidate_cached_user().
+"""
+import copy
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+from django.db import transaction
+
+
+def user_cache():
+    return caches[settings.SESSION_CACHE_ALIAS]
+
+
+def user_cache_key(user_id):
+    return f'accounts:user:{user_id}'
+
+
+def invalidate_cached_user(user_id):
+    """
+    Сбрасывает кэш пользователя сразу и еще раз после фиксации транзакции:
+    до фиксации другой запрос может успеть закэшировать старую строку.
+    """
+    if user_id is None:
+        return
+    key = user_cache_key(user_id)
+    user_cache().delete(key)
+    transaction.on_commit(lambda: user_cache().delete(key))
+
+
+def _cacheable(user):
+    """Копия пользователя для кэша: хэш сессии вместо хэша пароля"""
+    cached = copy.copy(user)
+    cached.session_auth_hash = user.get_session_auth_hash()
+    # Поле без значения в __dict__ Django считает отложенным: save() его не перезапишет
+    cached.__dict__.pop('password', None)
+    return cached
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend, который загружает пользователя сессии из кэша"""
+
+    def get_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = user_cache().get(key)
+        if user is None:
+            UserModel = get_user_model()
+            try:
+                user = UserModel._default_manager.get(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            user_cache().set(key, _cacheable(user), settings.AUTH_USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = await user_cache().aget(key)
+        if user is None:
+            UserModel = get_user_model()
+            try:
+                user = await UserModel._default_manager.aget(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            await user_cache().aset(key, _cacheable(user), settings.AUTH_USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
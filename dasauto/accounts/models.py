@@ -14,4 +14,24 @@ class CustomUser(AbstractUser):
 
     class Meta:
         verbose_name = 'Пользователь'
-        verbose_name_plural = 'Пользователи'
\ No newline at end of file
+        verbose_name_plural = 'Пользователи'
+
+    def get_session_auth_hash(self):
+        # Пользователь из кэша (accounts.backends) хранится без хэша пароля, но с готовым хэшем сессии
+        if 'password' in self.get_deferred_fields() and hasattr(self, 'session_auth_hash'):
+            return self.session_auth_hash
+        return super().get_session_auth_hash()
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Пользователь сессии кэшируется (accounts.backends): профиль и пароль должны обновиться сразу
+        from .backends import invalidate_cached_user
+        invalidate_cached_user(self.pk)
+
+    def delete(self, *args, **kwargs):
+        user_id = self.pk
+        result = super().delete(*args, **kwargs)
+
+        from .backends import invalidate_cached_user
+        invalidate_cached_user(user_id)
+        return result
@@ -1,3 +1,100 @@
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
 
-# Create your tests here.
+from .backends import user_cache, user_cache_key
+
+User = get_user_model()
+
+
+class AccountViewsQueryTests(TestCase):
+    """Страницы профиля не должны делать лишних запросов"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', email='user@example.com', password='password')
+
+    def setUp(self):
+        cache.clear()
+        user_cache().clear()
+        self.client.force_login(self.user)
+
+    def test_profile_pages(self):
+        # Первый запрос загружает пользователя в кэш, сессия уже в кэше после входа
+        with self.assertNumQueries(1):
+            self.client.get(reverse('profile'))
+        for name in ['profile', 'settings', 'change_password']:
+            with self.subTest(view=name):
+                with self.assertNumQueries(0):
+                    response = self.client.get(reverse(name))
+                self.assertEqual(response.status_code, 200)
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db',
+                       AUTHENTICATION_BACKENDS=['django.contrib.auth.backends.ModelBackend'])
+    def test_profile_pages_without_cache(self):
+        self.client.force_login(self.user)
+        for name in ['profile', 'settings', 'change_password']:
+            with self.subTest(view=name):
+                # Сессия и пользователь
+                with self.assertNumQueries(2):
+                    response = self.client.get(reverse(name))
+                self.assertEqual(response.status_code, 200)
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_signed_cookie_session(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('profile'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('settings'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_login_page(self):
+        self.client.logout()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('login'))
+        self.assertEqual(response.status_code, 200)
+
+
+class CachedUserTests(TestCase):
+    """Кэш пользователя сбрасывается при изменении профиля и пароля"""
+
+    def setUp(self):
+        user_cache().clear()
+        self.user = User.objects.create_user('user', email='user@example.com', password='password')
+        self.client.force_login(self.user)
+        self.client.get(reverse('profile'))
+
+    def test_profile_update(self):
+        data = {'first_name': 'Иван', 'last_name': 'Иванов', 'email': 'ivan@example.com', 'phone': ''}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('settings'), data)
+        self.assertRedirects(response, reverse('profile'))
+
+        response = self.client.get(reverse('profile'))
+        self.assertEqual(response.context['user'].first_name, 'Иван')
+        self.assertEqual(user_cache().get(user_cache_key(self.user.pk)).first_name, 'Иван')
+
+    def test_password_hash_not_cached(self):
+        cached = user_cache().get(user_cache_key(self.user.pk))
+        self.assertNotIn('password', cached.__dict__)
+        self.assertEqual(cached.get_session_auth_hash(), self.user.get_session_auth_hash())
+        # Сохранение пользователя из кэша не затирает пароль
+        cached.first_name = 'Иван'
+        cached.save()
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('password'))
+
+    def test_password_change(self):
+        other = self.client_class()
+        other.force_login(self.user)
+        other.get(reverse('profile'))
+
+        data = {'old_password': 'password', 'new_password1': 'n3w-Passw0rd!', 'new_password2': 'n3w-Passw0rd!'}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('change_password'), data)
+        self.assertRedirects(response, reverse('profile'))
+
+        # Текущая сессия продолжается, другая завершается: хеш пароля в кэше обновлен
+        self.assertEqual(self.client.get(reverse('profile')).status_code, 200)
+        self.assertEqual(other.get(reverse('profile')).status_code, 302)
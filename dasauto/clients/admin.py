@@ -1,17 +1,105 @@
-from django.contrib import admin
-from django.db.models import Count, Sum, Value, DecimalField, IntegerField
-from django.db.models.functions import Coalesce
+import os
+import tempfile
 
-from .models import Client
+from django.conf import settings
+from django.contrib import admin, messages
+from django.shortcuts import redirect, render
+from django.urls import path
+
+from .cache import client_sources
+from .dedupe import merge_clients
+from .forms import ClientImportUploadForm
+from .importers import ClientImporter
+from .models import Client, Tag
+from .pagination import EstimatedCountPaginator
+from .search import search_clients
+from .tags import filter_by_tags, parse_tags
+
+ADMIN_TAG_FILTER_LIMIT = 50
+
+
+class TagFilter(admin.SimpleListFilter):
+    """
+    Фильтр по тегам через индекс ClientTag. В параметре — теги через
+    запятую; клик по тегу добавляет его в набор или убирает из набора.
+    """
+    mode = 'any'
+
+    def lookups(self, request, model_admin):
+        names = Tag.objects.order_by('name').values_list('name', flat=True)[:ADMIN_TAG_FILTER_LIMIT]
+        return [(name, name) for name in names]
+
+    def selected(self):
+        return parse_tags(self.value())
+
+    def queryset(self, request, queryset):
+        selected = self.selected()
+        if selected:
+            return filter_by_tags(queryset, selected, self.mode)
+        return queryset
+
+    def choices(self, changelist):
+        selected = self.selected()
+        yield {
+            'selected': not selected,
+            'query_string': changelist.get_query_string(remove=[self.parameter_name]),
+            'display': 'Все',
+        }
+        for name, title in self.lookup_choices:
+            toggled = [tag for tag in selected if tag != name] if name in selected else selected + [name]
+            if toggled:
+                query_string = changelist.get_query_string({self.parameter_name: ','.join(toggled)})
+            else:
+                query_string = changelist.get_query_string(remove=[self.parameter_name])
+            yield {
+                'selected': name in selected,
+                'query_string': query_string,
+                'display': title,
+            }
+
+
+class AnyTagFilter(TagFilter):
+    title = 'теги (любой из)'
+    parameter_name = 'tags_any'
+    mode = 'any'
+
+
+class AllTagsFilter(TagFilter):
+    title = 'теги (все)'
+    parameter_name = 'tags_all'
+    mode = 'all'
+
+
+class SourceFilter(admin.SimpleListFilter):
+    """Фильтр по источнику: список значений из кэша вместо SELECT DISTINCT по таблице"""
+    title = 'источник'
+    parameter_name = 'source'
+
+    def lookups(self, request, model_admin):
+        return [(source, source) for source in client_sources()]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(source=self.value())
+        return queryset
 
 
 @admin.register(Client)
 class ClientAdmin(admin.ModelAdmin):
+    """
+    При ADMIN_PERFORMANCE_MODE changelist рассчитан на большие таблицы:
+    число строк без фильтров — по статистике таблицы, без второго COUNT(*)
+    для «показать все», поиск — по префиксам через индекс ClientSearchToken
+    (как в списке клиентов) вместо icontains по шести полям.
+    Счетчики заказов и суммы хранятся в Client, поэтому страница не агрегирует заказы.
+    """
     list_display = ['full_name', 'phone', 'email', 'client_type', 'created_by', 'get_orders_count', 'get_total_spent',
                     'is_active']
-    list_filter = ['client_type', 'source', 'is_active', 'created_at']
+    list_filter = ['client_type', SourceFilter, 'is_active', 'created_at', AnyTagFilter, AllTagsFilter]
     search_fields = ['first_name', 'last_name', 'phone', 'email', 'company_name', 'inn']
     readonly_fields = ['created_at', 'updated_at', 'get_total_spent', 'get_orders_count']
+    list_select_related = ['created_by']
+    actions = ['merge_selected']
 
     fieldsets = (
         ('Основная информация', {
@@ -32,31 +120,95 @@ class ClientAdmin(admin.ModelAdmin):
         }),
     )
 
-    def get_queryset(self, request):
-        queryset = super().get_queryset(request)
-        return queryset.annotate(
-            orders_count_annotated=Coalesce(
-                Count('orders', distinct=True),
-                Value(0),
-                output_field=IntegerField()
-            ),
-            total_spent_annotated=Coalesce(
-                Sum('orders__total_amount'),
-                Value(0),
-                output_field=DecimalField(max_digits=10, decimal_places=2)
-            )
-        )
-
     def get_orders_count(self, obj):
-        return obj.orders_count_annotated if hasattr(obj, 'orders_count_annotated') else obj.orders.count()
+        return obj.orders_count
 
     get_orders_count.short_description = 'Кол-во заказов'
-    get_orders_count.admin_order_field = 'orders_count_annotated'
+    get_orders_count.admin_order_field = 'orders_count'
 
     def get_total_spent(self, obj):
-        amount = obj.total_spent_annotated if hasattr(obj, 'total_spent_annotated') else \
-        obj.orders.aggregate(total=Sum('total_amount'))['total'] or 0
-        return f"{amount} ₽"
+        return f"{obj.total_spent} ₽"
 
     get_total_spent.short_description = 'Всего потрачено'
-    get_total_spent.admin_order_field = 'total_spent_annotated'
\ No newline at end of file
+    get_total_spent.admin_order_field = 'total_spent'
+
+    @property
+    def show_full_result_count(self):
+        return not settings.ADMIN_PERFORMANCE_MODE
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        if settings.ADMIN_PERFORMANCE_MODE:
+            return EstimatedCountPaginator(queryset, per_page, orphans, allow_empty_first_page)
+        return super().get_paginator(request, queryset, per_page, orphans, allow_empty_first_page)
+
+    def get_search_results(self, request, queryset, search_term):
+        if settings.ADMIN_PERFORMANCE_MODE:
+            # Фильтр id__in по токенам не размножает строки
+            return search_clients(queryset, search_term), False
+        return super().get_search_results(request, queryset, search_term)
+
+    # Дубликаты удаляются, поэтому действие доступно только с правом на удаление
+    @admin.action(permissions=['delete'], description='Объединить выбранных клиентов (в самого раннего)')
+    def merge_selected(self, request, queryset):
+        clients = list(queryset.order_by('pk'))
+        if len(clients) < 2:
+            self.message_user(request, 'Выберите хотя бы двух клиентов', messages.WARNING)
+            return
+        try:
+            target = merge_clients(clients[0], clients[1:], user=request.user)
+        except ValueError as exc:
+            self.message_user(request, str(exc), messages.ERROR)
+            return
+        self.message_user(request, f'Клиенты объединены в «{target.full_name}»', messages.SUCCESS)
+
+    def get_urls(self):
+        urls = [
+            path(
+                'import/',
+                self.admin_site.admin_view(self.import_clients_view),
+                name='clients_client_import',
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def import_clients_view(self, request):
+        """Импорт клиентов и автомобилей из CSV/XLSX"""
+        if not self.has_add_permission(request):
+            return redirect('admin:clients_client_changelist')
+
+        if request.method == 'POST':
+            form = ClientImportUploadForm(request.POST, request.FILES)
+            if form.is_valid():
+                upload = form.cleaned_data['file']
+                suffix = os.path.splitext(upload.name)[1].lower()
+                # Файл пишется на диск по частям, импорт читает его потоково
+                with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+                    for chunk in upload.chunks():
+                        tmp.write(chunk)
+                    tmp.flush()
+                    importer = ClientImporter(form.cleaned_data['owner'], dry_run=form.cleaned_data['dry_run'])
+                    try:
+                        report = importer.run(tmp.name)
+                    except (ImportError, ValueError) as exc:
+                        messages.error(request, str(exc))
+                        return redirect('admin:clients_client_import')
+
+                messages.success(
+                    request,
+                    f'Клиентов: {report.created_clients}, автомобилей: {report.created_cars}, '
+                    f'пропущено: {report.skipped}, ошибок: {report.error_count}'
+                )
+                for row_number, message in report.errors[:20]:
+                    messages.warning(request, f'Строка {row_number}: {message}')
+                return redirect('admin:clients_client_changelist')
+        else:
+            form = ClientImportUploadForm()
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'form': form,
+            'title': 'Импорт клиентов',
+            'max_upload_size': settings.ADMIN_IMPORT_MAX_UPLOAD_SIZE,
+        }
+        return render(request, 'admin/clients/client/import_clients.html', context)
@@ -0,0 +1,493 @@
+"""
+Генератор синтетических данных и замер представлений.
+
+generate_dataset() создает N пользователей × M клиентов × K автомобилей/заказов
+с услугами и запчастями через bulk_create, после чего пересчитывает поисковый
+индекс, счетчики клиентов и дневную статистику. measure() прогоняет URL через
+тестовый клиент Django и возвращает число запросов и p50/p95 времени ответа.
+compare_handlers() нагружает асинхронные представления параллельными
+запросами через WSGI-обработчик (пул потоков, как gthread-воркер) и через
+ASGI-обработчик (корутины в одном цикле событий, как uvicorn-воркер).
+compare_connections() замеряет те же запросы при соединении с БД на каждый
+запрос, постоянных соединениях и пуле соединений (dasauto.db.pool).
+compare_rendering() замеряет только рендеринг страницы списка клиентов
+(по умолчанию 1000 строк) без кэша шаблонов, с cached loader и с кэшем
+фрагментов строк. compare_sessions() показывает, сколько запросов к БД
+уходит на сессию и пользователя при разных хранилищах сессий.
+"""
+import asyncio
+import io
+from contextlib import contextmanager
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from decimal import Decimal
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import close_old_connections, connection, connections
+from django.utils.module_loading import import_string
+from django.test import AsyncClient, Client as TestClient
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from dasauto.database import ENGINES, POOLED_ENGINES
+from dasauto.db.pool import close_pools, pool_stats
+
+from .cache import bump_dashboard_version
+from .models import Client, Car, Order, Service, Part
+
+User = get_user_model()
+
+STATUSES = [status for status, _ in Order.STATUS_CHOICES]
+
+
+@dataclass
+class Dataset:
+    users: list
+    clients_per_user: int
+    cars_per_client: int
+    orders_per_car: int
+
+
+@dataclass
+class Measurement:
+    name: str
+    url: str
+    status_code: int
+    queries: int
+    p50_ms: float
+    p95_ms: float
+
+
+@dataclass
+class LoadResult:
+    name: str
+    handler: str
+    requests: int
+    concurrency: int
+    rps: float
+    p50_ms: float
+    p95_ms: float
+
+
+@dataclass
+class RenderMeasurement:
+    mode: str
+    rows: int
+    p50_ms: float
+    p95_ms: float
+
+
+def generate_dataset(users=2, clients=50, cars=1, orders=2, services=2, parts=2, prefix='bench', batch_size=1000):
+    """Создает синтетические данные и возвращает Dataset"""
+    created_users = [
+        User.objects.create_user(f'{prefix}{i}', email=f'{prefix}{i}@example.com', password='password')
+        for i in range(users)
+    ]
+
+    for user in created_users:
+        batch = [
+            Client(
+                created_by=user,
+                first_name=f'Имя{i}',
+                last_name=f'Фамилия{i}',
+                phone=f'+7{user.pk:03d}{i:07d}',
+                email=f'{prefix}{user.pk}-{i}@example.com',
+                client_type=['individual', 'legal', 'regular'][i % 3],
+            )
+            for i in range(clients)
+        ]
+        for client in batch:
+            client.normalize_phones()
+        Client.objects.bulk_create(batch, batch_size=batch_size)
+
+    client_ids = list(
+        Client.objects.filter(created_by__in=created_users).order_by('pk').values_list('pk', flat=True)
+    )
+    Car.objects.bulk_create([
+        Car(client_id=client_id, brand='Lada', model='Vesta', license_plate=f'А{client_id % 1000:03d}ВС{j:02d}')
+        for client_id in client_ids for j in range(cars)
+    ], batch_size=batch_size)
+
+    car_rows = Car.objects.filter(client_id__in=client_ids).order_by('pk').values_list('pk', 'client_id')
+    Order.objects.bulk_create([
+        Order(
+            client_id=client_id,
+            car_id=car_id,
+            description='Техническое обслуживание',
+            order_number=f'{prefix.upper()}-{car_id}-{j}',
+            status=STATUSES[(car_id + j) % len(STATUSES)],
+            labor_cost=Decimal(1000 * (j + 1)),
+            parts_cost=Decimal(500 * (j + 1)),
+            total_amount=Decimal(1500 * (j + 1)),
+        )
+        for car_id, client_id in car_rows for j in range(orders)
+    ], batch_size=batch_size)
+
+    order_ids = list(Order.objects.filter(client_id__in=client_ids).values_list('pk', flat=True))
+    Service.objects.bulk_create([
+        Service(order_id=order_id, name=f'Работа {j}', quantity=1, price=Decimal(500), total=Decimal(500))
+        for order_id in order_ids for j in range(services)
+    ], batch_size=batch_size)
+    Part.objects.bulk_create([
+        Part(order_id=order_id, name=f'Запчасть {j}', quantity=2, price=Decimal(125), total=Decimal(250))
+        for order_id in order_ids for j in range(parts)
+    ], batch_size=batch_size)
+
+    # bulk_create не вызывает save(): пересчитываем денормализованные данные
+    out = io.StringIO()
+    call_command('rebuild_search_index', stdout=out)
+    call_command('reconcile_client_counters', fix=True, stdout=out)
+    call_command('rebuild_order_stats', stdout=out)
+
+    return Dataset(created_users, clients, cars, orders)
+
+
+def delete_dataset(dataset):
+    """Удаляет данные, созданные generate_dataset() (для замеров на зафиксированных данных)"""
+    clients = Client.objects.filter(created_by__in=dataset.users)
+    Order.objects.filter(client__in=clients).delete()
+    Car.objects.filter(client__in=clients).delete()
+    clients.delete()
+    User.objects.filter(pk__in=[user.pk for user in dataset.users]).delete()
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def measure(http_client, url, name=None, repeat=10):
+    """Замеряет URL: число запросов к БД (по первому прогону) и p50/p95 времени в мс"""
+    with CaptureQueriesContext(connection) as captured:
+        response = http_client.get(url)
+    queries = len(captured)
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        http_client.get(url)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    return Measurement(
+        name=name or url,
+        url=url,
+        status_code=response.status_code,
+        queries=queries,
+        p50_ms=statistics.median(timings) if timings else 0.0,
+        p95_ms=percentile(timings, 95),
+    )
+
+
+def logged_in_client(user):
+    http_client = TestClient()
+    http_client.force_login(user)
+    return http_client
+
+
+def view_urls(user):
+    """Набор URL для замера представлений clients и accounts"""
+    from django.urls import reverse
+
+    client_ids = list(Client.objects.filter(created_by=user).order_by('pk').values_list('pk', flat=True)[:20])
+    client = Client.objects.get(pk=client_ids[0])
+    return [
+        ('client_list', reverse('client_list')),
+        ('client_list_search', f"{reverse('client_list')}?q=фамилия1"),
+        ('client_detail', reverse('client_detail', args=[client.pk])),
+        ('dashboard', reverse('dashboard')),
+        ('client_found', f"{reverse('client_found')}?query=фамилия"),
+        ('client_cars_api', reverse('client_cars_api', args=[client.pk])),
+        ('cars_api_batch', f"{reverse('cars_api')}?client_ids={','.join(map(str, client_ids))}"),
+        ('clients_api', reverse('clients_api')),
+        ('profile', reverse('profile')),
+        ('settings', reverse('settings')),
+    ]
+
+
+def run_benchmark(dataset, repeat=10):
+    """Замеряет все представления для первого пользователя набора и changelist админки"""
+    user = dataset.users[0]
+    # Первый замер дашборда должен быть холодным, даже если id пользователя уже встречался
+    bump_dashboard_version(user.pk)
+    # Тестовый клиент ходит с хостом testserver, которого может не быть в ALLOWED_HOSTS
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        http_client = logged_in_client(user)
+        results = [measure(http_client, url, name, repeat) for name, url in view_urls(user)]
+
+        admin_user = User.objects.create_superuser('bench_admin', 'bench_admin@example.com', 'password')
+        admin_client = logged_in_client(admin_user)
+        results.append(measure(admin_client, '/admin/clients/client/', 'admin_client_changelist', repeat))
+    return results
+
+
+# Асинхронные представления, которые сравниваются под WSGI и ASGI
+ASYNC_VIEWS = ('dashboard', 'client_detail', 'client_cars_api')
+
+
+def _split(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def _load_result(name, handler, timings, elapsed, concurrency):
+    return LoadResult(
+        name=name,
+        handler=handler,
+        requests=len(timings),
+        concurrency=concurrency,
+        rps=len(timings) / elapsed if elapsed else 0.0,
+        p50_ms=statistics.median(timings) if timings else 0.0,
+        p95_ms=percentile(timings, 95),
+    )
+
+
+def wsgi_load(user, name, url, concurrency, total):
+    """concurrency потоков по очереди запрашивают url через WSGI-обработчик"""
+    http_clients = [logged_in_client(user) for _ in range(concurrency)]
+
+    def worker(http_client, count):
+        timings = []
+        try:
+            for _ in range(count):
+                started = time.perf_counter()
+                http_client.get(url)
+                timings.append((time.perf_counter() - started) * 1000)
+        finally:
+            # У каждого потока свое соединение с БД
+            connection.close()
+        return timings
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        chunks = list(pool.map(worker, http_clients, _split(total, concurrency)))
+    elapsed = time.perf_counter() - started
+    return _load_result(name, 'wsgi', [timing for chunk in chunks for timing in chunk], elapsed, concurrency)
+
+
+def asgi_load(user, name, url, concurrency, total):
+    """concurrency корутин по очереди запрашивают url через ASGI-обработчик"""
+    cookies = logged_in_client(user).cookies
+
+    async def worker(count):
+        http_client = AsyncClient()
+        http_client.cookies = cookies
+        timings = []
+        for _ in range(count):
+            started = time.perf_counter()
+            await http_client.get(url)
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings
+
+    async def run():
+        return await asyncio.gather(*(worker(count) for count in _split(total, concurrency)))
+
+    started = time.perf_counter()
+    chunks = async_to_sync(run)()
+    elapsed = time.perf_counter() - started
+    return _load_result(name, 'asgi', [timing for chunk in chunks for timing in chunk], elapsed, concurrency)
+
+
+def compare_handlers(dataset, concurrency=10, total=200):
+    """
+    Замеряет асинхронные представления под WSGI и ASGI. Данные должны быть
+    зафиксированы в БД: потоки WSGI работают через собственные соединения.
+    """
+    user = dataset.users[0]
+    urls = dict(view_urls(user))
+    results = []
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        for name in ASYNC_VIEWS:
+            # Прогрев: кэш дашборда одинаково теплый для обоих обработчиков
+            logged_in_client(user).get(urls[name])
+            results.append(wsgi_load(user, name, urls[name], concurrency, total))
+            results.append(asgi_load(user, name, urls[name], concurrency, total))
+    return results
+
+
+# Режимы соединений с БД для compare_connections()
+CONNECTION_MODES = ('per_request', 'persistent', 'pool')
+CONNECTION_VIEWS = ('client_list', 'client_detail', 'clients_api')
+
+
+@contextmanager
+def connection_mode(mode, pool_size):
+    """
+    Временно меняет настройки соединения default. Действует на потоки,
+    которые обращаются к БД впервые после входа в контекст.
+    """
+    db = connections.settings['default']
+    saved = dict(db)
+    plain_engines = {pooled: ENGINES[name] for name, pooled in POOLED_ENGINES.items()}
+    plain = plain_engines.get(db['ENGINE'], db['ENGINE'])
+    if mode == 'per_request':
+        db.update(ENGINE=plain, CONN_MAX_AGE=0)
+    elif mode == 'persistent':
+        db.update(ENGINE=plain, CONN_MAX_AGE=60, CONN_HEALTH_CHECKS=True)
+    else:
+        pooled = {engine: name for name, engine in ENGINES.items()}.get(plain)
+        if pooled is None:
+            raise ValueError(f'Для {plain} нет бэкенда с пулом')
+        db.update(ENGINE=POOLED_ENGINES[pooled], CONN_MAX_AGE=0, POOL={**db.get('POOL', {}), 'SIZE': pool_size})
+    try:
+        yield
+    finally:
+        close_pools()
+        db.clear()
+        db.update(saved)
+
+
+@contextmanager
+def simulated_connect_latency(seconds):
+    """Добавляет задержку к каждому новому соединению — как TCP и авторизация удаленного MySQL"""
+    if not seconds:
+        yield
+        return
+    engine = connections.settings['default']['ENGINE']
+    plain_engines = {pooled: ENGINES[name] for name, pooled in POOLED_ENGINES.items()}
+    wrapper_class = import_string(f"{plain_engines.get(engine, engine)}.base.DatabaseWrapper")
+    original = wrapper_class.get_new_connection
+
+    def get_new_connection(self, conn_params):
+        time.sleep(seconds)
+        return original(self, conn_params)
+
+    with mock.patch.object(wrapper_class, 'get_new_connection', get_new_connection):
+        yield
+
+
+def connection_load(user, name, url, mode, concurrency, total):
+    """
+    Как wsgi_load(), но после каждого запроса соединения обрабатываются так
+    же, как в настоящем WSGI-сервере (тестовый клиент этот шаг пропускает).
+    """
+    http_clients = [logged_in_client(user) for _ in range(concurrency)]
+
+    def worker(http_client, count):
+        timings = []
+        try:
+            for _ in range(count):
+                started = time.perf_counter()
+                http_client.get(url)
+                close_old_connections()
+                timings.append((time.perf_counter() - started) * 1000)
+        finally:
+            connection.close()
+        return timings
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        chunks = list(pool.map(worker, http_clients, _split(total, concurrency)))
+    elapsed = time.perf_counter() - started
+    return _load_result(name, mode, [timing for chunk in chunks for timing in chunk], elapsed, concurrency)
+
+
+def compare_connections(dataset, concurrency=10, total=200, connect_latency=0.0, pool_size=None):
+    """
+    Замеряет представления при соединении на запрос, постоянных соединениях
+    и пуле. Возвращает (результаты, статистика пула). Данные должны быть
+    зафиксированы в БД: потоки работают через собственные соединения.
+    """
+    user = dataset.users[0]
+    urls = dict(view_urls(user))
+    results = []
+    stats = {}
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']), \
+            simulated_connect_latency(connect_latency):
+        for mode in CONNECTION_MODES:
+            with connection_mode(mode, pool_size or concurrency):
+                for name in CONNECTION_VIEWS:
+                    results.append(connection_load(user, name, urls[name], mode, concurrency, total))
+                if mode == 'pool':
+                    stats = pool_stats().get('default', {})
+    return results, stats
+
+
+# Режимы рендеринга для compare_rendering()
+RENDER_MODES = ('no_cache', 'cached_loader', 'fragments')
+
+
+def template_backend(cached_loader):
+    """Отдельный DjangoTemplates с настройками проекта: с cached loader или без"""
+    from django.template.backends.django import DjangoTemplates
+
+    config = settings.TEMPLATES[0]
+    options = {name: value for name, value in config.get('OPTIONS', {}).items() if name != 'loaders'}
+    loaders = settings.TEMPLATE_LOADERS
+    options['loaders'] = [('django.template.loaders.cached.Loader', loaders)] if cached_loader else loaders
+    return DjangoTemplates({
+        'NAME': f'benchmark_{int(cached_loader)}',
+        'DIRS': config.get('DIRS', []),
+        'APP_DIRS': False,
+        'OPTIONS': options,
+    })
+
+
+def compare_rendering(dataset, rows=1000, repeat=10):
+    """
+    Замеряет рендеринг client_list.html на странице из rows клиентов первого
+    пользователя. Данные страницы выбираются один раз, поэтому в замер
+    попадает только шаблон. Первый рендер в каждом режиме прогревает кэши.
+    """
+    from django.test import RequestFactory
+
+    from .views import client_list_context
+
+    request = RequestFactory().get('/clients/')
+    request.user = dataset.users[0]
+    context = client_list_context(request, page_size=rows)
+
+    results = []
+    for mode in RENDER_MODES:
+        backend = template_backend(cached_loader=mode != 'no_cache')
+        timeout = (settings.TEMPLATE_FRAGMENT_CACHE_TIMEOUT or 60 * 60) if mode == 'fragments' else 0
+        with override_settings(TEMPLATE_FRAGMENT_CACHE_TIMEOUT=timeout):
+            backend.get_template('clients/client_list.html').render(context, request)
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                backend.get_template('clients/client_list.html').render(context, request)
+                timings.append((time.perf_counter() - started) * 1000)
+        results.append(RenderMeasurement(
+            mode=mode,
+            rows=len(context['clients']),
+            p50_ms=statistics.median(timings) if timings else 0.0,
+            p95_ms=percentile(timings, 95),
+        ))
+    return results
+
+
+# Хранилища сессий и бэкенды аутентификации для compare_sessions()
+SESSION_MODES = {
+    'db': ('django.contrib.sessions.backends.db', 'django.contrib.auth.backends.ModelBackend'),
+    'cached_db': ('django.contrib.sessions.backends.cached_db', 'accounts.backends.CachedModelBackend'),
+    'signed_cookies': ('django.contrib.sessions.backends.signed_cookies', 'accounts.backends.CachedModelBackend'),
+}
+SESSION_VIEWS = ('client_cars_api', 'clients_api', 'profile')
+
+
+def compare_sessions(dataset, repeat=10):
+    """
+    Замеряет быстрые представления при сессиях в БД (пользователь из БД),
+    в кэше с записью в БД и в подписанной cookie (пользователь из кэша).
+    Возвращает [(режим, Measurement)]; число запросов — после первого
+    запроса, который прогревает кэши.
+    """
+    user = dataset.users[0]
+    urls = dict(view_urls(user))
+    results = []
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        for mode, (engine, backend) in SESSION_MODES.items():
+            with override_settings(SESSION_ENGINE=engine, AUTHENTICATION_BACKENDS=[backend]):
+                http_client = logged_in_client(user)
+                for name in SESSION_VIEWS:
+                    http_client.get(urls[name])
+                    results.append((mode, measure(http_client, urls[name], name, repeat)))
+    return results
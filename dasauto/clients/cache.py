@@ -0,0 +1,192 @@
+"""
+Кэш данных дашборда по пользователю.
+
+Ключи версионируются: любая запись в Order, Client, Car или ClientHistory
+увеличивает версию пользователя, и старые данные просто перестают читаться.
+Пересчет холодной записи выполняет только один запрос (блокировка через
+cache.add), остальные ждут готовый результат. Счетчики попаданий и промахов
+хранятся в том же кэше (incr атомарен в Redis и в dasauto.cache.FileBasedCache),
+посмотреть их можно командой dashboard_cache_stats.
+Для асинхронного дашборда есть aget_dashboard_context() с той же логикой
+поверх асинхронного API кэша.
+
+Здесь же кэшируется список источников клиентов для фильтра админки
+(client_sources), чтобы не выполнять SELECT DISTINCT по всей таблице.
+"""
+import asyncio
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+DASHBOARD_CACHE_TIMEOUT = 60 * 10
+DASHBOARD_LOCK_TIMEOUT = 30
+DASHBOARD_LOCK_WAIT = 5
+DASHBOARD_LOCK_POLL_INTERVAL = 0.05
+
+STATS_HITS_KEY = 'dashboard:stats:hits'
+STATS_MISSES_KEY = 'dashboard:stats:misses'
+
+CLIENT_SOURCES_KEY = 'clients:sources'
+CLIENT_SOURCES_TIMEOUT = 60 * 60
+
+
+def _version_key(user_id):
+    return f'dashboard:version:{user_id}'
+
+
+def _new_version():
+    # Версия от времени: после вытеснения ключа версии старые данные не оживут
+    return time.time_ns()
+
+
+def dashboard_version(user_id):
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        cache.add(_version_key(user_id), _new_version(), None)
+        version = cache.get(_version_key(user_id))
+    return version
+
+
+def bump_dashboard_version(user_id):
+    """Немедленно сбрасывает кэш дашборда пользователя"""
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        cache.set(_version_key(user_id), _new_version(), None)
+
+
+def invalidate_dashboard(user_id):
+    """Сбрасывает кэш дашборда пользователя после фиксации текущей транзакции"""
+    if user_id is None:
+        return
+    transaction.on_commit(lambda: bump_dashboard_version(user_id))
+
+
+def _count(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def get_dashboard_context(user_id, variant, compute):
+    """
+    Возвращает данные дашборда из кэша или вычисляет их через compute().
+    variant — часть ключа, зависящая от параметров запроса (например, период).
+    """
+    data_key = f'dashboard:data:{user_id}:{dashboard_version(user_id)}:{variant}'
+    data = cache.get(data_key)
+    if data is not None:
+        _count(STATS_HITS_KEY)
+        return data
+
+    _count(STATS_MISSES_KEY)
+    lock_key = f'{data_key}:lock'
+    if cache.add(lock_key, 1, DASHBOARD_LOCK_TIMEOUT):
+        try:
+            data = compute()
+            cache.set(data_key, data, DASHBOARD_CACHE_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+        return data
+
+    # Данные уже пересчитывает другой запрос — ждем его результат
+    deadline = time.monotonic() + DASHBOARD_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(DASHBOARD_LOCK_POLL_INTERVAL)
+        data = cache.get(data_key)
+        if data is not None:
+            return data
+    return compute()
+
+
+async def adashboard_version(user_id):
+    version = await cache.aget(_version_key(user_id))
+    if version is None:
+        await cache.aadd(_version_key(user_id), _new_version(), None)
+        version = await cache.aget(_version_key(user_id))
+    return version
+
+
+async def _acount(key):
+    try:
+        await cache.aincr(key)
+    except ValueError:
+        if not await cache.aadd(key, 1, None):
+            await cache.aincr(key)
+
+
+async def aget_dashboard_context(user_id, variant, compute):
+    """Асинхронный get_dashboard_context(); compute — корутинная функция"""
+    data_key = f'dashboard:data:{user_id}:{await adashboard_version(user_id)}:{variant}'
+    data = await cache.aget(data_key)
+    if data is not None:
+        await _acount(STATS_HITS_KEY)
+        return data
+
+    await _acount(STATS_MISSES_KEY)
+    lock_key = f'{data_key}:lock'
+    if await cache.aadd(lock_key, 1, DASHBOARD_LOCK_TIMEOUT):
+        try:
+            data = await compute()
+            await cache.aset(data_key, data, DASHBOARD_CACHE_TIMEOUT)
+        finally:
+            await cache.adelete(lock_key)
+        return data
+
+    deadline = time.monotonic() + DASHBOARD_LOCK_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(DASHBOARD_LOCK_POLL_INTERVAL)
+        data = await cache.aget(data_key)
+        if data is not None:
+            return data
+    return await compute()
+
+
+def dashboard_cache_stats():
+    hits = cache.get(STATS_HITS_KEY) or 0
+    misses = cache.get(STATS_MISSES_KEY) or 0
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / total if total else 0.0,
+    }
+
+
+def reset_dashboard_cache_stats():
+    cache.delete_many([STATS_HITS_KEY, STATS_MISSES_KEY])
+
+
+def client_sources():
+    """Отсортированные непустые значения Client.source"""
+    from .models import Client
+
+    sources = cache.get(CLIENT_SOURCES_KEY)
+    if sources is None:
+        sources = list(
+            Client.objects.exclude(source='').order_by('source').values_list('source', flat=True).distinct()
+        )
+        cache.set(CLIENT_SOURCES_KEY, sources, CLIENT_SOURCES_TIMEOUT)
+    return sources
+
+
+def invalidate_client_sources(sources, removed=False):
+    """
+    Сбрасывает список источников после фиксации транзакции, если в нем нет
+    какого-то из sources, а при removed=True (клиенты с этими источниками
+    удалены) — если какой-то из sources в нем есть: источник мог исчезнуть.
+    Источник, который перестал встречаться после изменения клиента, остается
+    в списке до истечения CLIENT_SOURCES_TIMEOUT.
+    """
+    sources = {source for source in sources if source}
+    if not sources:
+        return
+    cached = cache.get(CLIENT_SOURCES_KEY)
+    if cached is None:
+        return
+    stale = sources & set(cached) if removed else sources - set(cached)
+    if stale:
+        transaction.on_commit(lambda: cache.delete(CLIENT_SOURCES_KEY))
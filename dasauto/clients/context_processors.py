@@ -0,0 +1,6 @@
+from django.conf import settings
+
+
+def template_cache(request):
+    """Срок хранения фрагментов для тега {% cache %}: строки списков клиентов и заказов"""
+    return {'TEMPLATE_FRAGMENT_CACHE_TIMEOUT': settings.TEMPLATE_FRAGMENT_CACHE_TIMEOUT}
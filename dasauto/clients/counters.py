@@ -0,0 +1,101 @@
+"""
+Денормализованные счетчики клиента: orders_count, total_spent, last_order_at.
+
+Обновляются инкрементально из Order.save() и сигнала post_delete заказа (он
+срабатывает и для QuerySet.delete()) в той же транзакции, что и сам заказ.
+Удалить заказы каскадом нельзя: Order.client и Order.car — PROTECT.
+QuerySet.update() по заказам счетчики не обновляет: после массовых UPDATE
+затронутых клиентов пересчитывает refresh_client_counters() (так делает
+recompute_order_totals). Команду reconcile_client_counters --fix стоит
+запускать по расписанию (например, раз в сутки): она находит и исправляет
+расхождения, оставшиеся после ручных правок в БД.
+"""
+from decimal import Decimal
+
+from django.db.models import F, Count, Sum, Max, Value, DecimalField
+from django.db.models.functions import Coalesce, Greatest
+
+ZERO = Decimal('0.00')
+
+
+def apply_client_delta(client_id, count_delta=0, spent_delta=ZERO, order_created_at=None):
+    """Атомарно прибавляет дельты к счетчикам клиента одним UPDATE"""
+    from .models import Client
+
+    updates = {}
+    if count_delta:
+        updates['orders_count'] = F('orders_count') + count_delta
+    if spent_delta:
+        updates['total_spent'] = F('total_spent') + spent_delta
+    if order_created_at is not None:
+        updates['last_order_at'] = Greatest(Coalesce('last_order_at', Value(order_created_at)), Value(order_created_at))
+    if updates:
+        Client.objects.filter(pk=client_id).update(**updates)
+
+
+def refresh_last_order_at(client_id):
+    """Пересчитывает дату последнего заказа (после удаления или переноса заказа)"""
+    from .models import Client, Order
+
+    last_order_at = Order.objects.filter(client_id=client_id).aggregate(last=Max('created_at'))['last']
+    Client.objects.filter(pk=client_id).update(last_order_at=last_order_at)
+
+
+def order_saved(order, previous=None):
+    """
+    Применяет изменения заказа к счетчикам клиента.
+    previous — словарь со значениями client_id и total_amount до сохранения
+    (None для нового заказа).
+    """
+    if previous is None:
+        apply_client_delta(order.client_id, 1, order.total_amount, order.created_at)
+        return
+
+    if previous['client_id'] != order.client_id:
+        apply_client_delta(previous['client_id'], -1, -previous['total_amount'])
+        refresh_last_order_at(previous['client_id'])
+        apply_client_delta(order.client_id, 1, order.total_amount, order.created_at)
+    elif previous['total_amount'] != order.total_amount:
+        apply_client_delta(order.client_id, spent_delta=order.total_amount - previous['total_amount'])
+
+
+def order_deleted(order):
+    apply_client_delta(order.client_id, -1, -order.total_amount)
+    refresh_last_order_at(order.client_id)
+
+
+def actual_counters(queryset):
+    """Аннотирует клиентов фактическими значениями счетчиков по таблице заказов"""
+    return queryset.annotate(
+        actual_orders_count=Count('orders'),
+        actual_total_spent=Coalesce(
+            Sum('orders__total_amount'),
+            Value(ZERO),
+            output_field=DecimalField(max_digits=12, decimal_places=2)
+        ),
+        actual_last_order_at=Max('orders__created_at'),
+    )
+
+
+def find_drift(clients):
+    """Возвращает клиентов, у которых сохраненные счетчики расходятся с фактическими"""
+    drifted = []
+    for client in clients:
+        if (client.orders_count != client.actual_orders_count
+                or client.total_spent != client.actual_total_spent
+                or client.last_order_at != client.actual_last_order_at):
+            drifted.append(client)
+    return drifted
+
+
+def refresh_client_counters(client_ids):
+    """Пересчитывает счетчики указанных клиентов по таблице заказов; возвращает число исправленных"""
+    from .models import Client
+
+    drifted = find_drift(actual_counters(Client.objects.filter(pk__in=client_ids)))
+    for client in drifted:
+        client.orders_count = client.actual_orders_count
+        client.total_spent = client.actual_total_spent
+        client.last_order_at = client.actual_last_order_at
+    Client.objects.bulk_update(drifted, Client.COUNTER_FIELDS)
+    return len(drifted)
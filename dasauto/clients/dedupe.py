@@ -0,0 +1,299 @@
+"""
+Поиск и объединение дубликатов клиентов.
+
+Попарное сравнение всех клиентов — O(n²), поэтому клиенты сначала
+раскладываются по блокам: нормализованный телефон, ИНН, email, фонетический
+ключ фамилии с первой буквой имени, VIN и госномер автомобиля. Сравниваются
+только клиенты одного владельца внутри одного блока; слишком большие блоки
+(частые фамилии) пропускаются. Клиенты и автомобили читаются потоково через
+values().iterator(), в памяти держатся только компактные признаки.
+
+merge_clients() переносит автомобили, заказы и историю дубликатов на
+основного клиента несколькими UPDATE, дополняет пустые поля и удаляет
+дубликаты.
+"""
+from collections import defaultdict
+from dataclasses import dataclass, field
+from difflib import SequenceMatcher
+from itertools import combinations
+
+from django.db import transaction
+
+from .normalization import fold_text, normalize_code, normalize_phone, normalize_vin
+
+DEFAULT_MIN_SCORE = 0.5
+MAX_BLOCK_SIZE = 50
+READ_CHUNK_SIZE = 5000
+
+# Вес совпадения каждого признака; итоговая оценка ограничена 1.0
+SCORE_WEIGHTS = {
+    'phone': 0.6,
+    'inn': 0.7,
+    'email': 0.4,
+    'vin': 0.6,
+    'plate': 0.3,
+    'last_name': 0.2,
+    'first_name': 0.1,
+    'patronymic': 0.1,
+}
+NAME_SIMILARITY = 0.85
+
+# Поля, которые основной клиент получает от дубликата, если у него самого они пустые
+MERGE_FILL_FIELDS = (
+    'patronymic', 'email', 'additional_phone', 'company_name', 'inn', 'kpp', 'address', 'source', 'notes',
+)
+
+_PHONETIC_VOWELS = str.maketrans({'о': 'а', 'ы': 'а', 'я': 'а', 'е': 'и', 'ё': 'и', 'э': 'и', 'ю': 'у', 'й': 'и'})
+_PHONETIC_DEVOICE = str.maketrans({'б': 'п', 'в': 'ф', 'г': 'к', 'д': 'т', 'ж': 'ш', 'з': 'с'})
+_VOICELESS = set('пфктшсхцч')
+
+
+def phonetic_key(value):
+    """
+    Упрощенный фонетический ключ русской фамилии: безударные гласные сведены
+    к а/и/у, звонкие согласные оглушены в конце и перед глухими, мягкий и
+    твердый знаки убраны, повторы букв схлопнуты. Иванов/Иваноф/Ивонов дают
+    один ключ.
+    """
+    letters = [ch for ch in fold_text(value) if ch.isalpha() and ch not in 'ьъ']
+    letters = [ch.translate(_PHONETIC_VOWELS) for ch in letters]
+    for index, ch in enumerate(letters):
+        following = letters[index + 1] if index + 1 < len(letters) else None
+        if following is None or following in _VOICELESS:
+            letters[index] = ch.translate(_PHONETIC_DEVOICE)
+    key = []
+    for ch in letters:
+        if not key or key[-1] != ch:
+            key.append(ch)
+    return ''.join(key)
+
+
+@dataclass
+class ClientFeatures:
+    """Признаки клиента, по которым считается сходство"""
+    owner_id: int
+    phones: set
+    inn: str
+    email: str
+    last_name: str
+    first_name: str
+    patronymic: str
+    vins: set = field(default_factory=set)
+    plates: set = field(default_factory=set)
+
+
+@dataclass
+class MergeCandidate:
+    client_id: int
+    duplicate_id: int
+    score: float
+    reasons: list
+
+
+def _client_features(row):
+    phones = {normalize_phone(row['phone']), normalize_phone(row['additional_phone'])} - {''}
+    return ClientFeatures(
+        owner_id=row['created_by_id'],
+        phones=phones,
+        inn=(row['inn'] or '').strip(),
+        email=fold_text(row['email']),
+        last_name=fold_text(row['last_name']),
+        first_name=fold_text(row['first_name']),
+        patronymic=fold_text(row['patronymic']),
+    )
+
+
+def _blocking_keys(features):
+    keys = [('phone', phone) for phone in features.phones]
+    if features.inn:
+        keys.append(('inn', features.inn))
+    if features.email:
+        keys.append(('email', features.email))
+    if features.last_name and features.first_name:
+        keys.append(('name', f'{phonetic_key(features.last_name)}:{features.first_name[0]}'))
+    keys.extend(('vin', vin) for vin in features.vins)
+    keys.extend(('plate', plate) for plate in features.plates)
+    return [(features.owner_id, *key) for key in keys]
+
+
+def score_pair(a, b):
+    """Оценка сходства двух клиентов (0..1) и список совпавших признаков"""
+    reasons = []
+    if a.phones & b.phones:
+        reasons.append('phone')
+    if a.inn and a.inn == b.inn:
+        reasons.append('inn')
+    if a.email and a.email == b.email:
+        reasons.append('email')
+    if a.vins & b.vins:
+        reasons.append('vin')
+    if a.plates & b.plates:
+        reasons.append('plate')
+    if a.last_name and b.last_name and (
+        a.last_name == b.last_name
+        or SequenceMatcher(None, a.last_name, b.last_name).ratio() >= NAME_SIMILARITY
+    ):
+        reasons.append('last_name')
+    if a.first_name and a.first_name == b.first_name:
+        reasons.append('first_name')
+    if a.patronymic and a.patronymic == b.patronymic:
+        reasons.append('patronymic')
+    score = min(1.0, sum(SCORE_WEIGHTS[reason] for reason in reasons))
+    return round(score, 2), reasons
+
+
+def load_features(queryset):
+    """Признаки клиентов queryset и их автомобилей: {client_id: ClientFeatures}"""
+    from .models import Car
+
+    features = {}
+    rows = queryset.order_by().values(
+        'pk', 'created_by_id', 'phone', 'additional_phone', 'inn', 'email', 'last_name', 'first_name', 'patronymic'
+    )
+    for row in rows.iterator(chunk_size=READ_CHUNK_SIZE):
+        features[row['pk']] = _client_features(row)
+
+    cars = Car.objects.filter(client__in=queryset.order_by().values('pk')).values('client_id', 'vin', 'license_plate')
+    for car in cars.order_by().iterator(chunk_size=READ_CHUNK_SIZE):
+        client = features.get(car['client_id'])
+        if client is None:
+            continue
+        if car['vin']:
+            client.vins.add(normalize_vin(car['vin']))
+        if car['license_plate']:
+            client.plates.add(normalize_code(car['license_plate']))
+    return features
+
+
+def find_merge_candidates(queryset, min_score=DEFAULT_MIN_SCORE, max_block_size=MAX_BLOCK_SIZE):
+    """
+    Пары вероятных дубликатов среди клиентов queryset, по убыванию оценки.
+    Возвращает (кандидаты, число пропущенных слишком больших блоков).
+    """
+    features = load_features(queryset)
+
+    blocks = defaultdict(list)
+    for client_id, client in features.items():
+        for key in _blocking_keys(client):
+            blocks[key].append(client_id)
+
+    pairs = set()
+    skipped_blocks = 0
+    for client_ids in blocks.values():
+        if len(client_ids) < 2:
+            continue
+        if len(client_ids) > max_block_size:
+            skipped_blocks += 1
+            continue
+        pairs.update(combinations(sorted(set(client_ids)), 2))
+
+    candidates = []
+    for first_id, second_id in pairs:
+        score, reasons = score_pair(features[first_id], features[second_id])
+        if score >= min_score:
+            # Основным считается более ранний клиент
+            candidates.append(MergeCandidate(first_id, second_id, score, reasons))
+    candidates.sort(key=lambda candidate: (-candidate.score, candidate.client_id, candidate.duplicate_id))
+    return candidates, skipped_blocks
+
+
+def group_candidates(candidates):
+    """
+    Группы для объединения: {основной id: [id дубликатов]}. В группу входят
+    только клиенты, похожие на основного напрямую (их пара прошла порог): из
+    A~B и B~C без A~C не следует, что A и C — один клиент, поэтому C
+    остается отдельно до следующего поиска.
+    """
+    groups = defaultdict(list)
+    merged = set()
+    for candidate in sorted(candidates, key=lambda candidate: (candidate.client_id, candidate.duplicate_id)):
+        target, duplicate = candidate.client_id, candidate.duplicate_id
+        if target in merged or duplicate in merged or duplicate in groups:
+            continue
+        groups[target].append(duplicate)
+        merged.add(duplicate)
+    return {target: sorted(client_ids) for target, client_ids in sorted(groups.items())}
+
+
+def merge_clients(target, duplicates, user=None):
+    """
+    Объединяет дубликаты с клиентом target: автомобили, заказы и история
+    переносятся массовыми UPDATE, пустые поля target дополняются, теги
+    объединяются, дубликаты удаляются. Все клиенты должны принадлежать
+    одному владельцу.
+    """
+    from . import counters
+    from .cache import invalidate_client_sources, invalidate_dashboard
+    from .models import Car, Client, ClientHistory, ClientHistoryArchive, Order
+    from .tags import invalidate_tag_counts, parse_tags
+
+    duplicate_ids = sorted({client.pk for client in duplicates} - {target.pk})
+    if not duplicate_ids:
+        return target
+
+    with transaction.atomic():
+        target = Client.objects.select_for_update().get(pk=target.pk)
+        duplicates = list(Client.objects.select_for_update().filter(pk__in=duplicate_ids).order_by('pk'))
+        if len(duplicates) != len(duplicate_ids):
+            raise ValueError('Часть клиентов для объединения не найдена')
+        if any(client.created_by_id != target.created_by_id for client in duplicates):
+            raise ValueError('Объединять можно только клиентов одного владельца')
+
+        Car.objects.filter(client_id__in=duplicate_ids).update(client=target)
+        Order.objects.filter(client_id__in=duplicate_ids).update(client=target)
+        ClientHistory.objects.filter(client_id__in=duplicate_ids).update(client=target)
+        ClientHistoryArchive.objects.filter(client_id__in=duplicate_ids).update(client=target)
+
+        filled = {}
+        for name in MERGE_FILL_FIELDS:
+            if not getattr(target, name):
+                value = next((getattr(client, name) for client in duplicates if getattr(client, name)), None)
+                if value:
+                    filled[name] = value
+        # Другой основной номер дубликата сохраняется как дополнительный
+        if not target.additional_phone:
+            other_phone = next((
+                client.phone for client in duplicates
+                if normalize_phone(client.phone) != normalize_phone(target.phone)
+            ), None)
+            if other_phone:
+                filled['additional_phone'] = other_phone
+        # Теги дубликатов переходят к target: связи ClientTag target.save() создаст из строки
+        # (теги, не уместившиеся в поле, отбрасываются)
+        tags = ''
+        for name in parse_tags(','.join([target.tags, *(client.tags for client in duplicates)])):
+            joined = f'{tags}, {name}' if tags else name
+            if len(joined) > Client._meta.get_field('tags').max_length:
+                break
+            tags = joined
+        if parse_tags(tags) != parse_tags(target.tags):
+            filled['tags'] = tags
+
+        # Уникальные поля освобождаются вместе с удалением дубликатов
+        Client.objects.filter(pk__in=duplicate_ids).delete()
+
+        for name, value in filled.items():
+            setattr(target, name, value)
+        actual = counters.actual_counters(Client.objects.filter(pk=target.pk)).values(
+            'actual_orders_count', 'actual_total_spent', 'actual_last_order_at'
+        ).get()
+        target.orders_count = actual['actual_orders_count']
+        target.total_spent = actual['actual_total_spent']
+        target.last_order_at = actual['actual_last_order_at']
+        target.save()
+        Client.objects.filter(pk=target.pk).update(
+            **{name: getattr(target, name) for name in Client.COUNTER_FIELDS}
+        )
+
+        ClientHistory.objects.create(
+            client=target,
+            created_by=user,
+            action='Объединение клиентов',
+            description='Присоединены клиенты: ' + ', '.join(
+                f'#{client.pk} {client.full_name} ({client.phone})' for client in duplicates
+            ),
+        )
+        invalidate_dashboard(target.created_by_id)
+        invalidate_tag_counts(target.created_by_id)
+        invalidate_client_sources([client.source for client in duplicates], removed=True)
+    return target
@@ -0,0 +1,294 @@
+"""
+События заказов для живой доски (SSE).
+
+Order.save() и удаление заказа после фиксации транзакции публикуют короткое
+событие (создан, сменил статус, удален) в канал владельца клиента. Доска
+подписывается на канал через /clients/board/events/ и получает только
+дельты, поэтому открытые экраны не нагружают базу: запрос к БД делается
+один раз при открытии доски.
+
+Брокер выбирается настройкой ORDER_EVENTS_BACKEND (путь к классу):
+
+- DatabaseBroker (по умолчанию) — события пишутся в таблицу OrderEvent и
+  видны всем процессам и воркерам. Таблицу читает один опросчик на процесс
+  (раз в POLL_INTERVAL секунд, по индексу) и раздает события подписчикам
+  в памяти: нагрузка на БД не зависит от числа открытых экранов;
+- InMemoryBroker — очереди asyncio внутри процесса, без обращений к БД;
+  годится только для одного процесса (gunicorn.conf.py не запустит с ним
+  несколько воркеров).
+
+У брокера есть publish(), history(), last_id(), subscribe() и
+subscriber_count().
+"""
+import asyncio
+import itertools
+import logging
+import threading
+from collections import deque
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'clients.events.DatabaseBroker'
+IN_MEMORY_BACKEND = 'clients.events.InMemoryBroker'
+REPLAY_BUFFER_SIZE = 200
+SUBSCRIBER_QUEUE_SIZE = 1000
+# DatabaseBroker: как часто опросчик процесса проверяет новые события и сколько они хранятся
+POLL_INTERVAL = 1.0
+EVENT_RETENTION = timedelta(hours=1)
+PRUNE_EVERY = 100
+
+
+def order_channel(user_id):
+    return f'orders:{user_id}'
+
+
+class _LocalSubscribers:
+    """
+    Подписчики текущего процесса: очереди asyncio в цикле событий
+    ASGI-сервера. Раздача событий потокобезопасна — publish() может
+    вызываться из пула потоков синхронных представлений.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def _fan_out(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(self._deliver, queue, event)
+
+    @staticmethod
+    def _deliver(queue, event):
+        if queue.full():
+            # Отстающий экран теряет самые старые события, а не тормозит остальных
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+    async def _start(self, loop):
+        """Вызывается после добавления подписчика, до чтения истории"""
+
+    def _unsubscribed(self, loop):
+        """Вызывается под блокировкой после удаления подписчика"""
+
+    async def subscribe(self, channel, last_event_id=None, timeout=None):
+        """
+        Асинхронный генератор событий (id, data). Если за timeout секунд
+        событий нет, выдает None — чтобы отправить клиенту keep-alive.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        subscriber = (loop, queue)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscriber)
+        try:
+            await self._start(loop)
+            last_sent = last_event_id or 0
+            if last_event_id is not None:
+                for event in await self._ahistory(channel, last_event_id):
+                    last_sent = event[0]
+                    yield event
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event[0] > last_sent:
+                    last_sent = event[0]
+                    yield event
+        finally:
+            with self._lock:
+                subscribers = self._subscribers.get(channel, set())
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    self._subscribers.pop(channel, None)
+                self._unsubscribed(loop)
+
+    async def _ahistory(self, channel, after_id):
+        return self.history(channel, after_id)
+
+    def _loop_channels(self, loop):
+        """Каналы, на которые подписаны очереди цикла loop (вызывается под блокировкой)"""
+        return {
+            channel for channel, subscribers in self._subscribers.items()
+            if any(subscriber_loop is loop for subscriber_loop, _ in subscribers)
+        }
+
+    def subscriber_count(self, channel=None):
+        """Подписчики текущего процесса"""
+        with self._lock:
+            if channel is not None:
+                return len(self._subscribers.get(channel, ()))
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+class InMemoryBroker(_LocalSubscribers):
+    """
+    Pub/sub внутри процесса. Последние события канала хранятся для
+    переподключения с Last-Event-ID.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._ids = itertools.count(1)
+        self._history = {}
+
+    def publish(self, channel, data):
+        with self._lock:
+            event = (next(self._ids), data)
+            self._history.setdefault(channel, deque(maxlen=REPLAY_BUFFER_SIZE)).append(event)
+        self._fan_out(channel, event)
+        return event[0]
+
+    def history(self, channel, after_id):
+        with self._lock:
+            return [event for event in self._history.get(channel, ()) if event[0] > after_id]
+
+    def last_id(self, channel):
+        """id последнего события канала (0, если событий нет)"""
+        with self._lock:
+            events = self._history.get(channel)
+            return events[-1][0] if events else 0
+
+
+class DatabaseBroker(_LocalSubscribers):
+    """
+    Pub/sub через таблицу OrderEvent: публикация — INSERT. В каждом цикле
+    событий процесса, где есть подписчики, работает один опросчик: раз в
+    poll_interval секунд он одним запросом читает новые события всех
+    каналов, на которые подписаны экраны этого процесса, и раздает их по
+    очередям. Опросчик останавливается вместе с последним подписчиком.
+    События старше EVENT_RETENTION удаляются при публикации.
+    """
+    poll_interval = POLL_INTERVAL
+
+    def __init__(self):
+        super().__init__()
+        self._pollers = {}
+
+    def publish(self, channel, data):
+        from .models import OrderEvent
+
+        event = OrderEvent.objects.create(channel=channel, data=data)
+        if event.pk % PRUNE_EVERY == 0:
+            OrderEvent.objects.filter(created_at__lt=timezone.now() - EVENT_RETENTION).delete()
+        return event.pk
+
+    def history(self, channel, after_id):
+        from .models import OrderEvent
+
+        return list(
+            OrderEvent.objects.filter(channel=channel, pk__gt=after_id)
+            .order_by('pk').values_list('pk', 'data')[:REPLAY_BUFFER_SIZE]
+        )
+
+    async def _ahistory(self, channel, after_id):
+        return await sync_to_async(self.history)(channel, after_id)
+
+    def last_id(self, channel):
+        from .models import OrderEvent
+
+        return OrderEvent.objects.filter(channel=channel).order_by('-pk').values_list('pk', flat=True).first() or 0
+
+    def _latest_id(self):
+        from .models import OrderEvent
+
+        return OrderEvent.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+    async def _start(self, loop):
+        with self._lock:
+            if loop in self._pollers:
+                return
+        # Курсор опросчика читается до истории подписчика: события между ними не теряются
+        cursor = await sync_to_async(self._latest_id)()
+        with self._lock:
+            if loop not in self._pollers and self._loop_channels(loop):
+                self._pollers[loop] = loop.create_task(self._poll(loop, cursor))
+
+    def _unsubscribed(self, loop):
+        if not self._loop_channels(loop):
+            poller = self._pollers.pop(loop, None)
+            if poller is not None:
+                poller.cancel()
+
+    def _fetch(self, after_id, channels):
+        """Новые события каналов одним запросом: [(id, channel, data), ...]"""
+        from .models import OrderEvent
+
+        try:
+            return list(
+                OrderEvent.objects.filter(channel__in=channels, pk__gt=after_id)
+                .order_by('pk').values_list('pk', 'channel', 'data')[:REPLAY_BUFFER_SIZE]
+            )
+        except DatabaseError:
+            # Разорванное соединение опросчик переоткроет на следующем шаге
+            connection.close()
+            raise
+
+    async def _poll(self, loop, cursor):
+        while True:
+            with self._lock:
+                channels = self._loop_channels(loop)
+            try:
+                rows = await sync_to_async(self._fetch)(cursor, channels)
+            except DatabaseError:
+                logger.exception('Не удалось прочитать события доски заказов')
+                rows = []
+            for pk, channel, data in rows:
+                cursor = pk
+                with self._lock:
+                    queues = [queue for subscriber_loop, queue in self._subscribers.get(channel, ())
+                              if subscriber_loop is loop]
+                for queue in queues:
+                    self._deliver(queue, (pk, data))
+            if len(rows) < REPLAY_BUFFER_SIZE:
+                await asyncio.sleep(self.poll_interval)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'ORDER_EVENTS_BACKEND', DEFAULT_BACKEND))()
+    return _broker
+
+
+def set_broker(broker):
+    """Подменяет брокер (например, в тестах); возвращает предыдущий"""
+    global _broker
+    with _broker_lock:
+        previous, _broker = _broker, broker
+    return previous
+
+
+def order_event_data(order, event_type):
+    return {
+        'type': event_type,
+        'id': order.pk,
+        'order_number': order.order_number,
+        'status': order.status,
+        'status_display': order.get_status_display(),
+        'client': order.client.full_name,
+        'client_id': order.client_id,
+        'car': str(order.car),
+        'appointment_date': order.appointment_date.isoformat() if order.appointment_date else None,
+    }
+
+
+def publish_order_event(user_id, data):
+    if user_id is not None:
+        get_broker().publish(order_channel(user_id), data)
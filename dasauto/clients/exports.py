@@ -0,0 +1,173 @@
+"""
+Потоковая выгрузка клиентов, автомобилей, заказов и строк заказов.
+
+Данные читаются пачками по первичному ключу (pk > последнего в пачке) —
+связанные объекты подгружаются prefetch_related отдельно для каждой пачки, —
+и сразу пишутся в CSV, поэтому весь queryset никогда не оказывается в памяти
+(.iterator() на MySQL с mysqlclient все равно буферизует весь результат).
+В CSV текстовые ячейки, которые Excel принял бы за формулу, экранируются
+апострофом; телефоны и числа (+7 999 …, -5) остаются как есть. В XLSX
+строка — это всегда текстовая ячейка, формулой openpyxl считает только
+значение, начинающееся с «=». Для HTTP используется StreamingHttpResponse
+(CSV) или временный файл (XLSX), для файлов — команда export_clients.
+"""
+import csv
+import re
+
+from django.utils import timezone
+
+from .models import Client, Car, Order, Service, Part
+
+EXPORT_CHUNK_SIZE = 2000
+CSV_DELIMITER = ';'  # разделитель, который русский Excel открывает без мастера импорта
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+# Телефон или число: формулой не станет, апостроф только испортил бы значение
+PLAIN_NUMBER_RE = re.compile(r'^[+-]?[\d\s().-]*\d[\d\s().-]*$')
+
+
+def _batches(queryset):
+    """Объекты queryset пачками по pk: каждая пачка — отдельный запрос с LIMIT"""
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:EXPORT_CHUNK_SIZE])
+        if not batch:
+            return
+        yield from batch
+        last_pk = batch[-1].pk
+
+
+def _escape_cell(value):
+    """Строку, начинающуюся с =, +, -, @, Excel выполнит как формулу — экранируем ее"""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES) and not PLAIN_NUMBER_RE.match(value):
+        return "'" + value
+    return value
+
+
+def _xlsx_cell(value):
+    """Значение ячейки XLSX: openpyxl делает формулой только строку с «=» в начале"""
+    if not isinstance(value, (int, float, str)):
+        value = str(value)
+    if isinstance(value, str) and value.startswith('='):
+        return "'" + value
+    return value
+
+
+def _datetime(value):
+    return timezone.localtime(value).strftime('%d.%m.%Y %H:%M') if value else ''
+
+
+def _date(value):
+    return value.strftime('%d.%m.%Y') if value else ''
+
+
+def _client_rows(owner):
+    clients = Client.objects.filter(created_by=owner).order_by('pk').prefetch_related('cars')
+    yield [
+        'ID', 'Тип', 'Фамилия', 'Имя', 'Отчество', 'Телефон', 'Доп. телефон', 'Email', 'Компания', 'ИНН', 'КПП',
+        'Адрес', 'Скидка %', 'Источник', 'Теги', 'Заказов', 'Всего потрачено', 'Последний заказ',
+        'Автомобили', 'Активен', 'Дата создания',
+    ]
+    for client in _batches(clients):
+        yield [
+            client.pk, client.get_client_type_display(), client.last_name, client.first_name, client.patronymic,
+            client.phone, client.additional_phone, client.email, client.company_name, client.inn or '', client.kpp,
+            client.address, client.discount, client.source, client.tags, client.orders_count, client.total_spent,
+            _datetime(client.last_order_at), ', '.join(str(car) for car in client.cars.all()),
+            'да' if client.is_active else 'нет', _datetime(client.created_at),
+        ]
+
+
+def _car_rows(owner):
+    cars = Car.objects.filter(client__created_by=owner).order_by('pk').select_related('client')
+    yield [
+        'ID', 'Клиент ID', 'Клиент', 'Телефон клиента', 'Марка', 'Модель', 'Год', 'VIN', 'Госномер',
+        'Объем двигателя', 'Мощность', 'КПП', 'Топливо', 'Пробег', 'Цвет',
+    ]
+    for car in _batches(cars):
+        yield [
+            car.pk, car.client_id, car.client.full_name, car.client.phone, car.brand, car.model, car.year or '',
+            car.vin or '', car.license_plate, car.engine_volume or '', car.engine_power or '',
+            car.get_transmission_display(), car.get_fuel_type_display(), car.mileage, car.color,
+        ]
+
+
+def _order_rows(owner):
+    orders = Order.objects.filter(client__created_by=owner).order_by('pk').select_related('client', 'car')
+    yield [
+        'ID', 'Номер', 'Клиент ID', 'Клиент', 'Автомобиль', 'Статус', 'Оплата', 'Дата создания', 'Дата записи',
+        'Дата выполнения', 'Работы', 'Запчасти', 'Скидка', 'Предоплата', 'Итого', 'Гарантия до',
+    ]
+    for order in _batches(orders):
+        yield [
+            order.pk, order.order_number, order.client_id, order.client.full_name, str(order.car),
+            order.get_status_display(), order.get_payment_status_display(), _datetime(order.created_at),
+            _datetime(order.appointment_date), _datetime(order.completed_at), order.labor_cost, order.parts_cost,
+            order.discount, order.prepayment, order.total_amount, _date(order.warranty_until),
+        ]
+
+
+def _order_line_rows(owner):
+    yield ['Номер заказа', 'Вид', 'Наименование', 'Артикул', 'Количество', 'Цена', 'Сумма']
+    services = Service.objects.filter(order__client__created_by=owner).order_by('pk').select_related('order')
+    for service in _batches(services):
+        yield [
+            service.order.order_number, 'Работа', service.name, '', service.quantity, service.price, service.total,
+        ]
+    parts = Part.objects.filter(order__client__created_by=owner).order_by('pk').select_related('order')
+    for part in _batches(parts):
+        yield [
+            part.order.order_number, 'Запчасть', part.name, part.article, part.quantity, part.price, part.total,
+        ]
+
+
+EXPORTS = {
+    'clients': _client_rows,
+    'cars': _car_rows,
+    'orders': _order_rows,
+    'order_lines': _order_line_rows,
+}
+
+
+def export_rows(dataset, owner):
+    """Генератор строк выгрузки (первая строка — заголовки)"""
+    return EXPORTS[dataset](owner)
+
+
+class _Echo:
+    """Псевдо-файл: csv.writer возвращает записанную строку вместо буферизации"""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    """Строки CSV для StreamingHttpResponse; BOM нужен Excel для UTF-8"""
+    writer = csv.writer(_Echo(), delimiter=CSV_DELIMITER)
+    yield '\ufeff'
+    for row in rows:
+        yield writer.writerow([_escape_cell(value) for value in row])
+
+
+def xlsx_available():
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def write_xlsx(rows, path):
+    """
+    Записывает строки в XLSX в режиме write_only (строки не копятся в памяти).
+    path — имя файла или открытый бинарный файл.
+    """
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise ImportError('Для выгрузки в XLSX установите пакет openpyxl')
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for row in rows:
+        sheet.append([_xlsx_cell(value) for value in row])
+    workbook.save(path)
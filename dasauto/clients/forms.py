@@ -1,5 +1,8 @@
 from django import forms
-from .models import Client
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.template.defaultfilters import filesizeformat
+from .models import Client, Service, Part
 
 
 class ClientForm(forms.ModelForm):
@@ -57,4 +60,38 @@ class ClientForm(forms.ModelForm):
         if inn and len(inn) not in [10, 12]:
             raise forms.ValidationError('ИНН должен содержать 10 или 12 цифр')
 
-        return inn
\ No newline at end of file
+        return inn
+
+
+class ServiceLineForm(forms.ModelForm):
+    """Строка работ заказа (сумма считается из количества и цены)"""
+    class Meta:
+        model = Service
+        fields = ['name', 'quantity', 'price']
+
+
+class PartLineForm(forms.ModelForm):
+    """Строка запчастей заказа"""
+    class Meta:
+        model = Part
+        fields = ['name', 'article', 'quantity', 'price']
+
+
+class ClientImportUploadForm(forms.Form):
+    """Загрузка файла для импорта клиентов в админке"""
+    file = forms.FileField(label='Файл CSV или XLSX')
+    owner = forms.ModelChoiceField(
+        label='Владелец клиентов',
+        queryset=get_user_model().objects.order_by('username'),
+    )
+    dry_run = forms.BooleanField(label='Только проверить', required=False)
+
+    def clean_file(self):
+        # Импорт идет в том же запросе: большой файл занял бы воркер надолго
+        upload = self.cleaned_data['file']
+        if upload.size > settings.ADMIN_IMPORT_MAX_UPLOAD_SIZE:
+            raise forms.ValidationError(
+                f'Файл больше {filesizeformat(settings.ADMIN_IMPORT_MAX_UPLOAD_SIZE)}: загрузите его командой '
+                f'python manage.py import_clients <файл> --user <имя пользователя>'
+            )
+        return upload
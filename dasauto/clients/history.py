@@ -0,0 +1,114 @@
+"""
+История взаимодействия с клиентами.
+
+record_history() не пишет в базу сразу: внутри запроса записи копятся в
+буфере, а HistoryBufferMiddleware сохраняет их одним bulk_create перед
+отдачей ответа (и сбрасывает кэш дашборда владельцев). Если представление
+упало с исключением, буфер отбрасывается. Вне запроса (команды, shell,
+тесты без клиента) запись сохраняется сразу.
+
+Старые записи переносятся командой archive_client_history в таблицу
+ClientHistoryArchive, так что рабочая таблица остается небольшой, а архив
+доступен на странице клиента по запросу.
+"""
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.db import transaction
+
+_buffer = ContextVar('client_history_buffer', default=None)
+
+ARCHIVE_BATCH_SIZE = 1000
+
+
+def record_history(client, action, description='', user=None, order=None):
+    """Добавляет запись в историю клиента (в буфер запроса, если он открыт)"""
+    from .models import ClientHistory
+
+    entry = ClientHistory(client=client, created_by=user, action=action, description=description, order=order)
+    buffer = _buffer.get()
+    if buffer is None:
+        entry.save()
+    else:
+        buffer.append(entry)
+    return entry
+
+
+def flush_history(entries):
+    """Сохраняет накопленные записи одним INSERT"""
+    from .cache import invalidate_dashboard
+    from .models import ClientHistory
+
+    if not entries:
+        return
+    with transaction.atomic():
+        ClientHistory.objects.bulk_create(entries)
+        for owner_id in {entry.client.created_by_id for entry in entries}:
+            invalidate_dashboard(owner_id)
+
+
+class HistoryBufferMiddleware:
+    """Открывает буфер истории на время запроса и сохраняет его после представления"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _buffer.set([])
+        try:
+            response = self.get_response(request)
+            flush_history(_buffer.get())
+        finally:
+            _buffer.reset(token)
+        return response
+
+    async def __acall__(self, request):
+        token = _buffer.set([])
+        try:
+            response = await self.get_response(request)
+            await sync_to_async(flush_history)(_buffer.get())
+        finally:
+            _buffer.reset(token)
+        return response
+
+
+def archive_history(cutoff, batch_size=ARCHIVE_BATCH_SIZE, dry_run=False):
+    """
+    Переносит записи старше cutoff в ClientHistoryArchive пачками по первичному
+    ключу; каждая пачка — отдельная транзакция. Возвращает число записей.
+    """
+    from .models import ClientHistory, ClientHistoryArchive
+
+    old = ClientHistory.objects.filter(created_at__lt=cutoff).order_by('pk')
+    if dry_run:
+        return old.count()
+
+    moved = 0
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            batch = list(old.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            ClientHistoryArchive.objects.bulk_create([
+                ClientHistoryArchive(
+                    history_id=entry.pk,
+                    client_id=entry.client_id,
+                    created_by_id=entry.created_by_id,
+                    action=entry.action,
+                    description=entry.description,
+                    order_id=entry.order_id,
+                    created_at=entry.created_at,
+                )
+                for entry in batch
+            ], ignore_conflicts=True)
+            ClientHistory.objects.filter(pk__in=[entry.pk for entry in batch]).delete()
+        moved += len(batch)
+        last_pk = batch[-1].pk
+    return moved
@@ -0,0 +1,299 @@
+"""
+Массовый импорт клиентов и автомобилей из CSV и XLSX.
+
+Файл читается потоково и обрабатывается пачками: строки проверяются правилами
+ClientForm, автомобили — формой модели Car, дубликаты отсекаются по нормализованному телефону, ИНН и VIN
+(внутри пачки и в базе), затем клиенты, автомобили и записи истории
+вставляются через bulk_create в одной транзакции на пачку. Дубликаты из
+предыдущих пачек к этому моменту уже в базе и находятся той же проверкой,
+поэтому в памяти держится только текущая пачка и объем файла не ограничен.
+При dry_run ничего не записывается, и повтор строки из другой пачки
+проверкой не обнаруживается.
+"""
+import csv
+import os
+from dataclasses import dataclass, field
+
+from django import forms
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .cache import invalidate_client_sources, invalidate_dashboard
+from .forms import ClientForm
+from .models import Client, Car, ClientHistory
+from .normalization import fold_text, normalize_phone, normalize_vin
+from .search import reindex_clients
+from .tags import sync_client_tags
+
+DEFAULT_BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+
+CAR_FIELDS = ['brand', 'model', 'year', 'vin', 'license_plate']
+MIN_CAR_YEAR = 1900
+CLIENT_DEFAULTS = {'client_type': 'individual', 'discount': '0'}
+
+
+def _build_column_map():
+    """Колонки файла: имена полей и их русские названия"""
+    columns = {}
+    for name in ClientForm.Meta.fields:
+        columns[name] = ('client', name)
+        columns[fold_text(Client._meta.get_field(name).verbose_name)] = ('client', name)
+    columns['тип клиента'] = ('client', 'client_type')
+    for name in CAR_FIELDS:
+        columns[f'car_{name}'] = ('car', name)
+        columns[name] = ('car', name)
+        columns[fold_text(Car._meta.get_field(name).verbose_name)] = ('car', name)
+    return columns
+
+
+COLUMN_MAP = _build_column_map()
+
+
+class ClientImportForm(ClientForm):
+    """Правила ClientForm без проверки уникальности: дубликаты ищутся пачкой"""
+
+    def validate_unique(self):
+        pass
+
+
+class CarImportForm(forms.ModelForm):
+    """Автомобиль из строки файла; уникальность VIN проверяется пачкой"""
+
+    class Meta:
+        model = Car
+        fields = CAR_FIELDS
+
+    def clean_year(self):
+        year = self.cleaned_data.get('year')
+        max_year = timezone.localdate().year + 1
+        if year is not None and not MIN_CAR_YEAR <= year <= max_year:
+            raise forms.ValidationError(f'Год выпуска должен быть от {MIN_CAR_YEAR} до {max_year}')
+        return year
+
+    def validate_unique(self):
+        pass
+
+
+def _form_errors(form):
+    return '; '.join(f'{name}: {" ".join(messages)}' for name, messages in form.errors.items())
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0
+    created_clients: int = 0
+    created_cars: int = 0
+    skipped: int = 0
+    error_count: int = 0
+    errors: list = field(default_factory=list)
+
+    def add_error(self, row_number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((row_number, message))
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def iter_csv_rows(path):
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        sample = file.read(4096)
+        file.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(file, dialect)
+        for values in reader:
+            yield [_cell(value) for value in values]
+
+
+def iter_xlsx_rows(path):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportError('Для импорта XLSX установите пакет openpyxl')
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for values in workbook.active.iter_rows(values_only=True):
+            yield [_cell(value) for value in values]
+    finally:
+        workbook.close()
+
+
+def iter_rows(path):
+    """Строки файла в виде словарей {('client'|'car', поле): значение} с номером строки"""
+    extension = os.path.splitext(path)[1].lower()
+    rows = iter_xlsx_rows(path) if extension in ('.xlsx', '.xlsm') else iter_csv_rows(path)
+
+    header = next(rows, None)
+    if header is None:
+        return
+    columns = [COLUMN_MAP.get(fold_text(name)) for name in header]
+    if not any(column == ('client', 'phone') for column in columns):
+        raise ValueError('В файле нет колонки с телефоном (phone / Телефон)')
+
+    for row_number, values in enumerate(rows, start=2):
+        if not any(values):
+            continue
+        row = {}
+        for column, value in zip(columns, values):
+            if column and value:
+                row[column] = value
+        yield row_number, row
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ClientImporter:
+    """Импорт клиентов пользователя owner из файла"""
+
+    def __init__(self, owner, batch_size=DEFAULT_BATCH_SIZE, dry_run=False, progress=None):
+        self.owner = owner
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.progress = progress
+        self.report = ImportReport()
+
+    def run(self, path):
+        for chunk in _chunks(iter_rows(path), self.batch_size):
+            self._import_chunk(chunk)
+            if self.progress:
+                self.progress(self.report)
+        return self.report
+
+    def _validate(self, row_number, row):
+        client_data = dict(CLIENT_DEFAULTS)
+        client_data.update({name: value for (kind, name), value in row.items() if kind == 'client'})
+        form = ClientImportForm(data=client_data)
+        if not form.is_valid():
+            self.report.add_error(row_number, _form_errors(form))
+            return None
+
+        client = form.save(commit=False)
+        client.created_by = self.owner
+        client.is_active = True
+        client.normalize_phones()
+
+        car_data = {name: value for (kind, name), value in row.items() if kind == 'car'}
+        car = None
+        if car_data:
+            if car_data.get('vin'):
+                car_data['vin'] = normalize_vin(car_data['vin'])
+            car_form = CarImportForm(data=car_data)
+            if not car_form.is_valid():
+                self.report.add_error(row_number, f'Автомобиль: {_form_errors(car_form)}')
+                return None
+            car = car_form.save(commit=False)
+            car.vin = car.vin or None
+        return client, car
+
+    def _existing_keys(self, raw_phones, phones, inns, vins):
+        """Ключи из пачки, которые уже есть в базе"""
+        existing_phones = {
+            normalize_phone(phone) for phone in Client.objects.filter(
+                Q(phone_e164__in=['+' + phone for phone in phones]) | Q(phone__in=raw_phones)
+            ).values_list('phone', flat=True)
+        }
+        existing_inns = set(Client.objects.filter(inn__in=inns).values_list('inn', flat=True)) if inns else set()
+        existing_vins = set(Car.objects.filter(vin__in=vins).values_list('vin', flat=True)) if vins else set()
+        return existing_phones, existing_inns, existing_vins
+
+    def _import_chunk(self, chunk):
+        self.report.rows += len(chunk)
+
+        validated = []
+        for row_number, row in chunk:
+            result = self._validate(row_number, row)
+            if result:
+                validated.append((row_number, *result))
+
+        phones = {normalize_phone(client.phone) for _, client, _ in validated}
+        inns = {client.inn for _, client, _ in validated if client.inn}
+        vins = {car.vin for _, _, car in validated if car and car.vin}
+        raw_phones = {client.phone for _, client, _ in validated}
+        existing_phones, existing_inns, existing_vins = self._existing_keys(raw_phones, phones, inns, vins)
+        # Ключи, уже встреченные в пачке; более ранние пачки уже в базе
+        seen_phones = set()
+        seen_inns = set()
+        seen_vins = set()
+
+        clients = []
+        cars = {}
+        for row_number, client, car in validated:
+            phone = normalize_phone(client.phone)
+            if phone in existing_phones or phone in seen_phones:
+                self.report.skipped += 1
+                self.report.add_error(row_number, f'Клиент с телефоном {client.phone} уже существует')
+                continue
+            if client.inn and (client.inn in existing_inns or client.inn in seen_inns):
+                self.report.skipped += 1
+                self.report.add_error(row_number, f'Клиент с ИНН {client.inn} уже существует')
+                continue
+
+            seen_phones.add(phone)
+            if client.inn:
+                seen_inns.add(client.inn)
+            clients.append(client)
+
+            if car:
+                if car.vin and (car.vin in existing_vins or car.vin in seen_vins):
+                    self.report.add_error(row_number, f'Автомобиль с VIN {car.vin} уже существует, пропущен')
+                else:
+                    if car.vin:
+                        seen_vins.add(car.vin)
+                    cars[client.phone] = car
+
+        if self.dry_run or not clients:
+            self.report.created_clients += len(clients)
+            self.report.created_cars += len(cars)
+            return
+
+        with transaction.atomic():
+            Client.objects.bulk_create(clients, batch_size=self.batch_size)
+            # MySQL не возвращает id из bulk_create — получаем их по уникальному телефону
+            ids = dict(Client.objects.filter(phone__in=[c.phone for c in clients]).values_list('phone', 'id'))
+            for client in clients:
+                client.pk = ids[client.phone]
+            for phone, car in cars.items():
+                car.client_id = ids[phone]
+            Car.objects.bulk_create(cars.values(), batch_size=self.batch_size)
+
+            ClientHistory.objects.bulk_create([
+                ClientHistory(
+                    client_id=client.pk,
+                    created_by=self.owner,
+                    action='Импорт клиента',
+                    description=f'Клиент импортирован пользователем {self.owner.username}',
+                )
+                for client in clients
+            ], batch_size=self.batch_size)
+
+            reindex_clients(
+                Client.objects.filter(pk__in=[client.pk for client in clients]).prefetch_related('cars'),
+                batch_size=self.batch_size,
+            )
+            sync_client_tags(clients, batch_size=self.batch_size)
+            invalidate_dashboard(self.owner.pk)
+            invalidate_client_sources(client.source for client in clients)
+
+        self.report.created_clients += len(clients)
+        self.report.created_cars += len(cars)
@@ -0,0 +1,168 @@
+"""
+Строки заказа (работы и запчасти) и пересчет сумм заказа.
+
+save_order_lines() принимает весь набор строк заказа сразу: проверяет их
+формами, считает суммы за один проход, вставляет новые строки через
+bulk_create, измененные — через bulk_update, удаляет отсутствующие и
+обновляет labor_cost/parts_cost/total_amount заказа одним UPDATE в той же
+транзакции. Счетчики клиента, дневная статистика и кэш дашборда
+обновляются так же, как в Order.save().
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Sum, Value, DecimalField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .forms import ServiceLineForm, PartLineForm
+from .models import Order, Service, Part
+
+CENT = Decimal('0.01')
+
+LINE_KINDS = {
+    'services': (Service, ServiceLineForm),
+    'parts': (Part, PartLineForm),
+}
+
+
+class LineItemsError(ValueError):
+    """Ошибки проверки строк: {'services': {номер строки или '__all__': ошибки}, 'parts': {...}}"""
+
+    def __init__(self, errors):
+        super().__init__('Строки заказа содержат ошибки')
+        self.errors = errors
+
+
+def line_total_subquery(model):
+    """Подзапрос: сумма строк модели model (Service или Part) для заказа из внешнего запроса"""
+    totals = model.objects.filter(order=OuterRef('pk')).order_by().values('order').annotate(total=Sum('total'))
+    return Coalesce(
+        Subquery(totals.values('total')), Value(0), output_field=DecimalField(max_digits=10, decimal_places=2)
+    )
+
+
+def line_as_dict(line):
+    data = {'id': line.pk, 'name': line.name, 'quantity': line.quantity, 'price': str(line.price),
+            'total': str(line.total)}
+    if isinstance(line, Part):
+        data['article'] = line.article
+    return data
+
+
+def _validate(lines_by_kind):
+    """Проверяет строки формами; возвращает {вид: [(id или None, cleaned_data)]}"""
+    cleaned = {}
+    errors = {}
+    for kind, lines in lines_by_kind.items():
+        _, form_class = LINE_KINDS[kind]
+        cleaned[kind] = []
+        if not isinstance(lines, list):
+            errors[kind] = {'__all__': [{'message': 'Ожидается список строк'}]}
+            continue
+        for index, data in enumerate(lines):
+            if not isinstance(data, dict):
+                errors.setdefault(kind, {})[index] = {'__all__': [{'message': 'Строка должна быть объектом'}]}
+                continue
+            form = form_class(data=data)
+            if not form.is_valid():
+                errors.setdefault(kind, {})[index] = form.errors.get_json_data()
+                continue
+            line_id = data.get('id')
+            if line_id is not None and (not isinstance(line_id, int) or isinstance(line_id, bool)):
+                errors.setdefault(kind, {})[index] = {'id': [{'message': 'Некорректный id строки'}]}
+                continue
+            cleaned[kind].append((line_id, form.cleaned_data))
+    if errors:
+        raise LineItemsError(errors)
+    return cleaned
+
+
+def _sync_lines(order, kind, lines):
+    """Приводит строки вида kind к переданному набору; возвращает сумму строк"""
+    model, form_class = LINE_KINDS[kind]
+    existing = {line.pk: line for line in model.objects.filter(order=order)}
+    fields = form_class.Meta.fields + ['total']
+
+    to_create = []
+    to_update = []
+    unknown = {}
+    total = Decimal('0.00')
+    for index, (line_id, data) in enumerate(lines):
+        if line_id is None:
+            line = model(order=order)
+        elif line_id in existing:
+            line = existing.pop(line_id)
+        else:
+            unknown[index] = {'id': [{'message': 'Строка не найдена в заказе'}]}
+            continue
+
+        data = dict(data, total=(data['quantity'] * data['price']).quantize(CENT))
+        total += data['total']
+        if line.pk is None:
+            for name, value in data.items():
+                setattr(line, name, value)
+            to_create.append(line)
+        elif any(getattr(line, name) != value for name, value in data.items()):
+            for name, value in data.items():
+                setattr(line, name, value)
+            to_update.append(line)
+
+    if unknown:
+        raise LineItemsError({kind: unknown})
+
+    model.objects.bulk_create(to_create)
+    if to_update:
+        model.objects.bulk_update(to_update, fields)
+    if existing:
+        model.objects.filter(pk__in=list(existing)).delete()
+    return total
+
+
+def save_order_lines(order, services=None, parts=None):
+    """
+    Заменяет строки заказа переданными наборами и пересчитывает суммы заказа.
+    services/parts — списки словарей (name, quantity, price, article, id для
+    существующих строк); None оставляет строки этого вида без изменений,
+    пустой список удаляет их все. При ошибках бросает LineItemsError.
+    """
+    from . import counters, stats
+    from .cache import invalidate_dashboard
+
+    lines_by_kind = {kind: lines for kind, lines in (('services', services), ('parts', parts)) if lines is not None}
+    cleaned = _validate(lines_by_kind)
+
+    with transaction.atomic():
+        previous = Order.objects.select_for_update().filter(pk=order.pk).values(
+            'client_id', 'total_amount', 'status', 'created_at', 'discount'
+        ).get()
+
+        totals = {}
+        for kind, (model, _) in LINE_KINDS.items():
+            if kind in cleaned:
+                totals[kind] = _sync_lines(order, kind, cleaned[kind])
+            else:
+                totals[kind] = model.objects.filter(order=order).aggregate(
+                    total=Coalesce(Sum('total'), Value(0), output_field=DecimalField(max_digits=10, decimal_places=2))
+                )['total']
+
+        # Статус и клиент могли смениться после загрузки order: дельты считаем по заблокированной строке
+        order.client_id = previous['client_id']
+        order.status = previous['status']
+        order.created_at = previous['created_at']
+        order.labor_cost = totals['services']
+        order.parts_cost = totals['parts']
+        order.discount = previous['discount']
+        order.total_amount = order.labor_cost + order.parts_cost - order.discount
+        order.updated_at = timezone.now()
+        Order.objects.filter(pk=order.pk).update(
+            labor_cost=order.labor_cost,
+            parts_cost=order.parts_cost,
+            total_amount=order.total_amount,
+            updated_at=order.updated_at,
+        )
+
+        counters.order_saved(order, previous)
+        stats.order_saved(order, previous)
+        invalidate_dashboard(order.client.created_by_id)
+    return order
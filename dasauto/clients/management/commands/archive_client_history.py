@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from clients.history import ARCHIVE_BATCH_SIZE, archive_history
+
+
+def months_ago(moment, months):
+    """Тот же день months месяцев назад (последний день месяца, если такого дня нет)"""
+    month_index = moment.year * 12 + moment.month - 1 - months
+    year, month = divmod(month_index, 12)
+    month += 1
+    first_of_next = moment.replace(year=year + month // 12, month=month % 12 + 1, day=1)
+    last_day = (first_of_next - timedelta(days=1)).day
+    return moment.replace(year=year, month=month, day=min(moment.day, last_day))
+
+
+class Command(BaseCommand):
+    help = 'Переносит записи истории клиентов старше N месяцев в архивную таблицу'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=12, help='Возраст записей в месяцах (по умолчанию 12)')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+                            help='Количество записей в одной транзакции')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать число записей для переноса')
+
+    def handle(self, *args, **options):
+        if options['months'] < 1:
+            raise CommandError('--months должен быть не меньше 1')
+        cutoff = months_ago(timezone.now(), options['months'])
+        moved = archive_history(cutoff, batch_size=options['batch_size'], dry_run=options['dry_run'])
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'Записей старше {cutoff:%d.%m.%Y} для переноса: {moved}'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Перенесено в архив записей старше {cutoff:%d.%m.%Y}: {moved}'))
@@ -0,0 +1,146 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from clients.benchmark import (
+    compare_connections, compare_handlers, compare_rendering, compare_sessions, delete_dataset, generate_dataset,
+    run_benchmark,
+)
+
+
+class Command(BaseCommand):
+    help = 'Генерирует синтетические данные и замеряет число запросов и время ответа представлений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2)
+        parser.add_argument('--clients', type=int, default=200, help='Клиентов на пользователя')
+        parser.add_argument('--cars', type=int, default=1, help='Автомобилей на клиента')
+        parser.add_argument('--orders', type=int, default=2, help='Заказов на автомобиль')
+        parser.add_argument('--services', type=int, default=2, help='Услуг в заказе')
+        parser.add_argument('--parts', type=int, default=2, help='Запчастей в заказе')
+        parser.add_argument('--repeat', type=int, default=20, help='Повторов каждого запроса')
+        parser.add_argument(
+            '--compare-handlers', action='store_true',
+            help='Сравнить WSGI и ASGI на асинхронных представлениях (данные временно фиксируются в БД)',
+        )
+        parser.add_argument(
+            '--compare-connections', action='store_true',
+            help='Сравнить соединение на запрос, постоянные соединения и пул (данные временно фиксируются в БД)',
+        )
+        parser.add_argument(
+            '--connect-latency-ms', type=float, default=0,
+            help='Искусственная задержка установки соединения (имитация удаленного MySQL)',
+        )
+        parser.add_argument(
+            '--compare-rendering', action='store_true',
+            help='Замерить рендеринг списка клиентов без кэша шаблонов, с cached loader и с кэшем фрагментов',
+        )
+        parser.add_argument(
+            '--compare-sessions', action='store_true',
+            help='Сравнить число запросов при сессиях в БД, в кэше и в подписанной cookie',
+        )
+        parser.add_argument('--rows', type=int, default=1000, help='Строк на странице при замере рендеринга')
+        parser.add_argument('--pool-size', type=int, help='Размер пула при сравнении (по умолчанию --concurrency)')
+        parser.add_argument('--concurrency', type=int, default=10, help='Параллельных клиентов при сравнении')
+        parser.add_argument('--requests', type=int, default=200, help='Всего запросов на представление при сравнении')
+
+    def handle(self, *args, **options):
+        if options['compare_handlers']:
+            return self.compare_handlers(options)
+        if options['compare_connections']:
+            return self.compare_connections(options)
+        if options['compare_rendering']:
+            return self.compare_rendering(options)
+        if options['compare_sessions']:
+            return self.compare_sessions(options)
+
+        # Данные создаются в транзакции и откатываются после замера
+        with transaction.atomic():
+            self.stdout.write('Генерация данных...')
+            dataset = generate_dataset(
+                users=options['users'], clients=options['clients'], cars=options['cars'],
+                orders=options['orders'], services=options['services'], parts=options['parts'],
+            )
+            results = run_benchmark(dataset, repeat=options['repeat'])
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"{'Представление':<28}{'Код':>5}{'Запросов':>10}{'p50, мс':>10}{'p95, мс':>10}")
+        for result in results:
+            self.stdout.write(
+                f'{result.name:<28}{result.status_code:>5}{result.queries:>10}'
+                f'{result.p50_ms:>10.1f}{result.p95_ms:>10.1f}'
+            )
+
+    def compare_handlers(self, options):
+        self.stdout.write('Генерация данных...')
+        dataset = generate_dataset(
+            users=options['users'], clients=options['clients'], cars=options['cars'],
+            orders=options['orders'], services=options['services'], parts=options['parts'], prefix='bench_load',
+        )
+        try:
+            results = compare_handlers(dataset, options['concurrency'], options['requests'])
+        finally:
+            delete_dataset(dataset)
+
+        self.stdout.write(f"{'Представление':<20}{'Обработчик':>11}{'Запросов':>10}{'RPS':>10}{'p50, мс':>10}{'p95, мс':>10}")
+        for result in results:
+            self.stdout.write(
+                f'{result.name:<20}{result.handler:>11}{result.requests:>10}{result.rps:>10.1f}'
+                f'{result.p50_ms:>10.1f}{result.p95_ms:>10.1f}'
+            )
+
+    def compare_connections(self, options):
+        self.stdout.write('Генерация данных...')
+        dataset = generate_dataset(
+            users=options['users'], clients=options['clients'], cars=options['cars'],
+            orders=options['orders'], services=options['services'], parts=options['parts'], prefix='bench_conn',
+        )
+        try:
+            results, stats = compare_connections(
+                dataset, options['concurrency'], options['requests'],
+                connect_latency=options['connect_latency_ms'] / 1000, pool_size=options['pool_size'],
+            )
+        finally:
+            delete_dataset(dataset)
+
+        self.stdout.write(f"{'Представление':<20}{'Режим':>12}{'Запросов':>10}{'RPS':>10}{'p50, мс':>10}{'p95, мс':>10}")
+        for result in results:
+            self.stdout.write(
+                f'{result.name:<20}{result.handler:>12}{result.requests:>10}{result.rps:>10.1f}'
+                f'{result.p50_ms:>10.1f}{result.p95_ms:>10.1f}'
+            )
+        if stats:
+            self.stdout.write(
+                f"Пул: выдач {stats['checkouts']}, соединений {stats['connects']}, "
+                f"переподключений {stats['reconnects']}, ожиданий {stats['waits']} "
+                f"({stats['wait_seconds'] * 1000:.1f} мс), таймаутов {stats['timeouts']}"
+            )
+
+    def compare_rendering(self, options):
+        with transaction.atomic():
+            self.stdout.write('Генерация данных...')
+            dataset = generate_dataset(
+                users=1, clients=max(options['clients'], options['rows']), cars=options['cars'],
+                orders=options['orders'], services=0, parts=0,
+            )
+            results = compare_rendering(dataset, rows=options['rows'], repeat=options['repeat'])
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"{'Режим':<16}{'Строк':>8}{'p50, мс':>10}{'p95, мс':>10}")
+        for result in results:
+            self.stdout.write(f'{result.mode:<16}{result.rows:>8}{result.p50_ms:>10.1f}{result.p95_ms:>10.1f}')
+
+    def compare_sessions(self, options):
+        with transaction.atomic():
+            self.stdout.write('Генерация данных...')
+            dataset = generate_dataset(
+                users=options['users'], clients=options['clients'], cars=options['cars'],
+                orders=options['orders'], services=options['services'], parts=options['parts'],
+            )
+            results = compare_sessions(dataset, repeat=options['repeat'])
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"{'Представление':<20}{'Сессии':>16}{'Запросов':>10}{'p50, мс':>10}{'p95, мс':>10}")
+        for mode, result in results:
+            self.stdout.write(
+                f'{result.name:<20}{mode:>16}{result.queries:>10}{result.p50_ms:>10.1f}{result.p95_ms:>10.1f}'
+            )
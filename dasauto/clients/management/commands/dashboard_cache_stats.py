@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from clients.cache import dashboard_cache_stats, reset_dashboard_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Показывает счетчики попаданий и промахов кэша дашборда'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Обнулить счетчики после вывода')
+
+    def handle(self, *args, **options):
+        stats = dashboard_cache_stats()
+        self.stdout.write(
+            f"Попаданий: {stats['hits']}, промахов: {stats['misses']}, "
+            f"доля попаданий: {stats['hit_ratio']:.1%}"
+        )
+        if options['reset']:
+            reset_dashboard_cache_stats()
+            self.stdout.write(self.style.SUCCESS('Счетчики обнулены'))
@@ -0,0 +1,46 @@
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from clients.exports import EXPORTS, export_rows, iter_csv, write_xlsx
+from dasauto.db.routing import replica_reads
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Выгружает клиентов, автомобили, заказы или строки заказов пользователя в CSV/XLSX'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(EXPORTS))
+        parser.add_argument('--user', required=True, help='Имя пользователя, чьи данные выгружаются')
+        parser.add_argument('--output', '-o', help='Файл для записи (.csv или .xlsx); по умолчанию stdout в CSV')
+
+    def handle(self, *args, **options):
+        # Выгрузка только читает: при настроенных репликах основная БД не нагружается
+        with replica_reads():
+            return self.export(options)
+
+    def export(self, options):
+        try:
+            owner = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"Пользователь {options['user']} не найден")
+
+        rows = export_rows(options['dataset'], owner)
+        output = options['output']
+
+        if output and output.lower().endswith('.xlsx'):
+            try:
+                write_xlsx(rows, output)
+            except ImportError as exc:
+                raise CommandError(str(exc))
+        elif output:
+            with open(output, 'w', encoding='utf-8', newline='') as file:
+                file.writelines(iter_csv(rows))
+        else:
+            sys.stdout.writelines(iter_csv(rows))
+            return
+
+        self.stderr.write(self.style.SUCCESS(f'Выгрузка записана в {output}'))
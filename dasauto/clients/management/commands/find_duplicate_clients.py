@@ -0,0 +1,58 @@
+import csv
+
+from django.core.management.base import BaseCommand
+
+from clients.dedupe import DEFAULT_MIN_SCORE, MAX_BLOCK_SIZE, find_merge_candidates, group_candidates, merge_clients
+from clients.models import Client
+
+
+class Command(BaseCommand):
+    help = 'Ищет вероятные дубликаты клиентов по блокирующим ключам и при необходимости объединяет их'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='Искать только среди клиентов пользователя с этим id')
+        parser.add_argument('--min-score', type=float, default=DEFAULT_MIN_SCORE, help='Минимальная оценка сходства')
+        parser.add_argument('--max-block-size', type=int, default=MAX_BLOCK_SIZE,
+                            help='Блоки крупнее этого размера пропускаются')
+        parser.add_argument('--output', '-o', help='Записать кандидатов в CSV-файл')
+        parser.add_argument('--merge', action='store_true',
+                            help='Объединить найденные группы (основной — самый ранний клиент)')
+
+    def handle(self, *args, **options):
+        clients = Client.objects.all()
+        if options['user']:
+            clients = clients.filter(created_by_id=options['user'])
+
+        candidates, skipped_blocks = find_merge_candidates(
+            clients, min_score=options['min_score'], max_block_size=options['max_block_size']
+        )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as file:
+                writer = csv.writer(file, delimiter=';')
+                writer.writerow(['Клиент', 'Дубликат', 'Оценка', 'Совпадения'])
+                for candidate in candidates:
+                    writer.writerow([
+                        candidate.client_id, candidate.duplicate_id, candidate.score, ', '.join(candidate.reasons)
+                    ])
+        else:
+            for candidate in candidates:
+                self.stdout.write(
+                    f'#{candidate.client_id} ~ #{candidate.duplicate_id}: {candidate.score:.2f} '
+                    f'({", ".join(candidate.reasons)})'
+                )
+
+        message = f'Кандидатов в дубликаты: {len(candidates)}, пропущено больших блоков: {skipped_blocks}'
+        if options['merge']:
+            groups = group_candidates(candidates)
+            targets = Client.objects.in_bulk(list(groups))
+            merged = 0
+            for target_id, duplicate_ids in groups.items():
+                try:
+                    merge_clients(targets[target_id], [Client(pk=pk) for pk in duplicate_ids])
+                except ValueError as exc:
+                    self.stderr.write(f'Клиент #{target_id}: {exc}')
+                    continue
+                merged += len(duplicate_ids)
+            message += f', объединено клиентов: {merged}'
+        self.stdout.write(self.style.SUCCESS(message))
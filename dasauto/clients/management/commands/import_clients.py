@@ -0,0 +1,45 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from clients.importers import ClientImporter, DEFAULT_BATCH_SIZE
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Импортирует клиентов и их автомобили из CSV или XLSX'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к файлу .csv или .xlsx')
+        parser.add_argument('--user', required=True, help='Имя пользователя, которому принадлежат клиенты')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--dry-run', action='store_true', help='Только проверить файл, ничего не записывать')
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"Пользователь {options['user']} не найден")
+
+        def progress(report):
+            self.stdout.write(
+                f'Строк: {report.rows}, клиентов: {report.created_clients}, '
+                f'автомобилей: {report.created_cars}, ошибок: {report.error_count}'
+            )
+
+        importer = ClientImporter(owner, options['batch_size'], options['dry_run'], progress)
+        try:
+            report = importer.run(options['path'])
+        except (OSError, ImportError, ValueError) as exc:
+            raise CommandError(str(exc))
+
+        for row_number, message in report.errors:
+            self.stderr.write(f'Строка {row_number}: {message}')
+        if report.error_count > len(report.errors):
+            self.stderr.write(f'... и еще {report.error_count - len(report.errors)} ошибок')
+
+        prefix = 'Проверка завершена' if options['dry_run'] else 'Импорт завершен'
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}: клиентов {report.created_clients}, автомобилей {report.created_cars}, '
+            f'пропущено {report.skipped}, ошибок {report.error_count}'
+        ))
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from clients.models import Client
+
+
+class Command(BaseCommand):
+    help = (
+        'Заполняет нормализованные телефоны клиентов (E.164 и ключ поиска по окончанию номера) '
+        'и выводит клиентов с одинаковым номером'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать изменения и дубликаты')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Количество клиентов в пачке')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # Номер остается за клиентом, у которого он уже записан, иначе — за более ранним клиентом
+        owners = dict(Client.objects.exclude(phone_e164=None).values_list('phone_e164', 'pk'))
+        clients = Client.objects.order_by('pk').only('pk', 'phone', 'additional_phone', *Client.PHONE_KEY_FIELDS)
+
+        last_pk = 0
+        checked = 0
+        changed_total = 0
+        duplicates = []
+        while True:
+            batch = list(clients.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            checked += len(batch)
+
+            changed = []
+            for client in batch:
+                before = [getattr(client, name) for name in Client.PHONE_KEY_FIELDS]
+                client.normalize_phones()
+                if client.phone_e164:
+                    owner_pk = owners.setdefault(client.phone_e164, client.pk)
+                    if owner_pk != client.pk:
+                        duplicates.append((client.pk, owner_pk, client.phone_e164))
+                        client.phone_e164 = None
+                if [getattr(client, name) for name in Client.PHONE_KEY_FIELDS] != before:
+                    changed.append(client)
+            changed_total += len(changed)
+
+            if changed and not options['dry_run']:
+                with transaction.atomic():
+                    Client.objects.bulk_update(changed, Client.PHONE_KEY_FIELDS, batch_size=batch_size)
+
+        for client_pk, owner_pk, e164 in duplicates:
+            self.stdout.write(f'Клиент #{client_pk} дублирует клиента #{owner_pk} по телефону {e164}')
+
+        action = 'нужно обновить' if options['dry_run'] else 'обновлено'
+        self.stdout.write(self.style.SUCCESS(
+            f'Проверено клиентов: {checked}, {action}: {changed_total}, дубликатов по телефону: {len(duplicates)}'
+        ))
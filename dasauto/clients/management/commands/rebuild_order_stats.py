@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+from clients.models import DailyOrderStat, Order
+
+
+class Command(BaseCommand):
+    help = 'Заполняет дневную статистику заказов по истории заказов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='Пересчитать только для пользователя с этим id')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Размер пачки для вставки')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.filter(client__created_by__isnull=False)
+        stats = DailyOrderStat.objects.all()
+        if options['user']:
+            orders = orders.filter(client__created_by_id=options['user'])
+            stats = stats.filter(user_id=options['user'])
+
+        rows = (
+            orders.annotate(day=TruncDate('created_at'))
+            .values('client__created_by', 'day', 'status')
+            .annotate(count=Count('id'), revenue=Sum('total_amount'))
+            .order_by()
+        )
+
+        with transaction.atomic():
+            stats.delete()
+            batch = []
+            total = 0
+            for row in rows.iterator(chunk_size=options['batch_size']):
+                batch.append(DailyOrderStat(
+                    user_id=row['client__created_by'],
+                    day=row['day'],
+                    status=row['status'],
+                    orders_count=row['count'],
+                    revenue=row['revenue'] or 0,
+                ))
+                if len(batch) >= options['batch_size']:
+                    DailyOrderStat.objects.bulk_create(batch)
+                    total += len(batch)
+                    batch = []
+            DailyOrderStat.objects.bulk_create(batch)
+            total += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Статистика пересчитана: {total} строк'))
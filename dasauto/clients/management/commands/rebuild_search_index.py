@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from clients.models import Client
+from clients.search import reindex_clients
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает поисковый индекс клиентов пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Количество клиентов в пачке')
+        parser.add_argument('--user', type=int, help='Перестроить только клиентов пользователя с этим id')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        clients = Client.objects.order_by('pk').prefetch_related('cars')
+        if options['user']:
+            clients = clients.filter(created_by_id=options['user'])
+
+        last_pk = 0
+        total_clients = 0
+        total_tokens = 0
+        while True:
+            batch = list(clients.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            total_tokens += reindex_clients(batch)
+            total_clients += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write(f'Обработано клиентов: {total_clients}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Индекс перестроен: {total_clients} клиентов, {total_tokens} токенов'
+        ))
@@ -0,0 +1,73 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from clients.cache import bump_dashboard_version
+from clients.counters import refresh_client_counters
+from clients.line_items import line_total_subquery
+from clients.models import Order, Service, Part
+from clients.stats import refresh_daily_stats
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчитывает стоимость работ, запчастей и общую сумму заказов по строкам заказа '
+        '(заказы без строк не трогаются)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать число расходящихся заказов')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Количество заказов в одном UPDATE')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        labor_cost = line_total_subquery(Service)
+        parts_cost = line_total_subquery(Part)
+        orders = Order.objects.filter(
+            Q(Exists(Service.objects.filter(order=OuterRef('pk')))) | Q(Exists(Part.objects.filter(order=OuterRef('pk'))))
+        ).order_by('pk')
+
+        drifted = orders.alias(actual_labor=labor_cost, actual_parts=parts_cost).filter(
+            ~Q(labor_cost=F('actual_labor')) | ~Q(parts_cost=F('actual_parts'))
+            | ~Q(total_amount=F('actual_labor') + F('actual_parts') - F('discount'))
+        )
+        drifted_count = drifted.count()
+        if options['dry_run'] or not drifted_count:
+            self.stdout.write(self.style.SUCCESS(f'Заказов с расходящимися суммами: {drifted_count}'))
+            return
+
+        # Одно UPDATE ... SET x = (SELECT SUM ...) на диапазон первичных ключей
+        last_pk = 0
+        updated = 0
+        owners = set()
+        while True:
+            bounds = list(orders.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+            if not bounds:
+                break
+            batch = Q(pk__gt=last_pk, pk__lte=bounds[-1])
+            with transaction.atomic():
+                # Суммы меняются только у расходящихся заказов: их клиентов и дни и пересчитываем
+                affected = list(drifted.filter(batch).values_list('client_id', 'client__created_by_id', 'created_at'))
+                updated += orders.filter(batch).update(
+                    labor_cost=labor_cost,
+                    parts_cost=parts_cost,
+                    total_amount=labor_cost + parts_cost - F('discount'),
+                )
+                # UPDATE не вызывает save(): денормализованные данные пересчитываются здесь же
+                refresh_client_counters({client_id for client_id, _, _ in affected})
+                days = defaultdict(set)
+                for _, owner_id, created_at in affected:
+                    if owner_id is not None:
+                        days[owner_id].add(timezone.localdate(created_at))
+                for owner_id, owner_days in days.items():
+                    refresh_daily_stats(owner_id, owner_days)
+            owners.update(days)
+            last_pk = bounds[-1]
+
+        for owner_id in owners:
+            bump_dashboard_version(owner_id)
+
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано заказов: {updated}, исправлено расхождений: {drifted_count}'))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from clients.counters import actual_counters, find_drift
+from clients.models import Client
+
+
+class Command(BaseCommand):
+    help = 'Сверяет счетчики заказов клиентов с таблицей заказов и исправляет расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Исправить найденные расхождения')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Количество клиентов в пачке')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        clients = actual_counters(Client.objects.order_by('pk'))
+
+        last_pk = 0
+        checked = 0
+        drifted_total = 0
+        while True:
+            batch = list(clients.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            checked += len(batch)
+
+            drifted = find_drift(batch)
+            drifted_total += len(drifted)
+            for client in drifted:
+                self.stdout.write(
+                    f'Клиент #{client.pk}: заказов {client.orders_count} -> {client.actual_orders_count}, '
+                    f'сумма {client.total_spent} -> {client.actual_total_spent}, '
+                    f'последний заказ {client.last_order_at} -> {client.actual_last_order_at}'
+                )
+                client.orders_count = client.actual_orders_count
+                client.total_spent = client.actual_total_spent
+                client.last_order_at = client.actual_last_order_at
+
+            if drifted and options['fix']:
+                with transaction.atomic():
+                    Client.objects.bulk_update(drifted, Client.COUNTER_FIELDS, batch_size=batch_size)
+
+        if drifted_total and options['fix']:
+            message = f'Проверено клиентов: {checked}, исправлено: {drifted_total}'
+        else:
+            message = f'Проверено клиентов: {checked}, расхождений: {drifted_total}'
+        self.stdout.write(self.style.SUCCESS(message))
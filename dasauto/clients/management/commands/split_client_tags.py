@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from clients.models import Client
+from clients.tags import sync_client_tags
+
+
+class Command(BaseCommand):
+    help = 'Раскладывает строки тегов клиентов в справочник Tag и связи ClientTag пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Количество клиентов в пачке')
+        parser.add_argument('--user', type=int, help='Обработать только клиентов пользователя с этим id')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        clients = Client.objects.order_by('pk').only('pk', 'tags', 'created_by_id')
+        if options['user']:
+            clients = clients.filter(created_by_id=options['user'])
+
+        last_pk = 0
+        total_clients = 0
+        while True:
+            batch = list(clients.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            sync_client_tags(batch, batch_size=batch_size)
+            total_clients += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write(f'Обработано клиентов: {total_clients}')
+
+        self.stdout.write(self.style.SUCCESS(f'Теги разложены: {total_clients} клиентов'))
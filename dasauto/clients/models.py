@@ -1,5 +1,8 @@
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 
 User = get_user_model()
 from django.core.validators import MinValueValidator, MaxValueValidator
@@ -33,6 +36,14 @@ class Client(models.Model):
     phone = models.CharField('Телефон', max_length=20, unique=True, db_index=True)
     email = models.EmailField('Email', blank=True)
     additional_phone = models.CharField('Доп. телефон', max_length=20, blank=True)
+    # Нормализованные телефоны (заполняются в save): E.164 для точного поиска и дедупликации,
+    # цифры в обратном порядке — для поиска входящего звонка по последним цифрам номера
+    phone_e164 = models.CharField('Телефон (E.164)', max_length=16, unique=True, null=True, blank=True, editable=False)
+    additional_phone_e164 = models.CharField(
+        'Доп. телефон (E.164)', max_length=16, null=True, blank=True, editable=False, db_index=True
+    )
+    phone_suffix_key = models.CharField(max_length=20, blank=True, editable=False)
+    additional_phone_suffix_key = models.CharField(max_length=20, blank=True, editable=False)
 
     # Для юрлиц
     company_name = models.CharField('Название компании', max_length=200, blank=True)
@@ -56,6 +67,11 @@ class Client(models.Model):
     source = models.CharField('Источник', max_length=100, blank=True)
     tags = models.CharField('Теги', max_length=200, blank=True, help_text='Через запятую')
 
+    # Денормализованная статистика заказов (обновляется из Order.save/delete)
+    orders_count = models.PositiveIntegerField('Кол-во заказов', default=0)
+    total_spent = models.DecimalField('Всего потрачено', max_digits=12, decimal_places=2, default=0)
+    last_order_at = models.DateTimeField('Последний заказ', null=True, blank=True)
+
     # Системные поля
     created_at = models.DateTimeField('Дата создания', auto_now_add=True)
     updated_at = models.DateTimeField('Дата обновления', auto_now=True)
@@ -69,22 +85,103 @@ class Client(models.Model):
             models.Index(fields=['phone']),
             models.Index(fields=['email']),
             models.Index(fields=['created_at']),
+            # Клиенты пользователя в порядке разрешенных сортировок списка и топа на дашборде.
+            # is_active в индекс не входит: фильтр по boolean-колонке не используется как ключ индекса
+            models.Index(fields=['created_by', 'created_at'], name='client_owner_created'),
+            models.Index(fields=['created_by', 'last_name'], name='client_owner_last_name'),
+            models.Index(fields=['created_by', 'total_spent'], name='client_owner_spent'),
+            models.Index(fields=['created_by', 'orders_count'], name='client_owner_orders'),
+            # Поиск по окончанию номера: префикс по перевернутым цифрам
+            models.Index(fields=['created_by', 'phone_suffix_key'], name='client_owner_phone_sfx'),
+            models.Index(fields=['created_by', 'additional_phone_suffix_key'], name='client_owner_add_phone_sfx'),
+            # Список источников для фильтра админки строится по индексу, без прохода по таблице
+            models.Index(fields=['source'], name='client_source'),
         ]
 
     def __str__(self):
         return f"{self.last_name} {self.first_name} {self.patronymic}".strip()
 
+    # Поля, которые ведет Order.save/delete; обычное сохранение клиента их не перезаписывает
+    COUNTER_FIELDS = ('orders_count', 'total_spent', 'last_order_at')
+    PHONE_KEY_FIELDS = ('phone_e164', 'additional_phone_e164', 'phone_suffix_key', 'additional_phone_suffix_key')
+
+    def normalize_phones(self):
+        """Заполняет нормализованные поля телефонов (для bulk_create вызывается вручную)"""
+        from .normalization import phone_e164, phone_suffix_key
+
+        self.phone_e164 = phone_e164(self.phone)
+        self.additional_phone_e164 = phone_e164(self.additional_phone)
+        self.phone_suffix_key = phone_suffix_key(self.phone)
+        self.additional_phone_suffix_key = phone_suffix_key(self.additional_phone)
+
+    def _phone_duplicates(self):
+        """Другие клиенты, за которыми уже закреплен этот номер в E.164"""
+        from .normalization import phone_e164
+
+        e164 = phone_e164(self.phone)
+        if not e164:
+            return Client.objects.none()
+        return Client.objects.filter(phone_e164=e164).exclude(pk=self.pk)
+
+    def validate_unique(self, exclude=None):
+        errors = {}
+        try:
+            super().validate_unique(exclude)
+        except ValidationError as e:
+            errors = e.update_error_dict(errors)
+
+        # Один и тот же номер в разной записи (8 999..., +7 (999)...) — тоже дубликат.
+        # Известный дубликат (normalize_phones оставил ему пустой ключ) можно править, не меняя номер
+        if 'phone' not in errors and 'phone' not in (exclude or ()) and self._phone_duplicates().exists():
+            known_duplicate = self.pk and Client.objects.filter(
+                pk=self.pk, phone=self.phone, phone_e164=None
+            ).exists()
+            if not known_duplicate:
+                errors['phone'] = ['Клиент с таким номером телефона уже существует']
+
+        if errors:
+            raise ValidationError(errors)
+
+    def save(self, *args, **kwargs):
+        self.normalize_phones()
+        # Номер остается за клиентом, у которого он уже записан: дубликату ключ не достается,
+        # как и при заполнении normalize_phones (такие клиенты объединяются через find_duplicate_clients)
+        if self.phone_e164 and self._phone_duplicates().exists():
+            self.phone_e164 = None
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'phone', 'additional_phone'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, *self.PHONE_KEY_FIELDS}
+
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+        # Обновляем поисковый индекс клиента
+        from .search import reindex_client
+        reindex_client(self)
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'tags' in update_fields:
+            from .tags import sync_client_tags
+            sync_client_tags([self])
+
+        from .cache import invalidate_client_sources, invalidate_dashboard
+        invalidate_dashboard(self.created_by_id)
+        invalidate_client_sources([self.source])
+
     @property
     def full_name(self):
         return f"{self.last_name} {self.first_name} {self.patronymic}".strip()
 
-    @property
-    def total_spent(self):
-        """Общая сумма потраченная клиентом"""
-        total = self.orders.aggregate(total=models.Sum('total_amount'))['total']
-        return total or 0
 
-    # Удаляем property orders_count - будем использовать аннотацию в запросах
+@receiver(post_delete, sender=Client)
+def client_deleted(sender, instance, **kwargs):
+    """Сбрасывает счетчики тегов владельца (в том числе при массовом удалении в админке)"""
+    from .tags import invalidate_tag_counts
+    invalidate_tag_counts(instance.created_by_id)
 
 
 class Car(models.Model):
@@ -136,6 +233,28 @@ class Car(models.Model):
     def __str__(self):
         return f"{self.brand} {self.model} ({self.license_plate or 'без номера'})"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        # Госномер и VIN входят в поисковый индекс клиента
+        from .search import reindex_client
+        reindex_client(self.client)
+
+        # Автомобиль показывается в предстоящих записях дашборда
+        from .cache import invalidate_dashboard
+        invalidate_dashboard(self.client.created_by_id)
+
+    def delete(self, *args, **kwargs):
+        client = self.client
+        result = super().delete(*args, **kwargs)
+
+        from .search import reindex_client
+        reindex_client(client)
+
+        from .cache import invalidate_dashboard
+        invalidate_dashboard(client.created_by_id)
+        return result
+
 
 class Order(models.Model):
     """Модель заказа/ремонта"""
@@ -189,12 +308,19 @@ class Order(models.Model):
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы'
         ordering = ['-created_at']
+        indexes = [
+            # Заказы клиента на его странице, по дате
+            models.Index(fields=['client', 'created_at'], name='order_client_created'),
+            # Заказы клиента по статусу и предстоящие записи
+            models.Index(fields=['client', 'status', 'appointment_date'], name='order_client_status_appt'),
+            models.Index(fields=['appointment_date'], name='order_appointment_date'),
+        ]
 
     def save(self, *args, **kwargs):
-        # Генерация номера заказа
+        # Генерация номера заказа из счетчика в БД (до транзакции заказа, чтобы не держать блокировку счетчика)
         if not self.order_number:
-            from datetime import datetime
-            self.order_number = f"WO-{datetime.now().strftime('%Y%m%d')}-{self.id or 'XXX'}"
+            from .sequences import next_order_number
+            self.order_number = next_order_number()
 
         # Расчет общей суммы
         self.total_amount = self.labor_cost + self.parts_cost - self.discount
@@ -204,12 +330,59 @@ class Order(models.Model):
             from datetime import timedelta
             self.warranty_until = self.completed_at.date() + timedelta(days=self.warranty_period)
 
-        super().save(*args, **kwargs)
+        from . import counters, stats
+        from .cache import invalidate_dashboard
+
+        # Счетчики клиента и дневная статистика обновляются в той же транзакции, что и заказ
+        with transaction.atomic():
+            previous = None
+            if self.pk:
+                previous = Order.objects.select_for_update().filter(pk=self.pk).values(
+                    'client_id', 'total_amount', 'status', 'created_at'
+                ).first()
+            super().save(*args, **kwargs)
+            counters.order_saved(self, previous)
+            stats.order_saved(self, previous)
+
+            invalidate_dashboard(self.client.created_by_id)
+            if previous and previous['client_id'] != self.client_id:
+                invalidate_dashboard(
+                    Client.objects.filter(pk=previous['client_id']).values_list('created_by_id', flat=True).first()
+                )
+
+            # Живая доска получает только смену статуса
+            if previous is None or previous['status'] != self.status:
+                from .events import order_event_data, publish_order_event
+                owner_id = self.client.created_by_id
+                data = order_event_data(self, 'created' if previous is None else 'status')
+                # robust: сбой публикации (например, INSERT в OrderEvent) только логируется —
+                # заказ уже сохранен, и ответ не должен стать ошибкой 500
+                transaction.on_commit(lambda: publish_order_event(owner_id, data), robust=True)
 
     def __str__(self):
         return f"Заказ №{self.order_number} - {self.client}"
 
 
+@receiver(post_delete, sender=Order)
+def order_deleted(sender, instance, **kwargs):
+    """
+    Снимает удаленный заказ со счетчиков клиента и статистики. Сигнал, а не
+    Order.delete(): так учитываются и QuerySet.delete() (массовое удаление в
+    админке) — Django отправляет post_delete для каждого заказа в той же
+    транзакции, что и DELETE.
+    """
+    from . import counters, stats
+    from .cache import invalidate_dashboard
+    from .events import order_event_data, publish_order_event
+
+    owner_id = instance.client.created_by_id
+    data = order_event_data(instance, 'deleted')
+    counters.order_deleted(instance)
+    stats.order_deleted(instance)
+    invalidate_dashboard(owner_id)
+    transaction.on_commit(lambda: publish_order_event(owner_id, data), robust=True)
+
+
 class Service(models.Model):
     """Модель услуги/работы"""
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='services')
@@ -249,4 +422,133 @@ class ClientHistory(models.Model):
     class Meta:
         verbose_name = 'История'
         verbose_name_plural = 'История клиентов'
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            # История на странице клиента: курсор по (created_at, id)
+            models.Index(fields=['client', 'created_at', 'id'], name='history_client_created'),
+            # Отбор старых записей для архивации
+            models.Index(fields=['created_at'], name='history_created'),
+        ]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        from .cache import invalidate_dashboard
+        invalidate_dashboard(self.client.created_by_id)
+
+
+class ClientHistoryArchive(models.Model):
+    """Архив старых записей истории (переносятся командой archive_client_history)"""
+    history_id = models.BigIntegerField('id в рабочей таблице', unique=True)
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='archived_history')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='+')
+    action = models.CharField('Действие', max_length=200)
+    description = models.TextField('Описание')
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Архивная запись истории'
+        verbose_name_plural = 'Архив истории клиентов'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['client', 'created_at', 'id'], name='history_archive_client'),
+        ]
+
+
+class OrderNumberSequence(models.Model):
+    """Счетчик номеров заказов по префиксу (обычно по дню)"""
+    prefix = models.CharField('Префикс', max_length=30, unique=True)
+    last_value = models.PositiveBigIntegerField('Последнее значение', default=0)
+
+    class Meta:
+        verbose_name = 'Счетчик номеров заказов'
+        verbose_name_plural = 'Счетчики номеров заказов'
+
+    def __str__(self):
+        return f"{self.prefix}: {self.last_value}"
+
+
+class OrderEvent(models.Model):
+    """Событие доски заказов (шина DatabaseBroker, общая для всех процессов)"""
+    channel = models.CharField('Канал', max_length=64)
+    data = models.JSONField('Данные')
+    created_at = models.DateTimeField('Дата создания', auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = 'Событие доски заказов'
+        verbose_name_plural = 'События доски заказов'
+        indexes = [
+            # Подписчики читают новые события канала по возрастанию id
+            models.Index(fields=['channel', 'id'], name='order_event_channel'),
+        ]
+
+    def __str__(self):
+        return f"{self.channel} #{self.pk}"
+
+
+class DailyOrderStat(models.Model):
+    """Дневная статистика заказов пользователя по статусам"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_order_stats')
+    day = models.DateField('День')
+    status = models.CharField('Статус', max_length=20, choices=Order.STATUS_CHOICES)
+    orders_count = models.IntegerField('Кол-во заказов', default=0)
+    revenue = models.DecimalField('Сумма', max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name = 'Статистика заказов за день'
+        verbose_name_plural = 'Статистика заказов по дням'
+        unique_together = ['user', 'day', 'status']
+        ordering = ['-day']
+
+    def __str__(self):
+        return f"{self.day} {self.get_status_display()}: {self.orders_count}"
+
+
+class ClientSearchToken(models.Model):
+    """Поисковый токен клиента (нормализованный индекс для быстрого поиска)"""
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='search_tokens')
+    # Денормализованный владелец клиента, чтобы поиск не делал JOIN с Client
+    owner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='+')
+    token = models.CharField('Токен', max_length=64)
+
+    class Meta:
+        verbose_name = 'Поисковый токен'
+        verbose_name_plural = 'Поисковые токены'
+        indexes = [
+            models.Index(fields=['owner', 'token']),
+            # Поиск по всем клиентам (дубликаты телефонов при импорте)
+            models.Index(fields=['token']),
+        ]
+
+    def __str__(self):
+        return self.token
+
+
+class Tag(models.Model):
+    """Тег клиента (название в нижнем регистре)"""
+    name = models.CharField('Название', max_length=50, unique=True)
+
+    class Meta:
+        verbose_name = 'Тег'
+        verbose_name_plural = 'Теги'
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class ClientTag(models.Model):
+    """Связь клиента с тегом; заполняется из Client.tags при сохранении клиента"""
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='client_tags')
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name='client_tags')
+
+    class Meta:
+        verbose_name = 'Тег клиента'
+        verbose_name_plural = 'Теги клиентов'
+        # Клиенты с тегом — поиск по первой колонке уникального индекса (tag, client)
+        unique_together = ['tag', 'client']
+
+    def __str__(self):
+        return f"{self.client_id}: {self.tag_id}"
@@ -0,0 +1,75 @@
+import re
+
+_NON_DIGITS = re.compile(r'\D+')
+_NON_ALNUM = re.compile(r'[^0-9a-zа-я@._-]+')
+_WORD_SPLIT = re.compile(r'[\s,;]+')
+
+
+def fold_text(value):
+    """Приводит строку к нижнему регистру и заменяет ё на е"""
+    if not value:
+        return ''
+    return str(value).lower().replace('ё', 'е').strip()
+
+
+def digits_only(value):
+    """Оставляет в строке только цифры"""
+    if not value:
+        return ''
+    return _NON_DIGITS.sub('', str(value))
+
+
+def split_words(value):
+    """Разбивает строку на нормализованные слова"""
+    words = []
+    for word in _WORD_SPLIT.split(fold_text(value)):
+        word = _NON_ALNUM.sub('', word)
+        if word:
+            words.append(word)
+    return words
+
+
+# Кириллические буквы госномеров, совпадающие по написанию с латинскими
+_PLATE_LOOKALIKES = str.maketrans('авекмнорстух', 'abekmhopctyx')
+
+
+def normalize_code(value):
+    """Нормализует госномер/VIN: нижний регистр, латиница, без пробелов и дефисов"""
+    return ''.join(ch for ch in fold_text(value).translate(_PLATE_LOOKALIKES) if ch.isalnum())
+
+
+def normalize_phone(value):
+    """
+    Приводит телефон к цифрам в формате 7XXXXXXXXXX для российских номеров
+    (8XXXXXXXXXX и 10-значные национальные номера, мобильные и городские),
+    остальные номера — просто цифры
+    """
+    digits = digits_only(value)
+    if len(digits) == 11 and digits[0] == '8':
+        return '7' + digits[1:]
+    if len(digits) == 10:
+        return '7' + digits
+    return digits
+
+
+# E.164: код страны и номер, не больше 15 цифр
+E164_MIN_DIGITS = 8
+E164_MAX_DIGITS = 15
+
+
+def phone_e164(value):
+    """Телефон в формате E.164 (+79991234567) или None, если это не полный номер"""
+    digits = normalize_phone(value)
+    if E164_MIN_DIGITS <= len(digits) <= E164_MAX_DIGITS:
+        return '+' + digits
+    return None
+
+
+def phone_suffix_key(value):
+    """Цифры телефона в обратном порядке: поиск по окончанию номера становится поиском по префиксу"""
+    return digits_only(value)[::-1]
+
+
+def normalize_vin(value):
+    """VIN в верхнем регистре без пробелов и дефисов"""
+    return ''.join(ch for ch in str(value or '').upper() if ch.isalnum())
@@ -0,0 +1,167 @@
+"""
+Курсорная (keyset) пагинация.
+
+Вместо COUNT(*) и OFFSET страница выбирается условием по значениям ключа
+сортировки последней строки предыдущей страницы, поэтому любая страница
+стоит столько же, сколько первая. Курсор — подписанный непрозрачный токен.
+
+Для changelist админки, где нужны номера страниц, есть
+EstimatedCountPaginator: число строк без фильтров берется из статистики
+таблицы СУБД вместо COUNT(*).
+"""
+from django.core import signing
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+
+CURSOR_SALT = 'clients.pagination.cursor'
+# Таблицы меньше этого размера считаются точно: COUNT(*) по ним дешев
+ESTIMATED_COUNT_THRESHOLD = 10000
+
+
+class KeysetPage:
+    """Страница курсорной пагинации"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Пагинатор по ключу сортировки.
+    ordering — кортеж полей как для order_by(); последним должно идти
+    уникальное поле (обычно id), чтобы порядок был однозначным.
+    """
+
+    def __init__(self, queryset, ordering, per_page=20):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.per_page = per_page
+        opts = queryset.model._meta
+        self.fields = [
+            (name.lstrip('-'), name.startswith('-'), opts.get_field(name.lstrip('-')))
+            for name in self.ordering
+        ]
+
+    def _encode(self, obj, direction):
+        values = [field.value_to_string(obj) for _, _, field in self.fields]
+        return signing.dumps({'o': list(self.ordering), 'd': direction, 'v': values}, salt=CURSOR_SALT)
+
+    def _decode(self, cursor):
+        try:
+            payload = signing.loads(cursor, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            return None, None
+        if payload.get('o') != list(self.ordering) or len(payload.get('v', [])) != len(self.fields):
+            return None, None
+        values = [field.to_python(value) for (_, _, field), value in zip(self.fields, payload['v'])]
+        return payload.get('d'), values
+
+    def _seek_q(self, values, forward):
+        """Условие «строки после (или до) указанного ключа» в порядке сортировки"""
+        condition = Q()
+        equal = Q()
+        for (name, descending, _), value in zip(self.fields, values):
+            lookup = 'lt' if descending == forward else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def _reversed_ordering(self):
+        return [name[1:] if name.startswith('-') else f'-{name}' for name in self.ordering]
+
+    def get_page(self, cursor=None):
+        direction, values = self._decode(cursor) if cursor else (None, None)
+
+        if direction == 'prev':
+            queryset = self.queryset.filter(self._seek_q(values, forward=False))
+            rows = list(queryset.order_by(*self._reversed_ordering())[:self.per_page + 1])
+            has_more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            rows.reverse()
+            has_previous, has_next = has_more, True
+        else:
+            queryset = self.queryset
+            if direction == 'next':
+                queryset = queryset.filter(self._seek_q(values, forward=True))
+            rows = list(queryset.order_by(*self.ordering)[:self.per_page + 1])
+            has_next = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_previous = direction == 'next'
+
+        next_cursor = self._encode(rows[-1], 'next') if rows and has_next else None
+        previous_cursor = self._encode(rows[0], 'prev') if rows and has_previous else None
+        return KeysetPage(rows, next_cursor, previous_cursor)
+
+
+def estimated_row_count(model, using='default'):
+    """
+    Примерное число строк таблицы модели по статистике СУБД или None,
+    если статистики нет (для SQLite — до ANALYZE).
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    if connection.vendor == 'mysql':
+        sql = 'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'
+    elif connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)'
+    elif connection.vendor == 'sqlite':
+        if 'sqlite_stat1' not in connection.introspection.table_names(include_views=False):
+            return None
+        # Первое число в stat — количество строк таблицы
+        sql = "SELECT CAST(substr(stat, 1, instr(stat || ' ', ' ') - 1) AS INTEGER) FROM sqlite_stat1 WHERE tbl = %s"
+    else:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    # PostgreSQL возвращает -1 для таблицы, по которой еще не собиралась статистика
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator для больших таблиц. Без фильтров count берется из статистики
+    таблицы; выборки с фильтрами и таблицы меньше estimate_threshold строк
+    считаются точно. Оценка приблизительная: последняя страница может
+    оказаться пустой или неполной.
+    """
+    estimate_threshold = ESTIMATED_COUNT_THRESHOLD
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and not queryset.query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= self.estimate_threshold:
+                return estimate
+        return super().count
@@ -0,0 +1,330 @@
+"""
+Профилирование запросов.
+
+ProfilingMiddleware включается настройкой PROFILING_ENABLED (по умолчанию
+выключен). Для каждого запроса замеряются полное время, число и суммарное
+время SQL-запросов и время рендеринга шаблонов; замеры агрегируются по имени
+URL (client_list, dashboard, ...) и отдаются по /metrics в текстовом формате
+Prometheus: гистограмма времени ответа и счетчики SQL и шаблонов.
+
+Часть запросов (PROFILING_SAMPLE_RATE) и все медленные (дольше
+PROFILING_SLOW_REQUEST_MS) пишутся JSON-строкой в логгер dasauto.profiling —
+в settings это ротируемый файл. В запись попадают самые медленные SQL; у
+запросов из выборки к ним приложено место вызова в коде проекта (стек
+собирается только для запросов, претендующих на место в топе).
+
+Каждый процесс копит метрики в памяти и раз в PROFILING_FLUSH_INTERVAL
+секунд сохраняет снимок в общий кэш вместе со статистикой пулов соединений
+(dasauto.db.pool); /metrics складывает снимки всех воркеров, поэтому ответ
+не зависит от того, какой воркер его отдал.
+"""
+import functools
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+import traceback
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+
+from dasauto.db.pool import STAT_FIELDS as POOL_COUNTERS, pool_stats
+
+logger = logging.getLogger('dasauto.profiling')
+
+# Границы корзин гистограммы времени ответа, секунды
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_PREVIEW_LENGTH = 1000
+STACK_DEPTH = 6
+
+SNAPSHOT_KEY_PREFIX = 'profiling:metrics:'
+WORKERS_KEY = 'profiling:workers'
+SNAPSHOT_TIMEOUT = 60 * 60 * 24
+
+# Текущие значения пула соединений; остальные поля статистики пула — счетчики
+POOL_GAUGES = ('size', 'in_use', 'idle')
+
+_current = ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    """Замеры одного запроса"""
+
+    def __init__(self, sampled, slow_queries_limit):
+        self.started = time.perf_counter()
+        self.sampled = sampled
+        self.slow_queries_limit = slow_queries_limit
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        # Куча (время, номер запроса, sql, стек): в вершине — самый быстрый из топа
+        self.slow_queries = []
+
+    def add_query(self, sql, duration):
+        self.sql_count += 1
+        self.sql_seconds += duration
+        if len(self.slow_queries) >= self.slow_queries_limit and duration <= self.slow_queries[0][0]:
+            return
+        entry = (duration, self.sql_count, sql[:SQL_PREVIEW_LENGTH], _call_site() if self.sampled else [])
+        if len(self.slow_queries) < self.slow_queries_limit:
+            heapq.heappush(self.slow_queries, entry)
+        else:
+            heapq.heapreplace(self.slow_queries, entry)
+
+
+def _call_site():
+    """Последние кадры стека из кода проекта (без библиотек и этого модуля)"""
+    root = str(settings.BASE_DIR)
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if frame.filename.startswith(root) and 'site-packages' not in frame.filename
+        and frame.filename != __file__
+    ]
+    return [f'{os.path.relpath(frame.filename, root)}:{frame.lineno} {frame.name}' for frame in frames[-STACK_DEPTH:]]
+
+
+def _sql_wrapper(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.add_query(sql, time.perf_counter() - start)
+
+
+def _install_sql_wrapper():
+    """Подключения потокозависимы, поэтому обертка ставится в потоке, где идут запросы к БД"""
+    for connection in connections.all():
+        if _sql_wrapper not in connection.execute_wrappers:
+            connection.execute_wrappers.append(_sql_wrapper)
+
+
+def _patch_template_render():
+    """Замер render() шаблонов Django; вложенные шаблоны входят во внешний замер"""
+    from django.template.backends.django import Template
+
+    if getattr(Template.render, 'profiled', False):
+        return
+    original = Template.render
+
+    @functools.wraps(original)
+    def render(self, context=None, request=None):
+        profile = _current.get()
+        if profile is None or profile.template_depth:
+            return original(self, context, request)
+        profile.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return original(self, context, request)
+        finally:
+            profile.template_depth -= 1
+            profile.template_seconds += time.perf_counter() - start
+
+    render.profiled = True
+    Template.render = render
+
+
+def _empty_stats():
+    return {
+        'buckets': [0] * len(LATENCY_BUCKETS),
+        'count': 0,
+        'seconds': 0.0,
+        'sql_count': 0,
+        'sql_seconds': 0.0,
+        'template_seconds': 0.0,
+    }
+
+
+class MetricsRegistry:
+    """Агрегаты замеров по представлениям внутри процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+        self._flushed_at = 0.0
+
+    def observe(self, view, wall, profile):
+        with self._lock:
+            stats = self._views.setdefault(view, _empty_stats())
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if wall <= bound:
+                    stats['buckets'][index] += 1
+            stats['count'] += 1
+            stats['seconds'] += wall
+            stats['sql_count'] += profile.sql_count
+            stats['sql_seconds'] += profile.sql_seconds
+            stats['template_seconds'] += profile.template_seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {view: dict(stats, buckets=list(stats['buckets'])) for view, stats in self._views.items()}
+
+    def flush(self, interval=0):
+        """Сохраняет снимок процесса в кэш, если с прошлого раза прошло interval секунд"""
+        now = time.monotonic()
+        if interval and now - self._flushed_at < interval:
+            return
+        self._flushed_at = now
+        pid = os.getpid()
+        snapshot = {'views': self.snapshot(), 'pools': pool_stats()}
+        cache.set(f'{SNAPSHOT_KEY_PREFIX}{pid}', snapshot, SNAPSHOT_TIMEOUT)
+        workers = cache.get(WORKERS_KEY) or []
+        if pid not in workers:
+            # Заодно забываем воркеры, чьи снимки уже истекли
+            alive = cache.get_many([f'{SNAPSHOT_KEY_PREFIX}{worker}' for worker in workers])
+            workers = [worker for worker in workers if f'{SNAPSHOT_KEY_PREFIX}{worker}' in alive]
+            cache.set(WORKERS_KEY, workers + [pid], None)
+
+
+metrics_registry = MetricsRegistry()
+
+
+def collect_metrics():
+    """Сумма снимков всех воркеров: {'views': {представление: агрегаты}, 'pools': {псевдоним БД: статистика}}"""
+    metrics_registry.flush()
+    workers = cache.get(WORKERS_KEY) or []
+    snapshots = cache.get_many([f'{SNAPSHOT_KEY_PREFIX}{worker}' for worker in workers])
+    views = {}
+    pools = {}
+    for snapshot in snapshots.values():
+        for view, stats in snapshot['views'].items():
+            total = views.setdefault(view, _empty_stats())
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], stats['buckets'])]
+            for name in ('count', 'seconds', 'sql_count', 'sql_seconds', 'template_seconds'):
+                total[name] += stats[name]
+        for alias, stats in snapshot['pools'].items():
+            total = pools.setdefault(alias, dict.fromkeys(POOL_COUNTERS + POOL_GAUGES, 0))
+            for name in total:
+                total[name] += stats[name]
+    return {'views': views, 'pools': pools}
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return value if isinstance(value, int) else f'{value:.6f}'
+
+
+def render_metrics(collected):
+    """Метрики в текстовом формате Prometheus"""
+    metrics = collected['views']
+    lines = [
+        '# HELP dasauto_request_duration_seconds Время ответа по представлениям',
+        '# TYPE dasauto_request_duration_seconds histogram',
+    ]
+    views = sorted(metrics)
+    for view in views:
+        stats = metrics[view]
+        label = _label(view)
+        for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+            lines.append(f'dasauto_request_duration_seconds_bucket{{view="{label}",le="{bound}"}} {count}')
+        lines.append(f'dasauto_request_duration_seconds_bucket{{view="{label}",le="+Inf"}} {stats["count"]}')
+        lines.append(f'dasauto_request_duration_seconds_sum{{view="{label}"}} {stats["seconds"]:.6f}')
+        lines.append(f'dasauto_request_duration_seconds_count{{view="{label}"}} {stats["count"]}')
+
+    for name, key, help_text in (
+        ('dasauto_sql_queries_total', 'sql_count', 'Число SQL-запросов'),
+        ('dasauto_sql_duration_seconds_total', 'sql_seconds', 'Суммарное время SQL-запросов'),
+        ('dasauto_template_render_seconds_total', 'template_seconds', 'Суммарное время рендеринга шаблонов'),
+    ):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for view in views:
+            lines.append(f'{name}{{view="{_label(view)}"}} {_number(metrics[view][key])}')
+
+    pools = collected['pools']
+    for key in POOL_COUNTERS + POOL_GAUGES:
+        if key in POOL_GAUGES:
+            name, kind = f'dasauto_db_pool_{key}', 'gauge'
+        elif key == 'wait_seconds':
+            name, kind = 'dasauto_db_pool_wait_seconds_total', 'counter'
+        else:
+            name, kind = f'dasauto_db_pool_{key}_total', 'counter'
+        lines.append(f'# TYPE {name} {kind}')
+        for alias in sorted(pools):
+            lines.append(f'{name}{{alias="{_label(alias)}"}} {_number(pools[alias][key])}')
+    return '\n'.join(lines) + '\n'
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unresolved'
+
+
+class ProfilingMiddleware:
+    """Замеры запроса: время, SQL, шаблоны; должен стоять первым в MIDDLEWARE"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.01)
+        self.slow_request = getattr(settings, 'PROFILING_SLOW_REQUEST_MS', 1000) / 1000
+        self.slow_queries_limit = getattr(settings, 'PROFILING_SLOW_QUERIES', 5)
+        self.flush_interval = getattr(settings, 'PROFILING_FLUSH_INTERVAL', 10)
+        _patch_template_render()
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        _install_sql_wrapper()
+        profile = RequestProfile(random.random() < self.sample_rate, self.slow_queries_limit)
+        token = _current.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._finish(request, response, profile)
+        return response
+
+    async def __acall__(self, request):
+        await sync_to_async(_install_sql_wrapper)()
+        profile = RequestProfile(random.random() < self.sample_rate, self.slow_queries_limit)
+        token = _current.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        await sync_to_async(self._finish)(request, response, profile)
+        return response
+
+    def _finish(self, request, response, profile):
+        wall = time.perf_counter() - profile.started
+        view = _view_name(request)
+        metrics_registry.observe(view, wall, profile)
+        metrics_registry.flush(self.flush_interval)
+
+        if profile.sampled or wall >= self.slow_request:
+            logger.info(json.dumps({
+                'time': timezone.now().isoformat(),
+                'view': view,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'sampled': profile.sampled,
+                'wall_ms': round(wall * 1000, 2),
+                'sql_count': profile.sql_count,
+                'sql_ms': round(profile.sql_seconds * 1000, 2),
+                'template_ms': round(profile.template_seconds * 1000, 2),
+                'slow_queries': [
+                    {'ms': round(duration * 1000, 2), 'sql': sql, 'stack': stack}
+                    for duration, _, sql, stack in sorted(profile.slow_queries, reverse=True)
+                ],
+            }, ensure_ascii=False))
@@ -0,0 +1,154 @@
+"""
+Поиск клиентов по нормализованному индексу.
+
+Для каждого клиента хранится набор токенов (ClientSearchToken): части ФИО и
+названия компании, email, цифры телефонов, ИНН, госномера и VIN автомобилей.
+Поиск идет по префиксу токена диапазонным запросом по индексу (owner, token),
+поэтому не требует полного прохода по таблице клиентов.
+
+Цифры ищутся как есть и, если начинаются с 8, еще и с 7 вместо 8 (номер
+телефона в записи 8XXX...), поэтому ИНН и номера заказов на 8 тоже находятся.
+Окончание телефона ищется по отдельному токену с перевернутыми цифрами;
+поиск по цифрам из середины номера индексом не поддерживается.
+"""
+from django.db import transaction
+from django.db.models import Q
+
+from .normalization import fold_text, digits_only, split_words, normalize_code, normalize_phone, phone_suffix_key
+
+TOKEN_MAX_LENGTH = 64
+# Верхняя граница для диапазонного поиска по префиксу
+PREFIX_UPPER_BOUND = '\uffff'
+# Токен окончания телефона: маркер (не встречается в термах запроса) и цифры в обратном порядке
+PHONE_SUFFIX_MARKER = '~'
+PHONE_SUFFIX_MIN_DIGITS = 4
+
+
+def _phone_tokens(phone):
+    digits = digits_only(phone)
+    if not digits:
+        return []
+    tokens = [digits, normalize_phone(digits)]
+    # Российский номер: храним также 10 цифр без кода страны
+    if len(digits) == 11 and digits[0] in '78':
+        tokens.append(digits[1:])
+    tokens.append(PHONE_SUFFIX_MARKER + phone_suffix_key(digits))
+    return tokens
+
+
+def build_tokens(client, cars=None):
+    """Собирает множество поисковых токенов клиента"""
+    tokens = set()
+
+    for value in (client.last_name, client.first_name, client.patronymic, client.company_name):
+        tokens.update(split_words(value))
+
+    email = fold_text(client.email)
+    if email:
+        tokens.add(email)
+        tokens.add(email.split('@', 1)[0])
+
+    for phone in (client.phone, client.additional_phone):
+        tokens.update(_phone_tokens(phone))
+
+    inn = digits_only(client.inn)
+    if inn:
+        tokens.add(inn)
+
+    if cars is None:
+        cars = client.cars.all() if client.pk else []
+    for car in cars:
+        for code in (car.license_plate, car.vin):
+            code = normalize_code(code)
+            if code:
+                tokens.add(code)
+
+    return {token[:TOKEN_MAX_LENGTH] for token in tokens if token}
+
+
+def _token_rows(client, cars=None):
+    from .models import ClientSearchToken
+
+    return [
+        ClientSearchToken(client_id=client.pk, owner_id=client.created_by_id, token=token)
+        for token in build_tokens(client, cars)
+    ]
+
+
+def reindex_client(client):
+    """Перестраивает поисковые токены одного клиента"""
+    from .models import ClientSearchToken
+
+    with transaction.atomic():
+        ClientSearchToken.objects.filter(client_id=client.pk).delete()
+        ClientSearchToken.objects.bulk_create(_token_rows(client))
+
+
+def reindex_clients(clients, batch_size=1000):
+    """Перестраивает токены для пачки клиентов (cars должны быть предзагружены)"""
+    from .models import ClientSearchToken
+
+    clients = list(clients)
+    rows = []
+    for client in clients:
+        rows.extend(_token_rows(client, client.cars.all()))
+
+    with transaction.atomic():
+        ClientSearchToken.objects.filter(client_id__in=[c.pk for c in clients]).delete()
+        ClientSearchToken.objects.bulk_create(rows, batch_size=batch_size)
+    return len(rows)
+
+
+def parse_query(query):
+    """Разбивает поисковую строку на термы для префиксного поиска"""
+    query = fold_text(query)
+    if not query:
+        return []
+
+    # Строка без букв — это телефон, ИНН или часть номера: ищем по цифрам целиком
+    if not any(ch.isalpha() for ch in query):
+        digits = digits_only(query)
+        if digits:
+            return [digits[:TOKEN_MAX_LENGTH]]
+
+    terms = []
+    for word in split_words(query):
+        if any(ch.isdigit() for ch in word) and '@' not in word:
+            word = normalize_code(word)
+        if word:
+            terms.append(word[:TOKEN_MAX_LENGTH])
+    return terms
+
+
+def token_prefix_q(term):
+    return Q(token__gte=term, token__lt=term + PREFIX_UPPER_BOUND)
+
+
+def term_q(term):
+    """Условие на токены для терма; цифры — также как телефон с 7 вместо 8 и как окончание телефона"""
+    q = token_prefix_q(term)
+    if term.isdigit():
+        if len(term) > 1 and term[0] == '8':
+            q |= token_prefix_q('7' + term[1:])
+        if len(term) >= PHONE_SUFFIX_MIN_DIGITS:
+            q |= token_prefix_q(PHONE_SUFFIX_MARKER + phone_suffix_key(term))
+    return q
+
+
+def search_clients(queryset, query, owner=None):
+    """
+    Фильтрует queryset клиентов по поисковой строке.
+    Каждый терм должен совпасть по префиксу хотя бы с одним токеном клиента.
+    """
+    from .models import ClientSearchToken
+
+    terms = parse_query(query)
+    if not terms:
+        return queryset
+
+    for term in terms:
+        tokens = ClientSearchToken.objects.filter(term_q(term))
+        if owner is not None:
+            tokens = tokens.filter(owner=owner)
+        queryset = queryset.filter(id__in=tokens.values('client_id'))
+    return queryset
@@ -0,0 +1,149 @@
+"""
+Номера заказов из счетчика в базе данных.
+
+Для каждого префикса (по умолчанию WO-ГГГГММДД) в таблице OrderNumberSequence
+хранится последнее выданное значение. Блок номеров выделяется одним атомарным
+UPDATE ... SET last_value = last_value + N, поэтому параллельные запросы не
+получают одинаковые номера и не требуют повторов.
+
+Процесс заранее забирает блок номеров (ORDER_NUMBER_BLOCK_SIZE) и выдает их
+из памяти: строка счетчика блокируется один раз на блок, а не на каждый заказ.
+
+Если заказ сохраняется внутри внешней транзакции (админка, save_order_lines),
+UPDATE счетчика в ней держал бы блокировку строки до конца всей транзакции, и
+параллельные заказы ждали бы друг друга. Поэтому внутри atomic() номера
+выделяются в отдельном соединении потока с автокоммитом: блокировка снимается
+сразу, а выделенный блок можно кэшировать — откат внешней транзакции его уже не
+вернет. У SQLite блокировка на запись общая для всей базы, отдельное соединение
+ждало бы внешнюю транзакцию, поэтому там номер выделяется в ней самой и не
+кэшируется.
+
+Номера из недоиспользованного блока и из откаченных транзакций пропадают
+(в нумерации возможны пропуски).
+"""
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction, connections, IntegrityError
+from django.db.utils import ConnectionDoesNotExist, load_backend
+from django.db.models import F
+from django.utils import timezone
+
+ORDER_NUMBER_WIDTH = 4
+
+
+def order_number_prefix(day=None):
+    day = day or timezone.localdate()
+    return f"WO-{day.strftime('%Y%m%d')}"
+
+
+def format_order_number(prefix, value):
+    return f'{prefix}-{value:0{ORDER_NUMBER_WIDTH}d}'
+
+
+def allocate_block(prefix, size=1, using=DEFAULT_DB_ALIAS):
+    """Выделяет size последовательных значений счетчика и возвращает (первое, последнее)"""
+    from .models import OrderNumberSequence
+
+    with transaction.atomic(using=using):
+        rows = OrderNumberSequence.objects.using(using).filter(prefix=prefix)
+        if not rows.update(last_value=F('last_value') + size):
+            try:
+                with transaction.atomic(using=using):
+                    OrderNumberSequence.objects.using(using).create(prefix=prefix, last_value=size)
+                return 1, size
+            except IntegrityError:
+                # Счетчик успел создать параллельный запрос
+                rows.update(last_value=F('last_value') + size)
+        last_value = rows.values_list('last_value', flat=True).get()
+    return last_value - size + 1, last_value
+
+
+def sequence_connection(using=DEFAULT_DB_ALIAS):
+    """
+    Псевдоним отдельного соединения потока с той же базой (в автокоммите).
+
+    Соединение не входит в connections.all(), поэтому Django не закрывает его в
+    конце запроса: CONN_MAX_AGE и проверка ошибок применяются после каждого
+    выделения (close_if_unusable_or_obsolete).
+    """
+    alias = f'{using}_order_numbers'
+    try:
+        connections[alias]
+    except ConnectionDoesNotExist:
+        settings_dict = connections[using].settings_dict
+        connections[alias] = load_backend(settings_dict['ENGINE']).DatabaseWrapper(settings_dict, alias)
+    return alias
+
+
+def allocate_block_autocommit(prefix, size=1, using=DEFAULT_DB_ALIAS):
+    """allocate_block в отдельном соединении: фиксируется сразу, даже внутри atomic()"""
+    alias = sequence_connection(using)
+    try:
+        return allocate_block(prefix, size, using=alias)
+    finally:
+        connections[alias].close_if_unusable_or_obsolete()
+
+
+class OrderNumberAllocator:
+    """Потокобезопасная выдача номеров из заранее выделенных блоков"""
+
+    def __init__(self, block_size=1, separate_connection=None, using=DEFAULT_DB_ALIAS):
+        self.block_size = max(block_size, 1)
+        # None — отдельное соединение везде, кроме SQLite
+        self.separate_connection = separate_connection
+        self.using = using
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def reset(self):
+        """Забывает выделенные блоки (оставшиеся в них номера пропадают)"""
+        with self._lock:
+            self._blocks = {}
+
+    def _use_separate_connection(self):
+        if not connections[self.using].in_atomic_block:
+            return False
+        if self.separate_connection is not None:
+            return self.separate_connection
+        return connections[self.using].vendor != 'sqlite'
+
+    def allocate(self, prefix, size):
+        """(первое, последнее) — блок счетчика, по возможности вне внешней транзакции"""
+        if self._use_separate_connection():
+            return allocate_block_autocommit(prefix, size, using=self.using)
+        return allocate_block(prefix, size, using=self.using)
+
+    def next_value(self, prefix):
+        if self.block_size == 1 or (connections[self.using].in_atomic_block and not self._use_separate_connection()):
+            # Без отдельного соединения блок, выделенный в транзакции, нельзя кэшировать:
+            # откат вернул бы номера в счетчик, и они были бы выданы повторно
+            return self.allocate(prefix, 1)[0]
+
+        with self._lock:
+            block = self._blocks.get(prefix)
+            if block is None or block[0] > block[1]:
+                # Блоки за прошлые дни больше не понадобятся
+                self._blocks = {}
+                block = self._blocks[prefix] = list(self.allocate(prefix, self.block_size))
+            value = block[0]
+            block[0] += 1
+            return value
+
+
+_allocator = OrderNumberAllocator(getattr(settings, 'ORDER_NUMBER_BLOCK_SIZE', 1))
+
+
+def next_order_number(prefix=None):
+    """Следующий номер заказа"""
+    prefix = prefix or order_number_prefix()
+    return format_order_number(prefix, _allocator.next_value(prefix))
+
+
+def allocate_order_numbers(count, prefix=None):
+    """Список из count номеров заказа одним обращением к счетчику (для массовой загрузки)"""
+    if count <= 0:
+        return []
+    prefix = prefix or order_number_prefix()
+    first, last = _allocator.allocate(prefix, count)
+    return [format_order_number(prefix, value) for value in range(first, last + 1)]
@@ -0,0 +1,143 @@
+"""
+Дневная статистика заказов (DailyOrderStat).
+
+Одна строка на (пользователь, день, статус) с количеством заказов и суммой.
+Пользователь — владелец клиента (Client.created_by), день — локальная дата
+создания заказа, статус — текущий статус заказа. Строки обновляются
+инкрементально из Order.save() и сигнала post_delete заказа; история
+заполняется командой rebuild_order_stats.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction, IntegrityError
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+ZERO = Decimal('0.00')
+ACTIVE_EXCLUDED_STATUSES = ('completed', 'cancelled')
+TREND_PERIODS = (30, 90, 365)
+
+
+def apply_stat_delta(user_id, day, status, count_delta=0, revenue_delta=ZERO):
+    """Прибавляет дельты к строке статистики, создавая ее при необходимости"""
+    from .models import DailyOrderStat
+
+    if user_id is None or (not count_delta and not revenue_delta):
+        return
+
+    rows = DailyOrderStat.objects.filter(user_id=user_id, day=day, status=status)
+    if rows.update(orders_count=F('orders_count') + count_delta, revenue=F('revenue') + revenue_delta):
+        return
+
+    try:
+        with transaction.atomic():
+            DailyOrderStat.objects.create(
+                user_id=user_id, day=day, status=status, orders_count=count_delta, revenue=revenue_delta
+            )
+    except IntegrityError:
+        # Строку успел создать параллельный запрос
+        rows.update(orders_count=F('orders_count') + count_delta, revenue=F('revenue') + revenue_delta)
+
+
+def _owner_id(client_id):
+    from .models import Client
+
+    return Client.objects.filter(pk=client_id).values_list('created_by_id', flat=True).first()
+
+
+def order_saved(order, previous=None):
+    """
+    Переносит заказ между строками статистики после сохранения.
+    previous — значения client_id, status, total_amount, created_at до сохранения.
+    """
+    owner_id = order.client.created_by_id
+    day = timezone.localdate(order.created_at)
+
+    if previous is None:
+        apply_stat_delta(owner_id, day, order.status, 1, order.total_amount)
+        return
+
+    previous_owner_id = owner_id if previous['client_id'] == order.client_id else _owner_id(previous['client_id'])
+    previous_day = timezone.localdate(previous['created_at'])
+
+    if (previous_owner_id, previous_day, previous['status']) == (owner_id, day, order.status):
+        apply_stat_delta(owner_id, day, order.status, revenue_delta=order.total_amount - previous['total_amount'])
+    else:
+        apply_stat_delta(previous_owner_id, previous_day, previous['status'], -1, -previous['total_amount'])
+        apply_stat_delta(owner_id, day, order.status, 1, order.total_amount)
+
+
+def order_deleted(order):
+    apply_stat_delta(
+        order.client.created_by_id, timezone.localdate(order.created_at), order.status, -1, -order.total_amount
+    )
+
+
+def refresh_daily_stats(user_id, days):
+    """Пересчитывает строки статистики пользователя за указанные дни по таблице заказов"""
+    from .models import DailyOrderStat, Order
+
+    rows = (
+        Order.objects.filter(client__created_by_id=user_id, created_at__date__in=days)
+        .annotate(day=TruncDate('created_at'))
+        .values('day', 'status')
+        .annotate(count=Count('id'), revenue=Sum('total_amount'))
+        .order_by()
+    )
+    DailyOrderStat.objects.filter(user_id=user_id, day__in=days).delete()
+    DailyOrderStat.objects.bulk_create(
+        DailyOrderStat(
+            user_id=user_id, day=row['day'], status=row['status'], orders_count=row['count'],
+            revenue=row['revenue'] or 0,
+        )
+        for row in rows
+    )
+
+
+def dashboard_counters(user, today=None):
+    """Заказы сегодня, заказы в работе и разбивка по статусам из таблицы статистики"""
+    from .models import DailyOrderStat, Order
+
+    today = today or timezone.localdate()
+    rows = DailyOrderStat.objects.filter(user=user)
+
+    by_status = {
+        item['status']: item['count'] or 0
+        for item in rows.values('status').annotate(count=Sum('orders_count'))
+    }
+    orders_today = rows.filter(day=today).aggregate(count=Sum('orders_count'))['count'] or 0
+
+    status_names = dict(Order.STATUS_CHOICES)
+    orders_by_status = [
+        {'status': status, 'status_display': status_names.get(status, status), 'count': count}
+        for status, count in by_status.items() if count
+    ]
+    orders_in_progress = sum(
+        count for status, count in by_status.items() if status not in ACTIVE_EXCLUDED_STATUSES
+    )
+    return orders_today, orders_in_progress, orders_by_status
+
+
+def order_trend(user, days, today=None):
+    """Количество заказов и выручка по дням за последние days дней (отмененные не учитываются)"""
+    from .models import DailyOrderStat
+
+    today = today or timezone.localdate()
+    start = today - timedelta(days=days - 1)
+    totals = {
+        item['day']: item
+        for item in DailyOrderStat.objects.filter(
+            user=user, day__gte=start, day__lte=today
+        ).exclude(status='cancelled').values('day').annotate(
+            count=Sum('orders_count'), amount=Sum('revenue')
+        )
+    }
+
+    trend = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        item = totals.get(day, {})
+        trend.append({'day': day, 'count': item.get('count') or 0, 'revenue': item.get('amount') or ZERO})
+    return trend
@@ -0,0 +1,128 @@
+"""
+Теги клиентов.
+
+Пользователь по-прежнему вводит теги строкой через запятую (Client.tags), а
+при сохранении клиента строка раскладывается в справочник Tag и связи
+ClientTag с уникальным индексом (tag, client). Фильтры «любой из» и «все»
+идут через этот индекс, а не через LIKE по строке. Количество клиентов по
+тегам для боковой панели кэшируется на пользователя и сбрасывается при
+изменении тегов его клиентов, удалении клиентов и их объединении.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
+TAG_MAX_LENGTH = 50
+TAG_COUNTS_TIMEOUT = 60 * 60
+TAG_MODES = ('any', 'all')
+
+
+def parse_tags(value):
+    """Теги из строки через запятую: нижний регистр, без повторов, в исходном порядке"""
+    from .normalization import fold_text
+
+    tags = []
+    for part in str(value or '').split(','):
+        name = ' '.join(fold_text(part).split())[:TAG_MAX_LENGTH]
+        if name and name not in tags:
+            tags.append(name)
+    return tags
+
+
+def _tag_ids(names):
+    """id тегов по названиям; недостающие теги создаются"""
+    from .models import Tag
+
+    names = set(names)
+    if not names:
+        return {}
+    ids = dict(Tag.objects.filter(name__in=names).values_list('name', 'id'))
+    missing = names - set(ids)
+    if missing:
+        Tag.objects.bulk_create([Tag(name=name) for name in missing], ignore_conflicts=True)
+        ids.update(Tag.objects.filter(name__in=missing).values_list('name', 'id'))
+    return ids
+
+
+def sync_client_tags(clients, batch_size=1000):
+    """Приводит связи ClientTag клиентов к их строкам tags (для пачки клиентов — три-четыре запроса)"""
+    from .models import ClientTag
+
+    clients = [client for client in clients if client.pk]
+    if not clients:
+        return
+    wanted = {client.pk: parse_tags(client.tags) for client in clients}
+
+    with transaction.atomic():
+        ids = _tag_ids(name for names in wanted.values() for name in names)
+        wanted = {client_id: {ids[name] for name in names} for client_id, names in wanted.items()}
+
+        existing = {}
+        existing_pks = {}
+        for pk, client_id, tag_id in ClientTag.objects.filter(client_id__in=wanted).values_list(
+                'pk', 'client_id', 'tag_id'):
+            existing.setdefault(client_id, set()).add(tag_id)
+            existing_pks[client_id, tag_id] = pk
+
+        to_create = []
+        stale = []
+        for client_id, tag_ids in wanted.items():
+            current = existing.get(client_id, set())
+            to_create.extend(ClientTag(client_id=client_id, tag_id=tag_id) for tag_id in tag_ids - current)
+            stale.extend(existing_pks[client_id, tag_id] for tag_id in current - tag_ids)
+
+        if stale:
+            ClientTag.objects.filter(pk__in=stale).delete()
+        if to_create:
+            ClientTag.objects.bulk_create(to_create, batch_size=batch_size, ignore_conflicts=True)
+
+    # Счетчики зависят и от тегов, и от активности клиентов
+    for owner_id in {client.created_by_id for client in clients}:
+        invalidate_tag_counts(owner_id)
+
+
+def filter_by_tags(queryset, names, mode='any'):
+    """
+    Клиенты с тегами names: mode='any' — хотя бы с одним, 'all' — со всеми.
+    Неизвестный тег в режиме 'all' дает пустой результат.
+    """
+    from .models import ClientTag, Tag
+
+    names = parse_tags(','.join(names))
+    if not names:
+        return queryset
+    tag_ids = list(Tag.objects.filter(name__in=names).values_list('id', flat=True))
+
+    if mode == 'all':
+        if len(tag_ids) < len(names):
+            return queryset.none()
+        for tag_id in tag_ids:
+            queryset = queryset.filter(pk__in=ClientTag.objects.filter(tag_id=tag_id).values('client_id'))
+        return queryset
+    return queryset.filter(pk__in=ClientTag.objects.filter(tag_id__in=tag_ids).values('client_id'))
+
+
+def _counts_key(user_id):
+    return f'tags:counts:{user_id}'
+
+
+def tag_counts(user_id):
+    """[(тег, число клиентов)] для клиентов пользователя, по убыванию числа; кэшируется"""
+    from .models import ClientTag
+
+    counts = cache.get(_counts_key(user_id))
+    if counts is None:
+        counts = list(
+            ClientTag.objects.filter(client__created_by_id=user_id, client__is_active=True)
+            .values_list('tag__name')
+            .annotate(count=Count('client_id'))
+            .order_by('-count', 'tag__name')
+        )
+        cache.set(_counts_key(user_id), counts, TAG_COUNTS_TIMEOUT)
+    return counts
+
+
+def invalidate_tag_counts(user_id):
+    if user_id is None:
+        return
+    transaction.on_commit(lambda: cache.delete(_counts_key(user_id)))
@@ -7,7 +7,7 @@ register = template.Library()
 def query_transform(context, **kwargs):
     """
     Creates a URL query string with updated parameters.
-    Usage: {% query_transform page=page_obj.next_page_number %}
+    Usage: {% query_transform cursor=page_obj.next_cursor %}
     """
     query = context['request'].GET.copy()
 
@@ -17,4 +17,4 @@ def query_transform(context, **kwargs):
         else:
             query.pop(key, None)
 
-    return query.urlencode()
\ No newline at end of file
+    return query.urlencode()
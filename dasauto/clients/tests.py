@@ -1,3 +1,1752 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.apps import apps
+from django.db import OperationalError, connection, connections, transaction
+from django.db.backends.utils import CursorWrapper
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from dasauto.cache import FileBasedCache
+from dasauto.database import database_settings
+from dasauto.db import routing
+from dasauto.db.pool import ConnectionPool, PoolTimeout
+
+from .benchmark import (
+    RENDER_MODES, compare_rendering, compare_sessions, generate_dataset, logged_in_client, measure, view_urls,
+)
+from .admin import SourceFilter
+from .cache import (
+    aget_dashboard_context, bump_dashboard_version, dashboard_cache_stats, dashboard_version, get_dashboard_context,
+)
+from .counters import actual_counters, find_drift
+from .dedupe import MergeCandidate, find_merge_candidates, group_candidates, merge_clients, phonetic_key
+from .exports import export_rows, iter_csv, xlsx_available
+from .events import DatabaseBroker, InMemoryBroker, order_channel, publish_order_event, set_broker
+from .forms import ClientForm
+from .importers import ClientImporter
+from .line_items import save_order_lines
+from . import profiling, sequences
+from .history import flush_history, record_history
+from .models import (
+    Client, Car, Order, ClientHistory, ClientHistoryArchive, ClientSearchToken, ClientTag, DailyOrderStat, OrderNumberSequence,
+    Service, Tag,
+)
+from .normalization import normalize_code, phone_e164
+from .pagination import EstimatedCountPaginator
+from .search import search_clients
+from .stats import TREND_PERIODS, dashboard_counters, order_trend
+from .sequences import OrderNumberAllocator, allocate_order_numbers, order_number_prefix
+from .tags import filter_by_tags, parse_tags, tag_counts
+
+User = get_user_model()
+
+# Служебные таблицы Django, поиск в которых идет по первичному ключу
+PLAN_IGNORED_TABLES = ('django_session', 'django_content_type', 'accounts_customuser')
+
+
+def explain_full_scans(queries):
+    """
+    Возвращает список (sql, описание) для запросов, план которых содержит
+    полный проход по таблице. Поддерживаются SQLite и MySQL.
+    """
+    scans = []
+    with connection.cursor() as cursor:
+        for sql, params in queries:
+            if not sql.lstrip().upper().startswith('SELECT'):
+                continue
+
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                problems = [
+                    row[-1] for row in cursor.fetchall()
+                    if row[-1].startswith('SCAN ') and not row[-1].startswith(('SCAN CONSTANT', 'SCAN SUBQUERY'))
+                    and not any(table in row[-1] for table in PLAN_IGNORED_TABLES)
+                ]
+            elif connection.vendor == 'mysql':
+                cursor.execute(f'EXPLAIN {sql}', params)
+                columns = [column[0] for column in cursor.description]
+                problems = [
+                    f"{row['table']}: type={row['type']}"
+                    for row in (dict(zip(columns, values)) for values in cursor.fetchall())
+                    if row['type'] in ('ALL', 'index') and row['table']
+                    and not row['table'].startswith('<') and row['table'] not in PLAN_IGNORED_TABLES
+                ]
+            else:
+                problems = []
+
+            if problems:
+                scans.append((sql, problems))
+    return scans
+
+
+class CapturedQueries:
+    """Собирает (sql, params) всех запросов через execute_wrapper"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many:
+            self.queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+
+class ClientSearchTests(TestCase):
+    """Поиск клиентов по токенам: ФИО, email, телефоны, ИНН, госномера и VIN"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.client_obj = Client.objects.create(
+            created_by=self.user, first_name='Пётр', last_name='Иванов', phone='8 (999) 123-45-67',
+            email='Ivanov@Mail.ru',
+        )
+        Car.objects.create(
+            client=self.client_obj, brand='Lada', model='Vesta', license_plate='А 123 ВС 77', vin='XTA21099012345678'
+        )
+        self.company = Client.objects.create(
+            created_by=self.user, client_type='legal', company_name='ООО Ромашка', first_name='Анна',
+            last_name='Смирнова', phone='+7 912 000-11-22', inn='8901234567',
+        )
+        # Тезка у другого пользователя в выдачу не попадает
+        other = User.objects.create_user('other', password='password')
+        Client.objects.create(created_by=other, first_name='Петр', last_name='Иванов', phone='89991234567')
+
+    def search(self, query):
+        return list(search_clients(Client.objects.order_by('pk'), query, owner=self.user))
+
+    def assert_search(self, cases):
+        for query, expected in cases:
+            with self.subTest(query=query):
+                self.assertEqual(self.search(query), expected)
+
+    def test_names_and_email(self):
+        self.assert_search([
+            ('иванов', [self.client_obj]), ('ИВАН', [self.client_obj]), ('петр', [self.client_obj]),
+            ('иванов пётр', [self.client_obj]), ('иванов ромашка', []), ('ромашк', [self.company]),
+            ('ivanov@mail', [self.client_obj]), ('ivanov', [self.client_obj]),
+        ])
+
+    def test_phone_and_inn(self):
+        self.assert_search([
+            # Цифры как есть: телефон в любой записи и ИНН на 8
+            ('+7 999 123', [self.client_obj]), ('(999) 123-45', [self.client_obj]), ('890123', [self.company]),
+            # Номер, набранный через 8, находит телефон, сохраненный с 7
+            ('8 912 000', [self.company]), ('89991234567', [self.client_obj]),
+            # Окончание телефона — по токену с перевернутыми цифрами, от 4 цифр
+            ('4567', [self.client_obj]), ('11-22', [self.company]), ('567', []),
+        ])
+
+    def test_phone_tokens(self):
+        tokens = set(self.client_obj.search_tokens.values_list('token', flat=True))
+        self.assertTrue({'89991234567', '79991234567', '9991234567', '~76543219998'} <= tokens)
+
+    def test_plates_and_vin(self):
+        # Кириллические буквы госномера совпадают с латинскими того же написания
+        self.assertEqual(normalize_code('А 123 ВС 77'), normalize_code('a123bc-77'))
+        self.assertEqual(normalize_code('А 123 ВС 77'), 'a123bc77')
+        self.assert_search([
+            ('а123вс', [self.client_obj]), ('A123BC77', [self.client_obj]), ('xta2109', [self.client_obj]),
+            ('в123ас', []),
+        ])
+
+    def test_rebuild_index(self):
+        ClientSearchToken.objects.all().delete()
+        self.assertEqual(self.search('иванов'), [])
+
+        out = io.StringIO()
+        call_command('rebuild_search_index', batch_size=1, user=self.user.pk, stdout=out)
+        self.assertIn('Индекс перестроен: 2 клиентов', out.getvalue())
+        self.assert_search([
+            ('иванов', [self.client_obj]), ('а123вс', [self.client_obj]), ('4567', [self.client_obj]),
+            ('890123', [self.company]),
+        ])
+        # Клиенты другого пользователя не перестраивались
+        self.assertFalse(ClientSearchToken.objects.exclude(owner=self.user).exists())
+
+
+class QueryPlanTests(TestCase):
+    """Запросы всех представлений клиентов должны идти по индексам"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', password='password') for i in range(3)]
+        for user in cls.users:
+            for i in range(30):
+                client = Client.objects.create(
+                    created_by=user, first_name='Иван', last_name=f'Петров{i}', phone=f'+7999{user.pk:03d}{i:04d}'
+                )
+                car = Car.objects.create(client=client, brand='Lada', model='Vesta', license_plate=f'А{i:03d}ВС77')
+                for j in range(3):
+                    Order.objects.create(
+                        client=client, car=car, description='ТО',
+                        order_number=f'T-{user.pk}-{i}-{j}', labor_cost=1000 * j,
+                        status='in_progress' if j else 'new',
+                    )
+        cls.user = cls.users[0]
+        cls.client_obj = Client.objects.filter(created_by=cls.user).first()
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def assertNoFullScans(self, url):
+        captured = CapturedQueries()
+        with connection.execute_wrapper(captured):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        scans = explain_full_scans(captured.queries)
+        self.assertFalse(scans, f'{url}: полный проход по таблице в запросах {scans}')
+
+    def test_client_list(self):
+        for sort in ['-created_at', 'created_at', 'last_name', '-total_spent', '-orders_count']:
+            with self.subTest(sort=sort):
+                self.assertNoFullScans(f"{reverse('client_list')}?sort={sort}")
+
+    def test_client_list_search(self):
+        self.assertNoFullScans(f"{reverse('client_list')}?q=петров1")
+        self.assertNoFullScans(f"{reverse('client_list')}?q=8999")
+        self.assertNoFullScans(f"{reverse('client_list')}?q=0001")
+
+    def test_client_found(self):
+        self.assertNoFullScans(f"{reverse('client_found')}?query=петров")
+
+    def test_client_detail(self):
+        self.assertNoFullScans(reverse('client_detail', args=[self.client_obj.pk]))
+
+    def test_dashboard(self):
+        for period in [30, 365]:
+            with self.subTest(period=period):
+                self.assertNoFullScans(f"{reverse('dashboard')}?period={period}")
+
+    def test_clients_api(self):
+        self.assertNoFullScans(f"{reverse('clients_api')}?sort=last_name")
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Число запросов каждого представления ограничено бюджетом и не зависит
+    от количества клиентов, автомобилей и заказов (ловит N+1).
+    """
+
+    BUDGETS = {
+        # 5 запросов списка + счетчики тегов для панели фильтра (один запрос на холодном кэше,
+        # см. TagTests.test_list_sidebar_query)
+        'client_list': 6,
+        'client_list_search': 4,
+        'client_detail': 7,
+        'dashboard': 7,
+        'client_found': 4,
+        'client_cars_api': 4,
+        'cars_api_batch': 4,
+        'clients_api': 3,
+        'profile': 2,
+        'settings': 2,
+        'admin_client_changelist': 12,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.small = generate_dataset(users=1, clients=3, cars=1, orders=1, prefix='small')
+        cls.large = generate_dataset(users=1, clients=25, cars=2, orders=3, prefix='large')
+
+    def measure_views(self, user):
+        # Замер на холодном кэше: дашборд и счетчики тегов считаются заново
+        cache.clear()
+        http_client = logged_in_client(user)
+        results = {result.name: result for result in (
+            measure(http_client, url, name, repeat=0) for name, url in view_urls(user)
+        )}
+
+        admin_user = User.objects.create_superuser(f'admin{user.pk}', f'admin{user.pk}@example.com', 'password')
+        admin_client = logged_in_client(admin_user)
+        results['admin_client_changelist'] = measure(
+            admin_client, reverse('admin:clients_client_changelist'), 'admin_client_changelist', repeat=0
+        )
+        return results
+
+    def test_query_budgets(self):
+        for name, result in self.measure_views(self.large.users[0]).items():
+            with self.subTest(view=name):
+                self.assertEqual(result.status_code, 200)
+                self.assertLessEqual(result.queries, self.BUDGETS[name])
+
+    def test_queries_do_not_grow_with_data(self):
+        small = self.measure_views(self.small.users[0])
+        large = self.measure_views(self.large.users[0])
+        for name in self.BUDGETS:
+            with self.subTest(view=name):
+                self.assertEqual(small[name].queries, large[name].queries)
+
+    def test_session_cache_saves_queries(self):
+        # Сессия и пользователь из кэша: на каждое представление на два запроса меньше
+        results = compare_sessions(self.small, repeat=0)
+        queries = {(mode, result.name): result.queries for mode, result in results}
+        for mode, name in queries:
+            with self.subTest(mode=mode, view=name):
+                self.assertEqual(queries[mode, name], queries['db', name] - (0 if mode == 'db' else 2))
+
+    def test_client_detail_history_pages(self):
+        user = self.large.users[0]
+        client = Client.objects.filter(created_by=user).first()
+        ClientHistory.objects.bulk_create([
+            ClientHistory(client=client, created_by=user, action=f'Звонок {i}', description='') for i in range(45)
+        ])
+        http_client = logged_in_client(user)
+        url = reverse('client_detail', args=[client.pk])
+
+        first = http_client.get(url).context['history']
+        with CaptureQueriesContext(connection) as captured:
+            second = http_client.get(url, {'history_cursor': first.next_cursor}).context['history']
+        self.assertLessEqual(len(captured), self.BUDGETS['client_detail'])
+        self.assertTrue(second.has_previous and second.has_next)
+        self.assertFalse({item.pk for item in first} & {item.pk for item in second})
+
+
+class OrderNumberTests(TransactionTestCase):
+    """Номера заказов выдаются из счетчика без повторов"""
+
+    def setUp(self):
+        user = User.objects.create_user('user', password='password')
+        self.client_obj = Client.objects.create(created_by=user, first_name='Иван', last_name='Петров', phone='1')
+        self.car = Car.objects.create(client=self.client_obj, brand='Lada', model='Vesta')
+        # Счетчик очищается между тестами, блоки процесса — тоже
+        sequences._allocator.reset()
+
+    def create_order(self):
+        return Order.objects.create(client=self.client_obj, car=self.car, description='ТО')
+
+    def test_orders_get_sequential_numbers(self):
+        prefix = order_number_prefix()
+        numbers = [self.create_order().order_number for _ in range(3)]
+        self.assertEqual(numbers, [f'{prefix}-0001', f'{prefix}-0002', f'{prefix}-0003'])
+
+    def test_bulk_allocation_continues_sequence(self):
+        prefix = order_number_prefix()
+        first = self.create_order().order_number
+        # Пакет начинается после блока, уже забранного процессом
+        last_value = OrderNumberSequence.objects.get(prefix=prefix).last_value
+        numbers = allocate_order_numbers(5)
+        self.assertEqual(numbers, [f'{prefix}-{value:04d}' for value in range(last_value + 1, last_value + 6)])
+        self.assertNotIn(self.create_order().order_number, numbers + [first])
+
+    def test_block_allocator(self):
+        allocator = OrderNumberAllocator(block_size=10)
+        values = [allocator.next_value('TEST') for _ in range(15)]
+        self.assertEqual(values, list(range(1, 16)))
+        # Второй процесс получает номера после всех выделенных блоков
+        self.assertEqual(OrderNumberAllocator(block_size=10).next_value('TEST'), 21)
+
+    def test_block_is_not_cached_inside_transaction(self):
+        allocator = OrderNumberAllocator(block_size=10)
+        with transaction.atomic():
+            self.assertEqual(allocator.next_value('TEST'), 1)
+            transaction.set_rollback(True)
+        self.assertEqual(allocator.next_value('TEST'), 1)
+
+    def test_separate_connection_inside_transaction(self):
+        allocator = OrderNumberAllocator(block_size=10, separate_connection=True)
+        with transaction.atomic():
+            self.assertEqual(allocator.next_value('TEST'), 1)
+            transaction.set_rollback(True)
+        # Блок зафиксирован отдельно от откаченной транзакции и остается в кэше
+        self.assertEqual(allocator.next_value('TEST'), 2)
+        self.assertEqual(OrderNumberSequence.objects.get(prefix='TEST').last_value, 10)
+
+    def test_concurrent_allocation_inside_transactions(self):
+        allocator = OrderNumberAllocator(block_size=1, separate_connection=True)
+        allocated = threading.Barrier(2, timeout=5)
+        values, errors = [], []
+
+        def worker():
+            try:
+                with transaction.atomic():
+                    values.append(allocator.next_value('TEST'))
+                    # Обе транзакции получили номер, пока другая еще открыта
+                    allocated.wait()
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connections[sequences.sequence_connection()].close()
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(values), [1, 2])
+
+
+class ClientImportTests(TestCase):
+    """Импорт клиентов из CSV пачками с отсевом дубликатов"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        Client.objects.create(created_by=self.user, first_name='Иван', last_name='Иванов', phone='+7 (999) 000-00-01')
+
+    def write_csv(self, lines):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines))
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_import(self):
+        path = self.write_csv([
+            'Фамилия;Имя;Телефон;ИНН;Марка;Модель;VIN',
+            'Петров;Петр;+7 999 000 00 02;;Lada;Vesta;XTA00000000000001',
+            'Сидоров;Сидор;8 999 000 00 03;;;;',
+            'Иванов;Иван;89990000001;;;;',
+            'Петров;Петр;79990000002;;;;',
+            'Без;;79990000004;;;;',
+            'Юрлицо;ООО;79990000005;123;;;',
+        ])
+        report = ClientImporter(self.user, batch_size=2).run(path)
+
+        self.assertEqual(report.rows, 6)
+        self.assertEqual(report.created_clients, 2)
+        self.assertEqual(report.created_cars, 1)
+        self.assertEqual(report.skipped, 2)
+        self.assertEqual(report.error_count, 4)
+        self.assertEqual(Client.objects.filter(created_by=self.user).count(), 3)
+        self.assertTrue(Car.objects.filter(vin='XTA00000000000001', client__last_name='Петров').exists())
+        self.assertEqual(search_clients(Client.objects.all(), 'сидоров', owner=self.user).count(), 1)
+
+    def test_admin_upload_size_limit(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        http_client = logged_in_client(admin_user)
+        url = reverse('admin:clients_client_import')
+        content = 'Фамилия;Имя;Телефон\nПетров;Петр;79990000002\n'.encode()
+
+        with override_settings(ADMIN_IMPORT_MAX_UPLOAD_SIZE=len(content) - 1):
+            response = http_client.post(url, {
+                'file': SimpleUploadedFile('clients.csv', content), 'owner': self.user.pk,
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'manage.py import_clients')
+        self.assertEqual(Client.objects.count(), 1)
+
+        with override_settings(ADMIN_IMPORT_MAX_UPLOAD_SIZE=len(content)):
+            response = http_client.post(url, {
+                'file': SimpleUploadedFile('clients.csv', content), 'owner': self.user.pk,
+            })
+        self.assertRedirects(response, reverse('admin:clients_client_changelist'), fetch_redirect_response=False)
+        self.assertEqual(Client.objects.count(), 2)
+
+    def test_invalid_cars_are_reported(self):
+        path = self.write_csv([
+            'Фамилия;Имя;Телефон;Марка;Модель;Год выпуска;VIN;Госномер',
+            'Петров;Петр;79990000002;Lada;Vesta;2020;xta-0000-0000-0000-01;А001ВС77',
+            'Сидоров;Сидор;79990000003;Lada;Vesta;;XTA000000000000012345;',
+            'Кузнецов;Кузьма;79990000004;Lada;Vesta;1800;;',
+            'Смирнов;Семен;79990000005;Lada;;;;',
+            'Попов;Павел;79990000006;Lada;Vesta;;;А001ВС777RUS',
+            'Васильев;Василий;79990000007;Lada;Vesta;два;;',
+        ])
+        report = ClientImporter(self.user).run(path)
+
+        self.assertEqual((report.created_clients, report.created_cars, report.error_count), (1, 1, 5))
+        self.assertEqual([row for row, _ in report.errors], [3, 4, 5, 6, 7])
+        self.assertTrue(all(message.startswith('Автомобиль: ') for _, message in report.errors))
+        self.assertIn('vin', report.errors[0][1])
+        self.assertIn('year', report.errors[1][1])
+        self.assertTrue(Car.objects.filter(vin='XTA00000000000001', year=2020).exists())
+
+    def test_dry_run_writes_nothing(self):
+        path = self.write_csv(['phone,last_name,first_name', '79990000010,Петров,Петр'])
+        report = ClientImporter(self.user, dry_run=True).run(path)
+        self.assertEqual(report.created_clients, 1)
+        self.assertEqual(Client.objects.count(), 1)
+
+
+class ClientExportTests(TestCase):
+    """Потоковая выгрузка в CSV"""
+
+    def setUp(self):
+        self.dataset = generate_dataset(users=2, clients=5, cars=1, orders=2)
+
+    def test_export_streams_own_rows(self):
+        http_client = logged_in_client(self.dataset.users[0])
+        for dataset, rows in [('clients', 5), ('cars', 5), ('orders', 10), ('order_lines', 40)]:
+            with CaptureQueriesContext(connection) as captured:
+                response = http_client.get(reverse('clients_export', args=[dataset]))
+                content = b''.join(response.streaming_content).decode('utf-8-sig')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(content.splitlines()), rows + 1, dataset)
+            # Число запросов не зависит от числа строк
+            self.assertLessEqual(len(captured), 4, dataset)
+
+    def test_batches_by_pk(self):
+        owner = self.dataset.users[0]
+        expected = list(Client.objects.filter(created_by=owner).order_by('pk').values_list('pk', flat=True))
+        with mock.patch('clients.exports.EXPORT_CHUNK_SIZE', 2):
+            rows = list(export_rows('clients', owner))
+        self.assertEqual([row[0] for row in rows[1:]], expected)
+
+    def test_formula_cells_are_escaped(self):
+        rows = [['=HYPERLINK("http://evil")', '+7 999', '-1+1', '@SUM(A1)', '- заметка', 'Иванов', -5, '-5']]
+        content = ''.join(iter_csv(rows)).lstrip('\ufeff')
+        self.assertEqual(next(csv.reader(io.StringIO(content), delimiter=';')), [
+            '\'=HYPERLINK("http://evil")', '+7 999', "'-1+1", "'@SUM(A1)", "'- заметка", 'Иванов', '-5', '-5',
+        ])
+
+    def test_csv_phone_round_trip(self):
+        for number, client in enumerate(Client.objects.filter(created_by=self.dataset.users[0])):
+            Client.objects.filter(pk=client.pk).update(phone=f'+7 (999) 123-45-6{number}')
+        http_client = logged_in_client(self.dataset.users[0])
+        response = http_client.get(reverse('clients_export', args=['clients']))
+        content = b''.join(response.streaming_content).decode('utf-8-sig')
+        rows = list(csv.reader(io.StringIO(content), delimiter=';'))
+        phone_column = rows[0].index('Телефон')
+        self.assertEqual(sorted(row[phone_column] for row in rows[1:]), [f'+7 (999) 123-45-6{n}' for n in range(5)])
+
+    @skipUnless(xlsx_available(), 'openpyxl не установлен')
+    def test_xlsx_download_round_trip(self):
+        from openpyxl import load_workbook
+
+        owner = self.dataset.users[0]
+        for number, client in enumerate(Client.objects.filter(created_by=owner)):
+            Client.objects.filter(pk=client.pk).update(phone=f'+7999123456{number}', first_name='=1+1')
+        http_client = logged_in_client(owner)
+        response = http_client.get(reverse('clients_export', args=['clients']), {'format': 'xlsx'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('.xlsx', response['Content-Disposition'])
+
+        sheet = load_workbook(io.BytesIO(b''.join(response.streaming_content))).active
+        rows = [[cell.value for cell in row] for row in sheet.iter_rows()]
+        self.assertEqual(len(rows), 6)
+        header = rows[0]
+        self.assertEqual(sorted(row[header.index('Телефон')] for row in rows[1:]), [f'+7999123456{n}' for n in range(5)])
+        # Формула сохраняется текстом, а не вычисляется
+        self.assertEqual({row[header.index('Имя')] for row in rows[1:]}, {"'=1+1"})
+
+    def test_unknown_dataset(self):
+        http_client = logged_in_client(self.dataset.users[0])
+        self.assertEqual(http_client.get(reverse('clients_export', args=['users'])).status_code, 404)
+
+
+class ClientCountersTests(TestCase):
+    """Счетчики заказов клиента совпадают с таблицей заказов после любых изменений"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.client_obj = Client.objects.create(created_by=self.user, first_name='Иван', last_name='Иванов', phone='1')
+        self.other = Client.objects.create(created_by=self.user, first_name='Петр', last_name='Петров', phone='2')
+        self.car = Car.objects.create(client=self.client_obj, brand='Lada', model='Vesta')
+
+    def order(self, client=None, labor_cost=1000):
+        return Order.objects.create(
+            client=client or self.client_obj, car=self.car, description='ТО', labor_cost=labor_cost
+        )
+
+    def counters(self, client):
+        client.refresh_from_db()
+        return client.orders_count, client.total_spent, client.last_order_at
+
+    def test_delete_latest_order(self):
+        first = self.order()
+        latest = self.order(labor_cost=500)
+        self.assertEqual(self.counters(self.client_obj), (2, 1500, latest.created_at))
+
+        latest.delete()
+        self.assertEqual(self.counters(self.client_obj), (1, 1000, first.created_at))
+        first.delete()
+        self.assertEqual(self.counters(self.client_obj), (0, 0, None))
+
+    def test_move_order_to_another_client(self):
+        first = self.order()
+        latest = self.order(labor_cost=500)
+        latest.client = self.other
+        latest.save()
+
+        self.assertEqual(self.counters(self.client_obj), (1, 1000, first.created_at))
+        self.assertEqual(self.counters(self.other), (1, 500, latest.created_at))
+
+    def test_queryset_delete(self):
+        self.order()
+        self.order(labor_cost=500)
+        Order.objects.filter(client=self.client_obj).delete()
+
+        self.assertEqual(self.counters(self.client_obj), (0, 0, None))
+        self.assertEqual(list(DailyOrderStat.objects.values_list('orders_count', 'revenue')), [(0, 0)])
+
+    def test_reconcile_command(self):
+        order = self.order()
+        Client.objects.filter(pk=self.client_obj.pk).update(orders_count=5, total_spent=1, last_order_at=None)
+        self.assertEqual(find_drift(actual_counters(Client.objects.order_by('pk'))), [self.client_obj])
+
+        out = io.StringIO()
+        call_command('reconcile_client_counters', stdout=out)
+        self.assertIn(f'Клиент #{self.client_obj.pk}: заказов 5 -> 1', out.getvalue())
+        self.assertIn('расхождений: 1', out.getvalue())
+        self.assertEqual(self.counters(self.client_obj), (5, 1, None))
+
+        call_command('reconcile_client_counters', fix=True, batch_size=1, stdout=out)
+        self.assertEqual(self.counters(self.client_obj), (1, 1000, order.created_at))
+        out = io.StringIO()
+        call_command('reconcile_client_counters', stdout=out)
+        self.assertIn('Проверено клиентов: 2, расхождений: 0', out.getvalue())
+
+
+class DailyOrderStatTests(TestCase):
+    """Дневная статистика совпадает с агрегатами по таблице заказов"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.client_obj = Client.objects.create(created_by=self.user, first_name='Иван', last_name='Иванов', phone='1')
+        self.other = Client.objects.create(created_by=self.user, first_name='Петр', last_name='Петров', phone='2')
+        self.car = Car.objects.create(client=self.client_obj, brand='Lada', model='Vesta')
+        self.today = timezone.localdate()
+
+    def order(self, days_ago, status='new', labor_cost=1000):
+        order = Order.objects.create(
+            client=self.client_obj, car=self.car, description='ТО', status=status, labor_cost=labor_cost
+        )
+        if days_ago:
+            order.created_at -= timedelta(days=days_ago)
+            order.save()
+        return order
+
+    def raw_counters(self):
+        orders = Order.objects.filter(client__created_by=self.user)
+        by_status = {
+            item['status']: item['count'] for item in orders.values('status').annotate(count=Count('id')).order_by()
+        }
+        return (
+            orders.filter(created_at__date=self.today).count(),
+            orders.exclude(status__in=['completed', 'cancelled']).count(),
+            by_status,
+        )
+
+    def raw_trend(self, days):
+        start = self.today - timedelta(days=days - 1)
+        totals = {
+            item['day']: (item['count'], item['revenue'])
+            for item in Order.objects.filter(client__created_by=self.user, created_at__date__gte=start)
+            .exclude(status='cancelled').annotate(day=TruncDate('created_at')).values('day')
+            .annotate(count=Count('id'), revenue=Sum('total_amount')).order_by()
+        }
+        return [totals.get(start + timedelta(days=offset), (0, 0)) for offset in range(days)]
+
+    def assert_matches_orders(self):
+        orders_today, in_progress, by_status = dashboard_counters(self.user, self.today)
+        self.assertEqual(
+            (orders_today, in_progress, {item['status']: item['count'] for item in by_status}), self.raw_counters()
+        )
+        for days in TREND_PERIODS:
+            trend = [(item['count'], item['revenue']) for item in order_trend(self.user, days, self.today)]
+            self.assertEqual(trend, self.raw_trend(days), days)
+
+    def test_stats_follow_orders(self):
+        today = self.order(0)
+        week = self.order(7, status='completed', labor_cost=2000)
+        quarter = self.order(80, status='in_progress', labor_cost=300)
+        old = self.order(200, labor_cost=700)
+        self.order(400)
+        self.assert_matches_orders()
+
+        # completed -> cancelled -> completed
+        week.status = 'cancelled'
+        week.save()
+        self.assert_matches_orders()
+        week.status = 'completed'
+        week.labor_cost = 2500
+        week.save()
+        self.assert_matches_orders()
+
+        # Перенос между днями и между периодами тренда
+        quarter.created_at = timezone.now() - timedelta(days=3)
+        quarter.save()
+        old.created_at -= timedelta(days=300)
+        old.client = self.other
+        old.save()
+        self.assert_matches_orders()
+
+        today.delete()
+        Order.objects.filter(pk=quarter.pk).delete()
+        self.assert_matches_orders()
+
+        # Полный пересчет дает те же строки, что и инкрементальные обновления
+        incremental = set(
+            DailyOrderStat.objects.filter(user=self.user).exclude(orders_count=0, revenue=0)
+            .values_list('day', 'status', 'orders_count', 'revenue')
+        )
+        call_command('rebuild_order_stats', user=self.user.pk, stdout=io.StringIO())
+        rebuilt = set(
+            DailyOrderStat.objects.filter(user=self.user).values_list('day', 'status', 'orders_count', 'revenue')
+        )
+        self.assertEqual(incremental, rebuilt)
+        self.assert_matches_orders()
+
+    def test_rebuild_command(self):
+        self.order(0)
+        self.order(40, status='cancelled')
+        DailyOrderStat.objects.all().delete()
+        call_command('rebuild_order_stats', stdout=io.StringIO())
+        self.assertEqual(DailyOrderStat.objects.count(), 2)
+        self.assert_matches_orders()
+
+
+class OrderLinesTests(TestCase):
+    """Строки заказа сохраняются пачкой, суммы заказа и клиента пересчитываются"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.client_obj = Client.objects.create(created_by=self.user, first_name='Иван', last_name='Иванов', phone='1')
+        car = Car.objects.create(client=self.client_obj, brand='Lada', model='Vesta')
+        self.order = Order.objects.create(client=self.client_obj, car=car, description='ТО', discount=100)
+        self.url = reverse('order_lines_api', args=[self.order.pk])
+        self.http_client = logged_in_client(self.user)
+
+    def post(self, payload):
+        return self.http_client.post(self.url, json.dumps(payload), content_type='application/json')
+
+    def test_replace_lines(self):
+        response = self.post({
+            'services': [{'name': f'Работа {i}', 'quantity': 2, 'price': '150.50'} for i in range(40)],
+            'parts': [{'name': 'Фильтр', 'article': 'F-1', 'quantity': 1, 'price': '900'}],
+        })
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['labor_cost'], '12040.00')
+        self.assertEqual(data['total_amount'], '12840.00')
+
+        # Одна строка изменена, остальные работы удалены, запчасти не переданы и остаются
+        service = data['services'][0]
+        with CaptureQueriesContext(connection) as captured:
+            response = self.post({'services': [dict(service, quantity=1)]})
+        self.assertLessEqual(len(captured), 15)
+        self.assertEqual(response.json()['total_amount'], '950.50')
+
+        self.order.refresh_from_db()
+        self.client_obj.refresh_from_db()
+        self.assertEqual(self.order.services.count(), 1)
+        self.assertEqual(self.order.parts.count(), 1)
+        self.assertEqual(self.client_obj.total_spent, self.order.total_amount)
+
+    def test_invalid_lines_change_nothing(self):
+        response = self.post({'services': [{'name': 'Работа', 'quantity': 1, 'price': '100'}, {'name': ''}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('1', response.json()['errors']['services'])
+
+        response = self.post({'parts': [{'id': 999999, 'name': 'Чужая', 'quantity': 1, 'price': '1'}]})
+        self.assertEqual(response.status_code, 400)
+        response = self.post({'parts': [{'id': True, 'name': 'Фильтр', 'quantity': 1, 'price': '1'}]})
+        self.assertEqual(response.json()['errors']['parts']['0'], {'id': [{'message': 'Некорректный id строки'}]})
+        self.assertFalse(self.order.services.exists() or self.order.parts.exists())
+
+        for services in ({'name': 'Работа'}, 'Работа', 5):
+            with self.subTest(services=services):
+                response = self.post({'services': services})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('__all__', response.json()['errors']['services'])
+
+    def test_stale_order_uses_locked_row(self):
+        stale = Order.objects.get(pk=self.order.pk)
+        other = Client.objects.create(created_by=self.user, first_name='Петр', last_name='Петров', phone='2')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.client = other
+            self.order.status = 'in_progress'
+            self.order.save()
+
+        save_order_lines(stale, services=[{'name': 'Работа', 'quantity': 1, 'price': '500'}])
+        self.client_obj.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.client_obj.orders_count, self.client_obj.total_spent), (0, 0))
+        self.assertEqual((other.orders_count, other.total_spent), (1, 400))
+        stats = DailyOrderStat.objects.filter(user=self.user).values_list('status', 'orders_count', 'revenue')
+        self.assertEqual(sorted(stats), [('in_progress', 1, 400), ('new', 0, 0)])
+
+    def test_recompute_command(self):
+        Service.objects.create(order=self.order, name='Работа', quantity=3, price=200)
+        # Данные без расходящихся заказов команда не перечитывает и не трогает
+        other = Client.objects.create(created_by=self.user, first_name='Петр', last_name='Петров', phone='2')
+        Client.objects.filter(pk=other.pk).update(orders_count=7)
+        DailyOrderStat.objects.create(user=self.user, day=timezone.localdate() - timedelta(days=3), status='new',
+                                      orders_count=5)
+        out = io.StringIO()
+        call_command('recompute_order_totals', stdout=out)
+
+        self.order.refresh_from_db()
+        self.client_obj.refresh_from_db()
+        self.assertEqual(self.order.labor_cost, 600)
+        self.assertEqual(self.order.total_amount, 500)
+        self.assertEqual(self.client_obj.total_spent, 500)
+        stat = DailyOrderStat.objects.get(user=self.user, day=timezone.localdate(self.order.created_at))
+        self.assertEqual((stat.orders_count, stat.revenue), (1, 500))
+        self.assertEqual(Client.objects.get(pk=other.pk).orders_count, 7)
+        self.assertEqual(DailyOrderStat.objects.filter(user=self.user).count(), 2)
+
+
+class OrderBoardTests(TestCase):
+    """Доска заказов получает дельты через брокер событий, а не перечитывает базу"""
+
+    def setUp(self):
+        self.broker = InMemoryBroker()
+        self.addCleanup(set_broker, set_broker(self.broker))
+        self.user = User.objects.create_user('user', password='password')
+        self.client_obj = Client.objects.create(created_by=self.user, first_name='Иван', last_name='Иванов', phone='1')
+        self.car = Car.objects.create(client=self.client_obj, brand='Lada', model='Vesta')
+
+    def test_status_changes_are_published_after_commit(self):
+        channel = order_channel(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(client=self.client_obj, car=self.car, description='ТО')
+        with self.captureOnCommitCallbacks(execute=True):
+            order.master_notes = 'Без смены статуса'
+            order.save()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            order.status = 'in_progress'
+            order.save()
+            self.assertEqual(len(self.broker.history(channel, 0)), 1)
+        self.assertEqual(len(callbacks), 2)
+
+        events = [data for _, data in self.broker.history(channel, 0)]
+        self.assertEqual([(event['type'], event['status']) for event in events],
+                         [('created', 'new'), ('status', 'in_progress')])
+
+    def test_board_page(self):
+        Order.objects.create(client=self.client_obj, car=self.car, description='ТО', status='ready')
+        http_client = logged_in_client(self.user)
+        with CaptureQueriesContext(connection) as captured:
+            response = http_client.get(reverse('order_board'))
+        self.assertEqual(response.status_code, 200)
+        # Пользователь (кэш после входа пуст) и заказы; сессия читается из кэша
+        self.assertEqual(len(captured), 2)
+        self.assertContains(response, 'data-order=')
+
+    def test_event_stream(self):
+        async def read_stream():
+            http_client = AsyncClient()
+            await http_client.aforce_login(self.user)
+            response = await http_client.get(reverse('order_board_events'), headers={'Last-Event-ID': '0'})
+            chunks = aiter(response.streaming_content)
+            first = await anext(chunks)
+            # Событие из другого потока (синхронный код) доходит до подписчика
+            await asyncio.to_thread(
+                publish_order_event, self.user.pk, {'type': 'status', 'id': 1, 'status': 'ready'}
+            )
+            second = await asyncio.wait_for(anext(chunks), 5)
+            self.assertEqual(self.broker.subscriber_count(order_channel(self.user.pk)), 1)
+            await chunks.aclose()
+            return first, second
+
+        first, second = async_to_sync(read_stream)()
+        self.assertTrue(first.startswith(b'retry:'))
+        self.assertIn(b'event: order', second)
+        self.assertIn(b'"status": "ready"', second)
+
+    def test_failed_publish_does_not_fail_save(self):
+        with mock.patch.object(self.broker, 'publish', side_effect=OperationalError('events')):
+            with self.assertLogs('django', 'ERROR'):
+                with self.captureOnCommitCallbacks(execute=True):
+                    order = Order.objects.create(client=self.client_obj, car=self.car, description='ТО')
+        self.assertTrue(Order.objects.filter(pk=order.pk).exists())
+
+    def test_wsgi_polling(self):
+        # Под WSGI вместо бесконечного потока — короткий ответ, после которого EventSource переподключается
+        http_client = logged_in_client(self.user)
+        url = reverse('order_board_events')
+        response = http_client.get(url)
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.content.decode(), 'retry: 3000\n\nevent: mode\ndata: poll\n\nid: 0\n\n')
+
+        publish_order_event(self.user.pk, {'type': 'status', 'id': 1, 'status': 'ready'})
+        response = http_client.get(url, headers={'Last-Event-ID': '0'})
+        self.assertIn('id: 1\nevent: order\ndata: {"type": "status"', response.content.decode())
+
+
+class DatabaseBrokerTests(TestCase):
+    """Брокер поверх таблицы: события видны всем процессам"""
+
+    def setUp(self):
+        self.broker = DatabaseBroker()
+        self.broker.poll_interval = 0.01
+        self.channel = order_channel(1)
+
+    def test_publish_and_history(self):
+        self.assertEqual(self.broker.last_id(self.channel), 0)
+        first = self.broker.publish(self.channel, {'id': 1})
+        second = self.broker.publish(self.channel, {'id': 2})
+        self.broker.publish(order_channel(2), {'id': 3})
+        self.assertEqual(self.broker.history(self.channel, first), [(second, {'id': 2})])
+        self.assertEqual(self.broker.last_id(self.channel), second)
+
+    def test_subscribe(self):
+        before = self.broker.publish(self.channel, {'id': 1})
+
+        async def read():
+            events = self.broker.subscribe(self.channel, timeout=0.05)
+            # Без Last-Event-ID приходят только новые события; в тишине — keep-alive
+            self.assertIsNone(await anext(events))
+            await sync_to_async(self.broker.publish)(self.channel, {'id': 2})
+            event = await anext(events)
+            self.assertEqual(self.broker.subscriber_count(self.channel), 1)
+            await events.aclose()
+            return event
+
+        event_id, data = async_to_sync(read)()
+        self.assertGreater(event_id, before)
+        self.assertEqual(data, {'id': 2})
+        self.assertEqual(self.broker.subscriber_count(), 0)
+
+    def test_one_poller_per_process(self):
+        other = order_channel(2)
+
+        async def read():
+            fetch = mock.patch.object(self.broker, '_fetch', wraps=self.broker._fetch)
+            with fetch as fetched:
+                channels = (self.channel, self.channel, other)
+                screens = [self.broker.subscribe(channel, timeout=0.05) for channel in channels]
+                for screen in screens:
+                    self.assertIsNone(await anext(screen))
+                self.assertEqual(len(self.broker._pollers), 1)
+                await sync_to_async(self.broker.publish)(self.channel, {'id': 1})
+                await sync_to_async(self.broker.publish)(other, {'id': 2})
+                events = [await anext(screen) for screen in screens]
+                for screen in screens:
+                    await screen.aclose()
+            # Каждый опрос — один запрос по всем каналам процесса
+            self.assertTrue(fetched.call_count)
+            self.assertEqual(fetched.call_args.args[1], {self.channel, other})
+            return events
+
+        events = async_to_sync(read)()
+        self.assertEqual([data for _, data in events], [{'id': 1}, {'id': 1}, {'id': 2}])
+        self.assertEqual(self.broker._pollers, {})
+
+
+class CarsApiTests(TestCase):
+    """API автомобилей: ETag и 304, выбор полей, пакетный режим"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = generate_dataset(users=2, clients=3, cars=2, orders=0)
+        cls.user = cls.dataset.users[0]
+        cls.client_ids = list(Client.objects.filter(created_by=cls.user).order_by('pk').values_list('pk', flat=True))
+
+    def setUp(self):
+        self.http_client = logged_in_client(self.user)
+        self.url = reverse('client_cars_api', args=[self.client_ids[0]])
+
+    def test_conditional_get(self):
+        response = self.http_client.get(self.url)
+        self.assertEqual(len(response.json()), 2)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as captured:
+            response = self.http_client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        # Только расчет ETag: сессия и пользователь берутся из кэша
+        self.assertEqual(len(captured), 1)
+
+        car = Car.objects.filter(client_id=self.client_ids[0]).first()
+        car.mileage = 1000
+        car.save()
+        self.assertEqual(self.http_client.get(self.url, headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_fields(self):
+        response = self.http_client.get(self.url, {'fields': 'id,vin'})
+        self.assertEqual(set(response.json()[0]), {'id', 'vin'})
+        self.assertEqual(self.http_client.get(self.url, {'fields': 'notes'}).status_code, 400)
+
+    def test_batch_skips_foreign_clients(self):
+        foreign = Client.objects.exclude(created_by=self.user).values_list('pk', flat=True).first()
+        ids = ','.join(map(str, [*self.client_ids, foreign]))
+        response = self.http_client.get(reverse('cars_api'), {'client_ids': ids, 'fields': 'id'})
+        results = response.json()['results']
+        self.assertEqual(set(results), {str(pk) for pk in self.client_ids})
+        self.assertTrue(all(len(cars) == 2 for cars in results.values()))
+        self.assertEqual(
+            self.http_client.get(reverse('client_cars_api', args=[foreign])).status_code, 404
+        )
+
+
+class PhoneNormalizationTests(TestCase):
+    """Телефоны хранятся в E.164, дубликаты в разной записи не проходят, поиск по окончанию номера"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.client_obj = Client.objects.create(
+            created_by=self.user, first_name='Иван', last_name='Иванов',
+            phone='8 (999) 123-45-67', additional_phone='+7 495 111-22-33',
+        )
+        self.http_client = logged_in_client(self.user)
+
+    def test_normalized_on_save(self):
+        self.assertEqual(self.client_obj.phone_e164, '+79991234567')
+        self.assertEqual(self.client_obj.additional_phone_e164, '+74951112233')
+        self.assertEqual(phone_e164('12-34'), None)
+
+        form = ClientForm(data={
+            'client_type': 'individual', 'first_name': 'Петр', 'last_name': 'Петров',
+            'phone': '+7 999 123 45 67', 'discount': '0',
+        })
+        self.assertFalse(form.is_valid())
+        self.assertIn('phone', form.errors)
+
+    def test_search_digits(self):
+        company = Client.objects.create(
+            created_by=self.user, first_name='ООО', last_name='Ромашка', phone='+7 912 000-00-00', inn='8901234567',
+        )
+        clients = Client.objects.filter(created_by=self.user)
+        for query, expected in [
+            ('8901', [company]), ('8999', [self.client_obj]), ('7999', [self.client_obj]),
+            ('4567', [self.client_obj]), ('22-33', [self.client_obj]), ('00-00', [company]),
+        ]:
+            with self.subTest(query=query):
+                self.assertEqual(list(search_clients(clients, query, owner=self.user)), expected)
+
+    def test_lookup(self):
+        url = reverse('phone_lookup_api')
+        self.assertEqual(self.http_client.get(url, {'phone': '+7 (999) 123-45-67'}).json()['match'], 'exact')
+        self.assertEqual(self.http_client.get(url, {'phone': '74951112233'}).json()['match'], 'exact')
+
+        data = self.http_client.get(url, {'phone': '4567'}).json()
+        self.assertEqual(data['match'], 'suffix')
+        self.assertEqual([item['id'] for item in data['results']], [self.client_obj.pk])
+        self.assertEqual(self.http_client.get(url, {'phone': '0000'}).json()['results'], [])
+        self.assertEqual(self.http_client.get(url, {'phone': '12'}).status_code, 400)
+
+    def test_lookup_uses_indexes(self):
+        for phone in ('89991234567', '2233'):
+            with self.subTest(phone=phone):
+                collector = CapturedQueries()
+                with connection.execute_wrapper(collector):
+                    self.http_client.get(reverse('phone_lookup_api'), {'phone': phone})
+                self.assertEqual(explain_full_scans(collector.queries), [])
+
+    def test_backfill_reports_duplicates(self):
+        duplicate = Client.objects.create(created_by=self.user, first_name='Петр', last_name='Петров', phone='x')
+        Client.objects.filter(pk=duplicate.pk).update(phone='+7 999 123 45 67')
+        Client.objects.update(phone_e164=None, phone_suffix_key='')
+
+        out = io.StringIO()
+        call_command('normalize_phones', stdout=out)
+        self.assertIn(f'Клиент #{duplicate.pk} дублирует клиента #{self.client_obj.pk}', out.getvalue())
+        self.assertEqual(Client.objects.get(pk=self.client_obj.pk).phone_e164, '+79991234567')
+        self.assertEqual(Client.objects.get(pk=duplicate.pk).phone_suffix_key, '76543219997')
+
+        # Повторное сохранение дубликата не забирает номер у первого клиента
+        duplicate = Client.objects.get(pk=duplicate.pk)
+        duplicate.notes = 'Дубликат'
+        duplicate.full_clean()
+        duplicate.save()
+        self.assertIsNone(Client.objects.get(pk=duplicate.pk).phone_e164)
+
+    def test_landline_is_russian(self):
+        self.assertEqual(phone_e164('4951112233'), '+74951112233')
+        self.assertEqual(phone_e164('9991234567'), '+79991234567')
+
+    def test_admin_rejects_duplicate(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        response = logged_in_client(admin_user).post(reverse('admin:clients_client_add'), {
+            'client_type': 'individual', 'first_name': 'Петр', 'last_name': 'Петров',
+            'phone': '89991234567', 'discount': '0', 'orders_count': '0', 'total_spent': '0',
+            'cars-TOTAL_FORMS': '0', 'cars-INITIAL_FORMS': '0',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('phone', response.context['adminform'].form.errors)
+        self.assertEqual(Client.objects.count(), 1)
+
+
+class DedupeTests(TestCase):
+    """Поиск дубликатов по блокирующим ключам и объединение клиентов"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.other_user = User.objects.create_user('other', password='password')
+
+    def create_client(self, last_name, phone, user=None, **fields):
+        return Client.objects.create(
+            created_by=user or self.user, first_name=fields.pop('first_name', 'Иван'), last_name=last_name,
+            phone=phone, **fields
+        )
+
+    def test_phonetic_key(self):
+        self.assertEqual(phonetic_key('Иванов'), phonetic_key('Иваноф'))
+        self.assertEqual(phonetic_key('Иванов'), phonetic_key('Ивонов'))
+        self.assertNotEqual(phonetic_key('Иванов'), phonetic_key('Петров'))
+
+    def test_candidates(self):
+        original = self.create_client('Иванов', '+7 (999) 000-00-01', email='ivanov@example.com')
+        by_email = self.create_client('Иваноф', '+7 999 000 00 02', email='IVANOV@example.com')
+        # ИНН уникален в базе, но может отличаться пробелами
+        legal = self.create_client('Сидоров', '1001', inn='7700000000')
+        legal_copy = self.create_client('Сидоров', '1002', first_name='Сидор', inn=' 7700000000')
+        with_car = self.create_client('Петров', '2001', first_name='Петр')
+        Car.objects.create(client=with_car, brand='Lada', model='Vesta', vin='XTA00000000000001')
+        car_copy = self.create_client('Петрова', '2002', first_name='Петр')
+        Car.objects.create(client=car_copy, brand='Lada', model='Vesta', license_plate='А001ВС77')
+        Car.objects.filter(client=car_copy).update(vin='xta-00000000000001')
+        # Тот же телефон у клиента другого пользователя — не дубликат
+        self.create_client('Иванов', '8 999 000 00 03', user=self.other_user)
+        self.create_client('Другой', '79990000004')
+
+        candidates, _ = find_merge_candidates(Client.objects.all())
+        pairs = {(candidate.client_id, candidate.duplicate_id): candidate for candidate in candidates}
+        self.assertEqual(set(pairs), {(original.pk, by_email.pk), (legal.pk, legal_copy.pk), (with_car.pk, car_copy.pk)})
+        self.assertIn('vin', pairs[(with_car.pk, car_copy.pk)].reasons)
+        self.assertIn('inn', pairs[(legal.pk, legal_copy.pk)].reasons)
+
+    def test_merge(self):
+        target = self.create_client('Иванов', '+7 999 000 00 01')
+        duplicate = self.create_client('Иванов', '89990000005', email='ivanov@example.com', inn='7700000000')
+        car = Car.objects.create(client=duplicate, brand='Lada', model='Vesta')
+        Order.objects.create(client=target, car=Car.objects.create(client=target, brand='Kia', model='Rio'),
+                             description='ТО', labor_cost=1000)
+        Order.objects.create(client=duplicate, car=car, description='Ремонт', labor_cost=500)
+        ClientHistory.objects.create(client=duplicate, created_by=self.user, action='Звонок', description='')
+
+        merge_clients(target, [duplicate], user=self.user)
+
+        target.refresh_from_db()
+        self.assertFalse(Client.objects.filter(pk=duplicate.pk).exists())
+        self.assertEqual(target.cars.count(), 2)
+        self.assertEqual(target.orders_count, 2)
+        self.assertEqual(target.total_spent, 1500)
+        self.assertEqual((target.email, target.inn, target.additional_phone), ('ivanov@example.com', '7700000000', '89990000005'))
+        self.assertTrue(target.history.filter(action='Звонок').exists())
+        self.assertEqual(search_clients(Client.objects.all(), '7700000000', owner=self.user).get(), target)
+
+        foreign = self.create_client('Иванов', '79990000006', user=self.other_user)
+        with self.assertRaises(ValueError):
+            merge_clients(target, [foreign])
+
+    def test_merge_moves_tags(self):
+        target = self.create_client('Иванов', '+7 999 000 00 01', tags='vip')
+        duplicate = self.create_client('Иваноф', '+7 999 000 00 02', tags='опт, VIP')
+        self.assertEqual(dict(tag_counts(self.user.pk)), {'vip': 2, 'опт': 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            merge_clients(target, [duplicate], user=self.user)
+
+        target.refresh_from_db()
+        self.assertEqual(target.tags, 'vip, опт')
+        self.assertEqual(
+            set(ClientTag.objects.filter(client=target).values_list('tag__name', flat=True)), {'vip', 'опт'}
+        )
+        self.assertEqual(dict(tag_counts(self.user.pk)), {'vip': 1, 'опт': 1})
+
+    def test_groups_need_direct_match(self):
+        first, second, third, fourth = 1, 2, 3, 4
+        candidates = [
+            MergeCandidate(first, second, 80, ['phone']),
+            MergeCandidate(second, third, 80, ['email']),
+            MergeCandidate(first, fourth, 90, ['inn']),
+        ]
+        # third похож только на second, а second уже присоединяется к first
+        self.assertEqual(group_candidates(candidates), {first: [second, fourth]})
+        self.assertEqual(group_candidates(candidates[1:]), {first: [fourth], second: [third]})
+
+
+class DashboardCacheTests(TestCase):
+    """Кэш дашборда: один пересчет холодного ключа, счетчики попаданий, сброс при изменениях"""
+
+    def setUp(self):
+        cache.clear()
+
+    @staticmethod
+    async def async_value():
+        return {'orders': 5}
+
+    def test_cold_key_computed_once(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'orders': 5}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(get_dashboard_context(1, '30', compute)))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'orders': 5}] * 4)
+
+    def test_async_cold_key_computed_once(self):
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return {'orders': 5}
+
+        async def load():
+            return await asyncio.gather(*(aget_dashboard_context(1, '30', compute) for _ in range(4)))
+
+        self.assertEqual(async_to_sync(load)(), [{'orders': 5}] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_hits_and_misses(self):
+        for _ in range(3):
+            get_dashboard_context(1, '30', lambda: {'orders': 5})
+        async_to_sync(aget_dashboard_context)(1, '30', self.async_value)
+        async_to_sync(aget_dashboard_context)(1, '90', self.async_value)
+        self.assertEqual(dashboard_cache_stats(), {'hits': 3, 'misses': 2, 'hit_ratio': 0.6})
+
+        out = io.StringIO()
+        call_command('dashboard_cache_stats', reset=True, stdout=out)
+        self.assertIn('Попаданий: 3, промахов: 2, доля попаданий: 60.0%', out.getvalue())
+        self.assertEqual(dashboard_cache_stats(), {'hits': 0, 'misses': 0, 'hit_ratio': 0.0})
+
+    def test_version_bump_drops_cached_data(self):
+        get_dashboard_context(1, '30', lambda: {'orders': 5})
+        bump_dashboard_version(1)
+        self.assertEqual(get_dashboard_context(1, '30', lambda: {'orders': 6}), {'orders': 6})
+        # Ключ версии вытеснен: новая версия не совпадает со старыми данными
+        version = dashboard_version(1)
+        cache.delete('dashboard:version:1')
+        self.assertNotEqual(dashboard_version(1), version)
+
+    def test_history_changes_bump_version(self):
+        user = User.objects.create_user('user', password='password')
+        client = Client.objects.create(created_by=user, first_name='Иван', last_name='Иванов', phone='1')
+        version = dashboard_version(user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            record_history(client, 'note', 'Звонок')
+        self.assertNotEqual(dashboard_version(user.pk), version)
+
+        # Записи из буфера запроса тоже сбрасывают кэш
+        version = dashboard_version(user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            flush_history([ClientHistory(client=client, action='note', description='Визит')])
+        self.assertNotEqual(dashboard_version(user.pk), version)
+
+    def test_car_changes_bump_version(self):
+        user = User.objects.create_user('user', password='password')
+        client = Client.objects.create(created_by=user, first_name='Иван', last_name='Иванов', phone='1')
+        version = dashboard_version(user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            car = Car.objects.create(client=client, brand='Lada', model='Vesta')
+        self.assertNotEqual(dashboard_version(user.pk), version)
+
+        version = dashboard_version(user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            car.delete()
+        self.assertNotEqual(dashboard_version(user.pk), version)
+
+    def test_file_cache_incr_is_atomic(self):
+        with tempfile.TemporaryDirectory() as location:
+            backend = FileBasedCache(location, {'TIMEOUT': 60})
+            backend.set('counter', 0, None)
+            threads = [threading.Thread(target=lambda: [backend.incr('counter') for _ in range(50)])
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(backend.get('counter'), 400)
+
+            # Срок жизни ключа сохраняется: ключ без срока не получает TIMEOUT по умолчанию
+            with mock.patch('time.time', return_value=time.time() + 120):
+                self.assertEqual(backend.get('counter'), 400)
+            with self.assertRaises(ValueError):
+                backend.incr('missing')
+            self.assertEqual(async_to_sync(backend.aincr)('counter', 10), 410)
+
+
+class TagTests(TestCase):
+    """Теги раскладываются в справочник, фильтры идут через индекс ClientTag"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user', password='password')
+        self.fleet = self.create_client('Иванов', '1001', tags='Fleet, VIP, fleet')
+        self.fleetwood = self.create_client('Петров', '1002', tags='fleetwood')
+        self.vip = self.create_client('Сидоров', '1003', tags='vip')
+
+    def create_client(self, last_name, phone, tags):
+        return Client.objects.create(created_by=self.user, first_name='Иван', last_name=last_name, phone=phone,
+                                     tags=tags)
+
+    def filtered(self, names, mode='any'):
+        return set(filter_by_tags(Client.objects.all(), names, mode).values_list('pk', flat=True))
+
+    def test_parse_and_sync(self):
+        self.assertEqual(parse_tags(' Fleet ,VIP,, fleet '), ['fleet', 'vip'])
+        self.assertEqual(set(Tag.objects.values_list('name', flat=True)), {'fleet', 'vip', 'fleetwood'})
+        self.assertEqual(ClientTag.objects.filter(client=self.fleet).count(), 2)
+
+        self.fleet.tags = 'vip, новый'
+        self.fleet.save()
+        self.assertEqual(
+            set(ClientTag.objects.filter(client=self.fleet).values_list('tag__name', flat=True)), {'vip', 'новый'}
+        )
+
+    def test_filters(self):
+        self.assertEqual(self.filtered(['fleet']), {self.fleet.pk})
+        self.assertEqual(self.filtered(['fleet', 'vip']), {self.fleet.pk, self.vip.pk})
+        self.assertEqual(self.filtered(['fleet', 'VIP'], 'all'), {self.fleet.pk})
+        self.assertEqual(self.filtered(['fleet', 'нет такого'], 'all'), set())
+
+        response = logged_in_client(self.user).get(reverse('client_list'), {'tag': ['vip'], 'tag_mode': 'any'})
+        self.assertEqual({client.pk for client in response.context['clients']}, {self.fleet.pk, self.vip.pk})
+        self.assertIn(('vip', 2), response.context['tag_counts'])
+
+    def test_counts_cached(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(tag_counts(self.user.pk)[0], ('vip', 2))
+        with self.assertNumQueries(0):
+            tag_counts(self.user.pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.vip.tags = 'fleetwood'
+            self.vip.save()
+        self.assertEqual(tag_counts(self.user.pk)[0], ('fleetwood', 2))
+
+    def test_counts_after_delete(self):
+        self.assertEqual(dict(tag_counts(self.user.pk)), {'vip': 2, 'fleet': 1, 'fleetwood': 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.vip.delete()
+        self.assertEqual(dict(tag_counts(self.user.pk)), {'vip': 1, 'fleet': 1, 'fleetwood': 1})
+
+        # Массовое удаление (действие админки) идет через QuerySet.delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            Client.objects.filter(pk__in=[self.fleet.pk, self.fleetwood.pk]).delete()
+        self.assertEqual(tag_counts(self.user.pk), [])
+
+    def test_list_sidebar_query(self):
+        # Панель тегов в списке клиентов: один запрос на холодном кэше, ноль — на прогретом.
+        # Отсюда бюджет client_list в QueryBudgetTests: 5 запросов списка + 1 на счетчики тегов
+        http_client = logged_in_client(self.user)
+        url = reverse('client_list')
+        http_client.get(url)
+        cache.clear()
+        with CaptureQueriesContext(connection) as cold:
+            http_client.get(url)
+        with CaptureQueriesContext(connection) as warm:
+            http_client.get(url)
+        self.assertEqual(len(cold) - len(warm), 1)
+        self.assertEqual(len([query for query in cold.captured_queries if 'clients_clienttag' in query['sql']]), 1)
+
+    def test_backfill_command(self):
+        Client.objects.filter(pk=self.fleetwood.pk).update(tags='vip, fleet')
+        ClientTag.objects.all().delete()
+
+        out = io.StringIO()
+        call_command('split_client_tags', batch_size=2, stdout=out)
+        self.assertIn('Теги разложены: 3 клиентов', out.getvalue())
+        self.assertEqual(self.filtered(['fleet', 'vip'], 'all'), {self.fleet.pk, self.fleetwood.pk})
+
+
+class ClientHistoryTests(TestCase):
+    """Записи истории сохраняются одним INSERT за запрос, старые уходят в архив"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.client_obj = Client.objects.create(created_by=self.user, first_name='Иван', last_name='Иванов',
+                                                phone='1001')
+        self.http_client = logged_in_client(self.user)
+
+    def test_buffered_writes(self):
+        data = {'client_type': 'individual', 'first_name': 'Иван', 'last_name': 'Петров', 'phone': '1001',
+                'discount': '0'}
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.http_client.post(reverse('client_edit', args=[self.client_obj.pk]), data)
+        self.assertEqual(response.status_code, 302)
+        inserts = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('INSERT INTO "clients_clienthistory"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.client_obj.history.get().action, 'Редактирование клиента')
+
+        # Вне запроса запись сохраняется сразу
+        entry = record_history(self.client_obj, 'Звонок', user=self.user)
+        self.assertIsNotNone(entry.pk)
+
+    def test_archive(self):
+        old = record_history(self.client_obj, 'Старый звонок', user=self.user)
+        record_history(self.client_obj, 'Новый звонок', user=self.user)
+        ClientHistory.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=400))
+
+        out = io.StringIO()
+        call_command('archive_client_history', months=12, batch_size=1, stdout=out)
+        self.assertIn('Перенесено в архив записей', out.getvalue())
+        self.assertEqual(list(self.client_obj.history.values_list('action', flat=True)), ['Новый звонок'])
+        self.assertEqual(ClientHistoryArchive.objects.get().history_id, old.pk)
+
+        url = reverse('client_detail', args=[self.client_obj.pk])
+        archived = self.http_client.get(url, {'history': 'archive'}).context['history']
+        self.assertEqual([item.action for item in archived], ['Старый звонок'])
+
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=1.0, PROFILING_FLUSH_INTERVAL=0,
+                   PROFILING_METRICS_TOKEN='secret')
+class ProfilingTests(TestCase):
+    """Замеры запросов по представлениям: лог выборки и метрики Prometheus"""
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(profiling, 'metrics_registry', profiling.MetricsRegistry())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user('user', password='password')
+        Client.objects.create(created_by=self.user, first_name='Иван', last_name='Иванов', phone='1001')
+
+    def test_sampled_record(self):
+        with self.assertLogs('dasauto.profiling', 'INFO') as logs:
+            logged_in_client(self.user).get(reverse('client_list'))
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(record['view'], 'client_list')
+        self.assertGreater(record['sql_count'], 0)
+        self.assertGreater(record['template_ms'], 0)
+        self.assertLessEqual(len(record['slow_queries']), 5)
+        self.assertTrue(any('clients/views.py' in frame for query in record['slow_queries'] for frame in query['stack']))
+
+    def test_metrics_endpoint(self):
+        http_client = logged_in_client(self.user)
+        with self.assertLogs('dasauto.profiling', 'INFO'):
+            http_client.get(reverse('client_list'))
+            http_client.get(reverse('dashboard'))
+            self.assertEqual(http_client.get(reverse('metrics')).status_code, 403)
+
+        with self.assertLogs('dasauto.profiling', 'INFO'):
+            response = self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('dasauto_request_duration_seconds_count{view="client_list"} 1', body)
+        self.assertIn('dasauto_request_duration_seconds_bucket{view="dashboard",le="+Inf"} 1', body)
+        self.assertRegex(body, r'dasauto_sql_queries_total\{view="dashboard"\} [1-9]')
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.usable = True
+
+    def close(self):
+        self.closed = True
+
+
+class DatabaseConnectionTests(TestCase):
+    """Настройки БД из окружения и пул соединений процесса"""
+
+    def test_settings_from_environment(self):
+        config = database_settings({})
+        self.assertEqual(config['ENGINE'], 'django.db.backends.mysql')
+        self.assertEqual((config['HOST'], config['CONN_MAX_AGE'], config['CONN_HEALTH_CHECKS']), ('192.168.1.21', 60, True))
+
+        config = database_settings({'DB_HOST': 'db', 'DB_CONN_MAX_AGE': 'none', 'DB_CONN_HEALTH_CHECKS': '0'})
+        self.assertEqual((config['HOST'], config['CONN_MAX_AGE'], config['CONN_HEALTH_CHECKS']), ('db', None, False))
+
+        config = database_settings({'DB_ENGINE': 'sqlite', 'DB_NAME': 'x.sqlite3', 'DB_POOL_SIZE': '4'})
+        self.assertEqual((config['ENGINE'], config['CONN_MAX_AGE'], config['POOL']['SIZE']), ('dasauto.db.sqlite3', 0, 4))
+        with self.assertRaises(ValueError):
+            database_settings({'DB_ENGINE': 'oracle'})
+
+    def make_pool(self, **options):
+        options = {'size': 2, 'timeout': 0.05, 'recycle': 1800, 'ping_after': 0, **options}
+        return ConnectionPool(FakeConnection, lambda connection: connection.usable, **options)
+
+    def test_reuse_and_limit(self):
+        pool = self.make_pool()
+        first = pool.checkout()
+        pool.checkin(first)
+        self.assertIs(pool.checkout(), first)
+        pool.checkout()
+        with self.assertRaises(PoolTimeout):
+            pool.checkout()
+
+        pool.checkin(first, discard=True)
+        self.assertTrue(first.closed)
+        stats = pool.snapshot()
+        self.assertEqual((stats['checkouts'], stats['connects'], stats['timeouts'], stats['in_use']), (3, 2, 1, 1))
+
+    def test_health_check_and_recycle(self):
+        pool = self.make_pool()
+        broken = pool.checkout()
+        broken.usable = False
+        pool.checkin(broken)
+        replacement = pool.checkout()
+        self.assertIsNot(replacement, broken)
+        self.assertTrue(broken.closed)
+        self.assertEqual(pool.snapshot()['reconnects'], 1)
+
+        pool = self.make_pool(recycle=0)
+        old = pool.checkout()
+        pool.checkin(old)
+        self.assertIsNot(pool.checkout(), old)
+        self.assertEqual(pool.snapshot()['recycled'], 1)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    Чтение с реплики на второй SQLite-базе: данные, записанные в основную БД,
+    на реплике не появляются. TransactionTestCase — внутри atomic() роутер
+    реплику не использует.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Реплика подключается после проверок TestCase (раннер тестов о ней не знает)
+        cls.databases = cls.databases | {'replica'}
+        cls.replica_file = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+        cls.replica_file.close()
+        connections.settings['replica'] = connections.configure_settings({
+            'default': dict(connections.settings['default']),
+            'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': cls.replica_file.name},
+        })['replica']
+        with connections['replica'].schema_editor() as editor:
+            for model in apps.get_models():
+                editor.create_model(model)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        os.unlink(cls.replica_file.name)
+        super().tearDownClass()
+
+    def setUp(self):
+        routing._down_until.clear()
+        self.user = User.objects.create_user('user', password='password')
+        Client.objects.create(created_by=self.user, first_name='Иван', last_name='Иванов', phone='1001')
+        self.http_client = logged_in_client(self.user)
+
+    def test_list_reads_replica_until_write(self):
+        response = self.http_client.get(reverse('client_list'))
+        self.assertEqual(len(response.context['clients']), 0)
+        self.assertNotIn(routing.PIN_COOKIE, response.cookies)
+
+        data = {'client_type': 'individual', 'first_name': 'Петр', 'last_name': 'Петров', 'phone': '1002',
+                'discount': '0'}
+        response = self.http_client.post(reverse('client_create'), data)
+        self.assertIn(routing.PIN_COOKIE, response.cookies)
+        # Недавно писавший браузер читает из основной БД
+        response = self.http_client.get(reverse('client_list'))
+        self.assertEqual(len(response.context['clients']), 2)
+
+    def test_read_your_writes(self):
+        self.assertEqual(Client.objects.all().db, 'default')
+        with routing.replica_reads():
+            self.assertEqual(Client.objects.all().db, 'replica')
+            self.assertEqual(User.objects.all().db, 'default')
+            Tag.objects.create(name='vip')
+            self.assertEqual(Client.objects.all().db, 'default')
+
+    def test_fallback_when_replica_down(self):
+        with mock.patch.object(connections['replica'], 'ensure_connection', side_effect=OperationalError) as ping:
+            with routing.replica_reads():
+                self.assertEqual(Client.objects.all().db, 'default')
+            with routing.replica_reads():
+                self.assertEqual(Client.objects.all().db, 'default')
+        # Упавшая реплика не проверяется повторно до истечения паузы
+        self.assertEqual(ping.call_count, 1)
+
+    def test_replica_fails_mid_request(self):
+        def replica_down(execute, sql, params, many, context):
+            raise OperationalError('Lost connection to MySQL server during query')
+
+        replica = connections['replica']
+        replica.ensure_connection()
+        # Первый ping — при выборе реплики, второй — после ошибки запроса
+        with mock.patch.object(replica, 'is_usable', side_effect=[True, False]), replica.execute_wrapper(replica_down):
+            response = self.http_client.get(reverse('client_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['clients']), 1)
+        self.assertIn('replica', routing._down_until)
+
+    def test_async_views_retry_on_primary(self):
+        # Асинхронное представление читает в потоках sync_to_async со своими соединениями:
+        # сбой реплики подменяется на уровне классов
+        execute = CursorWrapper._execute
+
+        def replica_down(cursor, *args):
+            if cursor.db.alias == 'replica':
+                raise OperationalError('Lost connection to MySQL server during query')
+            return execute(cursor, *args)
+
+        client_obj = Client.objects.get()
+        with (
+            mock.patch.object(CursorWrapper, '_execute', autospec=True, side_effect=replica_down),
+            mock.patch.object(type(connections['replica']), 'is_usable', autospec=True,
+                              side_effect=lambda wrapper: wrapper.alias != 'replica'),
+        ):
+            async def detail():
+                http_client = AsyncClient()
+                await http_client.aforce_login(self.user)
+                return await http_client.get(reverse('client_detail', args=[client_obj.pk]))
+
+            response = async_to_sync(detail)()
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'Иванов')
+            self.assertIn('replica', routing._down_until)
+
+            # Под WSGI асинхронное представление тоже повторяется
+            routing._down_until.clear()
+            response = self.http_client.get(reverse('dashboard'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(list(response.context['top_clients']), [client_obj])
+            self.assertIn('replica', routing._down_until)
+
+    def test_stale_replica_connection_reconnects(self):
+        replica = connections['replica']
+        replica.ensure_connection()
+        stale = replica.connection
+        with mock.patch.object(replica, 'is_usable', return_value=False):
+            with routing.replica_reads():
+                self.assertEqual(Client.objects.all().db, 'replica')
+        self.assertIsNot(replica.connection, stale)
+
+
+@override_settings(TEMPLATE_FRAGMENT_CACHE_TIMEOUT=60)
+class TemplateFragmentCacheTests(TestCase):
+    """Строки клиентов и заказов кэшируются фрагментами с ключом по updated_at"""
+
+    def setUp(self):
+        caches['template_fragments'].clear()
+        self.user = User.objects.create_user('user', password='password')
+        self.client_obj = Client.objects.create(created_by=self.user, first_name='Иван', last_name='Иванов',
+                                                phone='1001')
+        self.car = Car.objects.create(client=self.client_obj, brand='Lada', model='Vesta')
+        self.http_client = logged_in_client(self.user)
+
+    def test_client_row_invalidated_on_change(self):
+        url = reverse('client_list')
+        self.assertContains(self.http_client.get(url), 'Иванов Иван')
+
+        # UPDATE без save() не меняет updated_at: строка берется из кэша
+        Client.objects.filter(pk=self.client_obj.pk).update(last_name='Петров')
+        self.assertContains(self.http_client.get(url), 'Иванов Иван')
+
+        self.client_obj.refresh_from_db()
+        self.client_obj.first_name = 'Петр'
+        self.client_obj.save()
+        self.assertContains(self.http_client.get(url), 'Петров Петр')
+
+        # Счетчики клиента меняются без save(), но входят в ключ фрагмента
+        Order.objects.create(client=self.client_obj, car=self.car, description='ТО', labor_cost=1500)
+        self.assertContains(self.http_client.get(url), '1500,00 ₽')
+
+    @override_settings(TEMPLATE_FRAGMENT_CACHE_TIMEOUT=0)
+    def test_disabled_cache_renders_fresh_rows(self):
+        url = reverse('client_list')
+        self.assertContains(self.http_client.get(url), 'Иванов Иван')
+        Client.objects.filter(pk=self.client_obj.pk).update(last_name='Петров')
+        self.assertContains(self.http_client.get(url), 'Петров Иван')
+
+    def test_order_row_invalidated_on_change(self):
+        order = Order.objects.create(client=self.client_obj, car=self.car, description='ТО')
+        url = reverse('client_detail', args=[self.client_obj.pk])
+        self.assertContains(self.http_client.get(url), 'Не оплачен')
+
+        order.payment_status = 'paid'
+        order.save()
+        response = self.http_client.get(url)
+        self.assertContains(response, 'Оплачен')
+        self.assertNotContains(response, 'Не оплачен')
+
+    def test_compare_rendering(self):
+        dataset = generate_dataset(users=1, clients=30, cars=1, orders=1, services=0, parts=0, prefix='render')
+        results = compare_rendering(dataset, rows=25, repeat=1)
+        self.assertEqual([result.mode for result in results], list(RENDER_MODES))
+        self.assertTrue(all(result.rows == 25 for result in results))
+
+
+class ClientAdminTests(TestCase):
+    """Changelist клиентов на больших таблицах: оценка числа строк, поиск по индексу, кэш источников"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user', password='password')
+        Client.objects.create(created_by=self.user, first_name='Иван', last_name='Иванов', phone='1001',
+                              source='Авито')
+        Client.objects.create(created_by=self.user, first_name='Петр', last_name='Петров', phone='1002',
+                              source='Сайт')
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.http_client = logged_in_client(admin_user)
+        self.url = reverse('admin:clients_client_changelist')
+
+    def test_search_uses_token_index(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.http_client.get(self.url, {'q': 'петр'})
+        self.assertEqual([client.last_name for client in response.context['cl'].result_list], ['Петров'])
+        sql = ' '.join(query['sql'] for query in captured.captured_queries)
+        self.assertIn('clients_clientsearchtoken', sql)
+        self.assertNotIn('LIKE', sql)
+
+    def test_estimated_count(self):
+        paginator = EstimatedCountPaginator(Client.objects.order_by('pk'), 20)
+        paginator.estimate_threshold = 1
+        # Без статистики таблицы — точный COUNT(*)
+        self.assertEqual(paginator.count, 2)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            cursor.execute("UPDATE sqlite_stat1 SET stat = '200000 1' WHERE tbl = 'clients_client'")
+        paginator = EstimatedCountPaginator(Client.objects.order_by('pk'), 20)
+        paginator.estimate_threshold = 1
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(paginator.count, 200000)
+        self.assertFalse([query for query in captured.captured_queries if 'COUNT(' in query['sql']])
+
+        # С фильтром число строк считается точно
+        filtered = EstimatedCountPaginator(Client.objects.filter(source='Сайт').order_by('pk'), 20)
+        filtered.estimate_threshold = 1
+        self.assertEqual(filtered.count, 1)
+
+    def test_source_filter_cached(self):
+        response = self.http_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        with CaptureQueriesContext(connection) as captured:
+            response = self.http_client.get(self.url, {'source': 'Сайт'})
+        self.assertNotIn('DISTINCT', ' '.join(query['sql'] for query in captured.captured_queries))
+        self.assertEqual([client.last_name for client in response.context['cl'].result_list], ['Петров'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Client.objects.create(created_by=self.user, first_name='Анна', last_name='Сидорова', phone='1003',
+                                  source='Радио')
+        response = self.http_client.get(self.url)
+        source_filter = next(spec for spec in response.context['cl'].filter_specs if isinstance(spec, SourceFilter))
+        self.assertEqual([value for value, _ in source_filter.lookup_choices], ['Авито', 'Радио', 'Сайт'])
+
+    def source_choices(self):
+        response = self.http_client.get(self.url)
+        source_filter = next(spec for spec in response.context['cl'].filter_specs if isinstance(spec, SourceFilter))
+        return [value for value, _ in source_filter.lookup_choices]
+
+    def test_merge_action(self):
+        self.assertEqual(self.source_choices(), ['Авито', 'Сайт'])
+        clients = list(Client.objects.order_by('pk'))
+        data = {'action': 'merge_selected', '_selected_action': [client.pk for client in clients]}
+
+        # Без права на удаление действия нет
+        manager = User.objects.create_user('manager', password='password', is_staff=True)
+        manager.user_permissions.add(*Permission.objects.filter(codename__in=['view_client', 'change_client']))
+        manager_client = logged_in_client(manager)
+        self.assertNotContains(manager_client.get(self.url), 'merge_selected')
+        manager_client.post(self.url, data)
+        self.assertEqual(Client.objects.count(), 2)
+        self.assertContains(self.http_client.get(self.url), 'merge_selected')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.http_client.post(self.url, data)
+        self.assertEqual(Client.objects.count(), 1)
+        # Источник удаленного дубликата пропадает из фильтра
+        self.assertEqual(self.source_choices(), ['Авито'])
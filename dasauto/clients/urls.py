@@ -6,8 +6,16 @@ urlpatterns = [
     path('clients/', views.dashboard, name='dashboard'),
     path('clients/list/', views.client_list, name='client_list'),
     path('clients/create/', views.client_create, name='client_create'),
+    path('clients/board/', views.order_board, name='order_board'),
+    path('clients/board/events/', views.order_board_events, name='order_board_events'),
     path('clients/<int:pk>/', views.client_detail, name='client_detail'),
     path('clients/<int:pk>/edit/', views.client_edit, name='client_edit'),
+    path('api/clients/', views.clients_api, name='clients_api'),
     path('api/clients/<int:client_id>/cars/', views.get_client_cars, name='client_cars_api'),
+    path('api/cars/', views.cars_api, name='cars_api'),
+    path('api/clients/lookup/', views.phone_lookup_api, name='phone_lookup_api'),
+    path('api/orders/<int:pk>/lines/', views.order_lines_api, name='order_lines_api'),
     path('clients/found/', views.client_found, name='client_found'),
+    path('clients/export/<slug:dataset>.csv', views.export_view, name='clients_export'),
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,241 +1,541 @@
 # # Create your views here.
-
+import asyncio
+import hashlib
+import json
+import logging
+import tempfile
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
-from django.db.models import Q, Count, Sum, Value, DecimalField, IntegerField
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Count, Max, Sum, Value, DecimalField, Q
 from django.db.models.functions import Coalesce
-from django.http import JsonResponse, Http404
+from django.http import FileResponse, HttpResponse, JsonResponse, Http404, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
+from django.urls import reverse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.crypto import constant_time_compare
 
+from .cache import aget_dashboard_context
+from .events import get_broker, order_channel
+from .exports import EXPORTS, export_rows, iter_csv, write_xlsx, xlsx_available
 from .forms import ClientForm
-from .models import Client, Car, Order, ClientHistory
-
-
-@login_required
-def client_list(request):
+from .history import record_history
+from .line_items import LineItemsError, line_as_dict, line_total_subquery, save_order_lines
+from .models import Client, Car, Order, Service, Part
+from .normalization import digits_only, phone_e164, phone_suffix_key
+from .pagination import KeysetPaginator
+from .profiling import collect_metrics, render_metrics
+from .search import search_clients
+from .stats import dashboard_counters, order_trend, TREND_PERIODS
+from .tags import TAG_MODES, filter_by_tags, parse_tags, tag_counts
+
+logger = logging.getLogger(__name__)
+
+# Допустимые сортировки списка клиентов; id в конце делает ключ уникальным для курсора
+CLIENT_SORT_OPTIONS = {
+    '-created_at': ('-created_at', '-id'),
+    'created_at': ('created_at', 'id'),
+    'last_name': ('last_name', 'id'),
+    '-last_name': ('-last_name', '-id'),
+    '-orders_count': ('-orders_count', '-id'),
+    'orders_count': ('orders_count', 'id'),
+    '-total_spent': ('-total_spent', '-id'),
+    'total_spent': ('total_spent', 'id'),
+}
+DEFAULT_CLIENT_SORT = '-created_at'
+CLIENTS_PER_PAGE = 20
+HISTORY_PER_PAGE = 20
+# Колонки доски заказов и параметры потока событий
+BOARD_STATUSES = ['new', 'diagnostics', 'awaiting_parts', 'in_progress', 'ready']
+BOARD_KEEPALIVE = 15
+BOARD_RETRY_MS = 5000
+# Под WSGI доска опрашивает сервер с этим интервалом вместо постоянного потока
+BOARD_POLL_MS = 3000
+API_MAX_PAGE_SIZE = 100
+# Поля автомобиля, доступные в API через ?fields=
+CAR_API_FIELDS = (
+    'id', 'client_id', 'brand', 'model', 'year', 'vin', 'license_plate', 'engine_volume', 'engine_power',
+    'transmission', 'fuel_type', 'mileage', 'color', 'updated_at',
+)
+CAR_API_DEFAULT_FIELDS = ('id', 'brand', 'model', 'license_plate')
+CAR_API_MAX_CLIENTS = 100
+# Поиск клиента по входящему звонку
+PHONE_LOOKUP_MIN_DIGITS = 4
+PHONE_LOOKUP_SUFFIX_DIGITS = 10
+PHONE_LOOKUP_LIMIT = 10
+PHONE_SUFFIX_UPPER_BOUND = ':'  # следующий за '9' символ: верхняя граница диапазона по префиксу из цифр
+
+
+def _filter_clients(request):
+    """Клиенты текущего пользователя с учетом поиска и фильтров из GET"""
     # Фильтруем клиентов по текущему пользователю (поле created_by)
+    # orders_count и total_spent хранятся в самой таблице клиентов
     clients = Client.objects.filter(
         is_active=True,
         created_by=request.user  # Используем created_by вместо user
-    ).annotate(
-        orders_count=Coalesce(
-            Count('orders', distinct=True),
-            Value(0),
-            output_field=IntegerField()
-        ),
-        total_spent_sum=Coalesce(
-            Sum('orders__total_amount'),
-            Value(0),
-            output_field=DecimalField(max_digits=10, decimal_places=2)
-        )
-    ).select_related('created_by').prefetch_related('cars')
+    )
 
-    # Поиск
+    # Поиск по нормализованному индексу (ФИО, телефон, email, ИНН, госномер, VIN)
     query = request.GET.get('q')
     if query:
-        clients = clients.filter(
-            # Q(first_name__icontains=query) |
-            Q(last_name__icontains=query) |
-            # Q(patronymic__icontains=query) |
-            Q(phone__icontains=query) |
-            Q(email__icontains=query) |
-            Q(company_name__icontains=query)
-            # Q(inn__icontains=query)
-        )
+        clients = search_clients(clients, query, owner=request.user)
 
     # Фильтры
     client_type = request.GET.get('client_type')
     if client_type:
         clients = clients.filter(client_type=client_type)
 
+    # Теги: ?tag=...&tag=...&tag_mode=any|all, через индекс ClientTag
+    tags = request.GET.getlist('tag')
+    if tags:
+        clients = filter_by_tags(clients, tags, _get_tag_mode(request))
+
+    return clients
+
+
+def _get_tag_mode(request):
+    mode = request.GET.get('tag_mode', 'any')
+    return mode if mode in TAG_MODES else 'any'
+
+
+def _get_sort(request):
+    sort_by = request.GET.get('sort', DEFAULT_CLIENT_SORT)
+    if sort_by not in CLIENT_SORT_OPTIONS:
+        sort_by = DEFAULT_CLIENT_SORT
+    return sort_by
+
+
+@login_required
+def client_list(request):
+    return render(request, 'clients/client_list.html', client_list_context(request))
+
+
+def client_list_context(request, page_size=CLIENTS_PER_PAGE):
+    """Контекст страницы списка клиентов (используется и в замере рендеринга)"""
+    clients = _filter_clients(request).select_related('created_by').prefetch_related('cars')
+
     # Сортировка
-    sort_by = request.GET.get('sort', '-created_at')
-    clients = clients.order_by(sort_by)
+    sort_by = _get_sort(request)
 
-    # Пагинация
-    paginator = Paginator(clients, 20)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Курсорная пагинация: без COUNT(*) и OFFSET
+    paginator = KeysetPaginator(clients, CLIENT_SORT_OPTIONS[sort_by], page_size)
+    page_obj = paginator.get_page(request.GET.get('cursor'))
 
-    context = {
+    return {
         'clients': page_obj,
         'page_obj': page_obj,
-        'is_paginated': paginator.num_pages > 1,
+        'is_paginated': page_obj.has_other_pages,
         'total_clients': Client.objects.filter(is_active=True, created_by=request.user).count(),
-        'query': query,
-        'client_type': client_type,
+        'query': request.GET.get('q'),
+        'client_type': request.GET.get('client_type'),
         'sort_by': sort_by,
+        'tag_counts': tag_counts(request.user.pk),
+        'selected_tags': parse_tags(','.join(request.GET.getlist('tag'))),
+        'tag_mode': _get_tag_mode(request),
+        'xlsx_export': xlsx_available(),
     }
 
-    return render(request, 'clients/client_list.html', context)
+
+@login_required
+def clients_api(request):
+    """API списка клиентов с курсорной пагинацией"""
+    sort_by = _get_sort(request)
+    try:
+        page_size = min(int(request.GET.get('page_size', CLIENTS_PER_PAGE)), API_MAX_PAGE_SIZE)
+    except ValueError:
+        page_size = CLIENTS_PER_PAGE
+    page_size = max(page_size, 1)
+
+    paginator = KeysetPaginator(_filter_clients(request), CLIENT_SORT_OPTIONS[sort_by], page_size)
+    page = paginator.get_page(request.GET.get('cursor'))
+
+    results = [
+        {
+            'id': client.id,
+            'full_name': client.full_name,
+            'company_name': client.company_name,
+            'phone': client.phone,
+            'email': client.email,
+            'client_type': client.client_type,
+            'orders_count': client.orders_count,
+            'total_spent': str(client.total_spent),
+            'created_at': client.created_at.isoformat(),
+        }
+        for client in page
+    ]
+    return JsonResponse({
+        'results': results,
+        'next': page.next_cursor,
+        'previous': page.previous_cursor,
+    })
+
+
+async def _alist(queryset):
+    return [obj async for obj in queryset]
 
 
 @login_required
-def client_detail(request, pk):
+async def client_detail(request, pk):
+    request.user = user = await request.auser()
     # Используем filter с created_by=request.user, а потом get
     try:
-        client = Client.objects.filter(created_by=request.user).get(pk=pk)
+        client = await Client.objects.filter(created_by=user).aget(pk=pk)
     except Client.DoesNotExist:
         raise Http404("Клиент не найден или у вас нет доступа к нему")
 
-    # Аннотируем клиента дополнительными полями
-    client = Client.objects.filter(pk=client.pk).annotate(
-        orders_count=Coalesce(
-            Count('orders', distinct=True),
-            Value(0),
-            output_field=IntegerField()
-        ),
-        total_spent_sum=Coalesce(
-            Sum('orders__total_amount'),
-            Value(0),
-            output_field=DecimalField(max_digits=10, decimal_places=2)
-        )
-    ).first()
-
-    cars = client.cars.all()
-    orders = client.orders.all().order_by('-created_at')
-    history = client.history.all()[:20]
-
-    # Статистика по заказам
-    orders_stats = {
-        'total': orders.count(),
-        'completed': orders.filter(status='completed').count(),
-        'in_progress': orders.exclude(status__in=['completed', 'cancelled']).count(),
-        'total_amount': orders.aggregate(
-            total=Coalesce(Sum('total_amount'), Value(0), output_field=DecimalField(max_digits=10, decimal_places=2))
-        )['total'] or 0,
-    }
+    orders = client.orders.select_related('car').annotate(
+        services_total=line_total_subquery(Service),
+        parts_total=line_total_subquery(Part),
+    ).order_by('-created_at')
+
+    # Статистика по заказам одним запросом
+    orders_stats = client.orders.aaggregate(
+        total=Count('pk'),
+        completed=Count('pk', filter=Q(status='completed')),
+        in_progress=Count('pk', filter=~Q(status__in=['completed', 'cancelled'])),
+        total_amount=Coalesce(Sum('total_amount'), Value(0), output_field=DecimalField(max_digits=10, decimal_places=2)),
+    )
+
+    # История листается курсором, без COUNT(*); ?history=archive — записи, перенесенные в архив
+    show_archive = request.GET.get('history') == 'archive'
+    history_source = client.archived_history if show_archive else client.history
+    history_paginator = KeysetPaginator(
+        history_source.select_related('order'), ('-created_at', '-id'), HISTORY_PER_PAGE
+    )
+
+    # Независимые запросы запускаются вместе; шаблон получает готовые списки
+    cars, orders, orders_stats, history = await asyncio.gather(
+        _alist(client.cars.all()),
+        _alist(orders),
+        orders_stats,
+        sync_to_async(history_paginator.get_page)(request.GET.get('history_cursor')),
+    )
 
     context = {
         'client': client,
         'cars': cars,
         'orders': orders,
         'history': history,
+        'show_archive': show_archive,
         'orders_stats': orders_stats,
     }
-    return render(request, 'clients/client_detail.html', context)
+    return await sync_to_async(render)(request, 'clients/client_detail.html', context)
 
 
-@login_required
-def dashboard(request):
-    """Дашборд для автомастерской с фильтрацией по текущему пользователю"""
-
-    today = timezone.now().date()
+async def _dashboard_context(user, trend_days):
+    """Данные дашборда; результат кэшируется целиком, поэтому querysets материализуются"""
+    today = timezone.localdate()
 
-    # Статистика за сегодня
-    orders_today = Order.objects.filter(
-        created_at__date=today,
-        client__created_by=request.user  # Используем client__created_by
-    ).count()
-
-    orders_in_progress = Order.objects.filter(
-        client__created_by=request.user  # Используем client__created_by
-    ).exclude(
-        status__in=['completed', 'cancelled']
-    ).count()
+    # Статистика за сегодня, заказы в работе и по статусам — из дневной статистики
+    counters = sync_to_async(dashboard_counters)(user, today)
 
     # Топ клиентов текущего пользователя
-    top_clients = Client.objects.filter(
-        created_by=request.user  # Используем created_by
-    ).annotate(
-        total_orders=Coalesce(
-            Count('orders', distinct=True),
-            Value(0),
-            output_field=IntegerField()
-        ),
-        total_sum=Coalesce(
-            Sum('orders__total_amount'),
-            Value(0),
-            output_field=DecimalField(max_digits=10, decimal_places=2)
-        )
-    ).order_by('-total_sum')[:5]
-
-    # Заказы по статусам
-    orders_by_status = Order.objects.filter(
-        client__created_by=request.user  # Используем client__created_by
-    ).values('status').annotate(
-        count=Coalesce(
-            Count('id'),
-            Value(0),
-            output_field=IntegerField()
-        )
-    )
+    top_clients = _alist(Client.objects.filter(
+        created_by=user  # Используем created_by
+    ).order_by('-total_spent')[:5])
 
     # Предстоящие записи
-    upcoming_appointments = Order.objects.filter(
+    upcoming_appointments = _alist(Order.objects.filter(
         appointment_date__date__gte=today,
-        client__created_by=request.user,  # Используем client__created_by
+        client__created_by=user,  # Используем client__created_by
         status__in=['new', 'diagnostics']
-    ).select_related('client', 'car').order_by('appointment_date')[:10]
+    ).select_related('client', 'car').order_by('appointment_date')[:10])
 
-    # Для преобразования статусов в читаемый вид
-    for item in orders_by_status:
-        item['status_display'] = dict(Order.STATUS_CHOICES).get(item['status'], item['status'])
+    # Динамика заказов за выбранный период
+    trend = sync_to_async(order_trend)(user, trend_days, today)
 
-    context = {
+    counters, top_clients, upcoming_appointments, trend = await asyncio.gather(
+        counters, top_clients, upcoming_appointments, trend
+    )
+    orders_today, orders_in_progress, orders_by_status = counters
+    trend_max = max([item['count'] for item in trend] + [1])
+    for item in trend:
+        item['height'] = round(item['count'] * 100 / trend_max)
+
+    return {
         'orders_today': orders_today,
         'orders_in_progress': orders_in_progress,
         'top_clients': top_clients,
         'orders_by_status': orders_by_status,
         'upcoming_appointments': upcoming_appointments,
+        'trend': trend,
+        'trend_days': trend_days,
+        'trend_periods': TREND_PERIODS,
+        'trend_orders': sum(item['count'] for item in trend),
+        'trend_revenue': sum(item['revenue'] for item in trend),
     }
-    return render(request, 'clients/dashboard.html', context)
 
 
 @login_required
-def get_client_cars(request, client_id):
-    """API для получения автомобилей клиента"""
-    # Проверяем, что клиент принадлежит текущему пользователю
-    client = get_object_or_404(Client, id=client_id, created_by=request.user)
-    cars = Car.objects.filter(client=client).values('id', 'brand', 'model', 'license_plate')
-    return JsonResponse(list(cars), safe=False)
+async def dashboard(request):
+    """Дашборд для автомастерской с фильтрацией по текущему пользователю"""
+    request.user = user = await request.auser()
+    # Динамика заказов за 30/90/365 дней
+    try:
+        trend_days = int(request.GET.get('period', TREND_PERIODS[0]))
+    except ValueError:
+        trend_days = TREND_PERIODS[0]
+    if trend_days not in TREND_PERIODS:
+        trend_days = TREND_PERIODS[0]
+
+    # Данные берутся из кэша пользователя; в ключ входит дата, чтобы «сегодня» не устаревало
+    context = await aget_dashboard_context(
+        user.pk,
+        f'{timezone.localdate().isoformat()}:{trend_days}',
+        lambda: _dashboard_context(user, trend_days),
+    )
+    return await sync_to_async(render)(request, 'clients/dashboard.html', context)
+
+
+def _car_fields(request):
+    """Поля автомобиля из ?fields=; None, если запрошено неизвестное поле"""
+    raw = request.GET.get('fields')
+    if not raw:
+        return list(CAR_API_DEFAULT_FIELDS)
+    fields = [name.strip() for name in raw.split(',') if name.strip()]
+    if not fields or any(name not in CAR_API_FIELDS for name in fields):
+        return None
+    return fields
+
+
+def _cars_etag(fields, versions):
+    """ETag из числа автомобилей и max(updated_at) по каждому клиенту и набора полей"""
+    key = '|'.join([','.join(fields)] + [
+        f"{row['pk']}:{row['cars_count']}:{row['cars_updated'].isoformat() if row['cars_updated'] else ''}"
+        for row in versions
+    ])
+    return f'"{hashlib.md5(key.encode(), usedforsecurity=False).hexdigest()}"'
+
+
+async def _cars_response(request, user, client_ids, batch):
+    fields = _car_fields(request)
+    if fields is None:
+        return JsonResponse({'error': f"Допустимые поля: {', '.join(CAR_API_FIELDS)}"}, status=400)
+
+    # Проверка владельца и версия данных — одним запросом
+    versions = await _alist(
+        Client.objects.filter(pk__in=client_ids, created_by=user)
+        .annotate(cars_count=Count('cars'), cars_updated=Max('cars__updated_at'))
+        .values('pk', 'cars_count', 'cars_updated').order_by('pk')
+    )
+    if not versions and not batch:
+        raise Http404("Клиент не найден или у вас нет доступа к нему")
+
+    etag = _cars_etag(fields, versions)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        owned_ids = [row['pk'] for row in versions]
+        cars = await _alist(
+            Car.objects.filter(client_id__in=owned_ids).order_by('client_id', 'pk')
+            .values(*dict.fromkeys(['client_id', *fields]))
+        )
+        results = {str(client_id): [] for client_id in owned_ids}
+        for car in cars:
+            client_id = car['client_id'] if 'client_id' in fields else car.pop('client_id')
+            results[str(client_id)].append(car)
+        if batch:
+            response = JsonResponse({'results': results})
+        else:
+            response = JsonResponse(cars, safe=False)
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 @login_required
-def get_client_cars(request, client_id):
+async def get_client_cars(request, client_id):
     """API для получения автомобилей клиента"""
-    # Проверяем, что клиент принадлежит текущему пользователю
-    client = get_object_or_404(Client, id=client_id, user=request.user)
-    cars = Car.objects.filter(client=client).values('id', 'brand', 'model', 'license_plate')
-    return JsonResponse(list(cars), safe=False)
+    user = await request.auser()
+    return await _cars_response(request, user, [client_id], batch=False)
 
 
 @login_required
-def client_create(request):
+async def cars_api(request):
+    """API автомобилей нескольких клиентов: ?client_ids=1,2,3 — одним запросом"""
+    user = await request.auser()
+    try:
+        client_ids = sorted({int(value) for value in request.GET.get('client_ids', '').split(',') if value.strip()})
+    except ValueError:
+        return JsonResponse({'error': 'client_ids — список id через запятую'}, status=400)
+    if not client_ids or len(client_ids) > CAR_API_MAX_CLIENTS:
+        return JsonResponse({'error': f'Укажите от 1 до {CAR_API_MAX_CLIENTS} id клиентов'}, status=400)
+    return await _cars_response(request, user, client_ids, batch=True)
+
+
+@login_required
+def phone_lookup_api(request):
+    """
+    Поиск клиента по входящему номеру: сначала точное совпадение E.164,
+    затем по последним цифрам номера (не меньше PHONE_LOOKUP_MIN_DIGITS)
+    """
+    digits = digits_only(request.GET.get('phone'))
+    if len(digits) < PHONE_LOOKUP_MIN_DIGITS:
+        return JsonResponse({'error': f'Нужно не меньше {PHONE_LOOKUP_MIN_DIGITS} цифр номера'}, status=400)
+
+    clients = Client.objects.filter(created_by=request.user).order_by()
+    match = 'exact'
+    found = []
+    e164 = phone_e164(digits)
+    if e164:
+        found = list(
+            clients.filter(phone_e164=e164).union(clients.filter(additional_phone_e164=e164))[:PHONE_LOOKUP_LIMIT]
+        )
+    if not found:
+        # Последние 10 цифр одинаковы для 8XXX..., +7XXX... и номера без кода страны
+        key = phone_suffix_key(digits[-PHONE_LOOKUP_SUFFIX_DIGITS:])
+        upper = key + PHONE_SUFFIX_UPPER_BOUND
+        match = 'suffix'
+        found = list(
+            clients.filter(phone_suffix_key__gte=key, phone_suffix_key__lt=upper).union(
+                clients.filter(additional_phone_suffix_key__gte=key, additional_phone_suffix_key__lt=upper)
+            )[:PHONE_LOOKUP_LIMIT]
+        )
+
+    return JsonResponse({
+        'match': match if found else None,
+        'results': [
+            {
+                'id': client.pk,
+                'full_name': client.full_name,
+                'phone': client.phone,
+                'additional_phone': client.additional_phone,
+                'url': reverse('client_detail', args=[client.pk]),
+            }
+            for client in found
+        ],
+    })
+
+
+@login_required
+def order_lines_api(request, pk):
+    """API строк заказа: GET — текущие работы и запчасти, POST — замена всего набора строк"""
+    order = get_object_or_404(Order.objects.select_related('client'), pk=pk, client__created_by=request.user)
+
     if request.method == 'POST':
-        print("POST request received")
-        print(f"POST data: {request.POST}")
+        try:
+            payload = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({'error': 'Некорректный JSON'}, status=400)
+        if not isinstance(payload, dict):
+            return JsonResponse({'error': 'Ожидается объект с ключами services и parts'}, status=400)
+        try:
+            save_order_lines(order, services=payload.get('services'), parts=payload.get('parts'))
+        except LineItemsError as exc:
+            return JsonResponse({'errors': exc.errors}, status=400)
+    elif request.method != 'GET':
+        return JsonResponse({'error': 'Метод не поддерживается'}, status=405)
+
+    return JsonResponse({
+        'order': order.order_number,
+        'services': [line_as_dict(line) for line in order.services.order_by('pk')],
+        'parts': [line_as_dict(line) for line in order.parts.order_by('pk')],
+        'labor_cost': str(order.labor_cost),
+        'parts_cost': str(order.parts_cost),
+        'discount': str(order.discount),
+        'total_amount': str(order.total_amount),
+    })
+
+
+@login_required
+def order_board(request):
+    """Доска заказов в работе; дальше обновляется событиями SSE без перезагрузки"""
+    orders = Order.objects.filter(
+        client__created_by=request.user, status__in=BOARD_STATUSES
+    ).select_related('client', 'car').order_by('appointment_date', 'created_at')
+
+    columns = {status: [] for status in BOARD_STATUSES}
+    for order in orders:
+        columns[order.status].append(order)
+    status_labels = dict(Order.STATUS_CHOICES)
+
+    context = {
+        'columns': [(status, status_labels[status], columns[status]) for status in BOARD_STATUSES],
+    }
+    return render(request, 'clients/order_board.html', context)
+
+
+def _sse_order_event(event_id, data):
+    return f'id: {event_id}\nevent: order\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+def _board_poll_response(channel, last_event_id):
+    """
+    Ответ доски под WSGI: накопившиеся события и конец ответа. EventSource
+    переподключается через BOARD_POLL_MS с Last-Event-ID, так что поток
+    воркера не занят между опросами.
+    """
+    broker = get_broker()
+    parts = [f'retry: {BOARD_POLL_MS}\n\n', 'event: mode\ndata: poll\n\n']
+    if last_event_id is None:
+        # Событие без данных только запоминает id: следующий опрос начнется с него
+        parts.append(f'id: {broker.last_id(channel)}\n\n')
+    else:
+        parts.extend(_sse_order_event(event_id, data) for event_id, data in broker.history(channel, last_event_id))
+    response = HttpResponse(''.join(parts), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
 
+
+@login_required
+async def order_board_events(request):
+    """Поток событий заказов пользователя (text/event-stream)"""
+    user = await request.auser()
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_event_id = None
+
+    if not isinstance(request, ASGIRequest):
+        # WSGI собрал бы бесконечный асинхронный поток в список и занял поток воркера навсегда
+        return await sync_to_async(_board_poll_response)(order_channel(user.pk), last_event_id)
+
+    async def stream():
+        yield f'retry: {BOARD_RETRY_MS}\n\n'
+        events = get_broker().subscribe(order_channel(user.pk), last_event_id, timeout=BOARD_KEEPALIVE)
+        try:
+            async for event in events:
+                if event is None:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield _sse_order_event(*event)
+        finally:
+            # Экран закрыт — сразу снимаем подписку
+            await events.aclose()
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx не должен буферизовать поток
+    return response
+
+
+@login_required
+def client_create(request):
+    if request.method == 'POST':
         form = ClientForm(request.POST)
 
         if form.is_valid():
-            print("Form is valid")
-            print(f"Cleaned data: {form.cleaned_data}")
-
             client = form.save(commit=False)
             client.is_active = True
             client.created_by = request.user
-            print(f"Client before save: {client}")
-            print(f"Created by: {client.created_by}")
-
             client.save()
-            print(f"Client after save, ID: {client.id}")
-
-            # Добавляем запись в историю
-            history = ClientHistory.objects.create(
-                client=client,
-                created_by=request.user,
-                action='Создание клиента',
-                description=f'Клиент создан пользователем {request.user.username}'
+            logger.info('Клиент #%s создан пользователем %s', client.pk, request.user.pk)
+
+            # Добавляем запись в историю (сохраняется в конце запроса)
+            record_history(
+                client,
+                'Создание клиента',
+                f'Клиент создан пользователем {request.user.username}',
+                user=request.user,
             )
-            print(f"History created: {history.id}")
 
             messages.success(request, f'Клиент {client.last_name} {client.first_name} успешно добавлен!')
             return redirect('client_list')
         else:
-            print(f"Form errors: {form.errors}")
+            logger.debug('Ошибки формы клиента: %s', form.errors.as_json())
             messages.error(request, 'Проверьте данные формы. Пожалуйста, исправьте ошибки ниже.')
     else:
         form = ClientForm()
@@ -255,12 +555,12 @@ def client_edit(request, pk):
         if form.is_valid():
             client = form.save()
 
-            # Добавляем запись в историю
-            ClientHistory.objects.create(
-                client=client,
-                created_by=request.user,
-                action='Редактирование клиента',
-                description=f'Данные клиента обновлены пользователем {request.user.username}'
+            # Добавляем запись в историю (сохраняется в конце запроса)
+            record_history(
+                client,
+                'Редактирование клиента',
+                f'Данные клиента обновлены пользователем {request.user.username}',
+                user=request.user,
             )
 
             messages.success(request, f'Данные клиента {client.last_name} {client.first_name} успешно обновлены!')
@@ -288,20 +588,53 @@ def client_found(request):
 
     # Получаем поисковый запрос из GET параметров
     query = request.GET.get('query', '')  # По умолчанию пустая строка
-    print(f'Search query: {query}')
+    logger.debug('Поиск клиентов: %r', query)
 
     # Применяем фильтрацию, если запрос не пустой
     if query:
-        # Поиск по имени или телефону (пример)
-        clients = clients.filter(
-            Q(last_name__icontains=query) |
-            Q(phone__icontains=query)
-        )
-        print(f'Filtered clients count: {clients.count()}')
+        clients = search_clients(clients, query, owner=request.user)
 
     context = {
         'clients': clients,
         'search_query': query,  # Передаем запрос в шаблон
     }
 
-    return render(request, 'clients/client_list.html', context)
\ No newline at end of file
+    return render(request, 'clients/client_list.html', context)
+
+
+@login_required
+def export_view(request, dataset):
+    """Выгрузка clients, cars, orders, order_lines: потоковый CSV или XLSX (?format=xlsx)"""
+    if dataset not in EXPORTS:
+        raise Http404("Неизвестная выгрузка")
+
+    if request.GET.get('format') == 'xlsx':
+        if not xlsx_available():
+            raise Http404("Выгрузка в XLSX недоступна: не установлен openpyxl")
+        # Книга собирается во временном файле на диске, не в памяти
+        file = tempfile.TemporaryFile()
+        write_xlsx(export_rows(dataset, request.user), file)
+        file.seek(0)
+        return FileResponse(
+            file, as_attachment=True, filename=f"{dataset}-{timezone.localdate().isoformat()}.xlsx",
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        )
+
+    filename = f"{dataset}-{timezone.localdate().isoformat()}.csv"
+    response = StreamingHttpResponse(
+        iter_csv(export_rows(dataset, request.user)),
+        content_type='text/csv; charset=utf-8',
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def metrics(request):
+    """Метрики профилирования в формате Prometheus (персонал или Bearer-токен)"""
+    if not settings.PROFILING_ENABLED:
+        raise Http404
+    token = settings.PROFILING_METRICS_TOKEN
+    authorization = request.headers.get('Authorization', '')
+    if not (request.user.is_staff or (token and constant_time_compare(authorization, f'Bearer {token}'))):
+        return HttpResponse('Доступ запрещен', status=403, content_type='text/plain; charset=utf-8')
+    return HttpResponse(render_metrics(collect_metrics()), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,67 @@
+"""
+Файловый кэш с атомарным incr.
+
+Стандартный FileBasedCache выполняет incr как get + set: два воркера,
+увеличивающие один счетчик одновременно, теряют одно из увеличений, а set
+заменяет срок жизни ключа на TIMEOUT по умолчанию. Здесь incr выполняется
+под файловой блокировкой (fcntl.flock) в каталоге кэша — она общая для всех
+процессов хоста, которые этим кэшем пользуются, — и сохраняет срок жизни
+ключа. На платформах без fcntl incr остается неатомарным.
+"""
+import os
+import pickle
+import time
+import zlib
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.core.cache.backends import filebased
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOCK_FILE_NAME = 'incr.lock'
+
+
+class FileBasedCache(filebased.FileBasedCache):
+
+    @contextmanager
+    def _incr_lock(self):
+        if fcntl is None:
+            yield
+            return
+        self._createdir()
+        with open(os.path.join(self._dir, LOCK_FILE_NAME), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self, key, version):
+        """(значение, момент истечения) или None, если ключа нет"""
+        try:
+            with open(self._key_to_file(key, version), 'rb') as f:
+                expiry = pickle.load(f)
+                if expiry is not None and expiry < time.time():
+                    return None
+                return pickle.loads(zlib.decompress(f.read())), expiry
+        except FileNotFoundError:
+            return None
+
+    def incr(self, key, delta=1, version=None):
+        with self._incr_lock():
+            current = self._read(key, version)
+            if current is None:
+                raise ValueError(f"Key '{key}' not found")
+            value, expiry = current
+            value += delta
+            timeout = None if expiry is None else max(expiry - time.time(), 0)
+            self.set(key, value, timeout, version=version)
+        return value
+
+    async def aincr(self, key, delta=1, version=None):
+        # Базовый aincr — это aget + aset, минуя блокировку
+        return await sync_to_async(self.incr)(key, delta, version)
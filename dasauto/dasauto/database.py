@@ -0,0 +1,122 @@
+"""
+Настройки базы данных из переменных окружения.
+
+Без переменных получается прежняя конфигурация (MySQL на 192.168.1.21), но
+с постоянными соединениями: CONN_MAX_AGE=60 и проверкой соединения перед
+повторным использованием (CONN_HEALTH_CHECKS). Переменные:
+
+    DB_ENGINE              mysql (по умолчанию) или sqlite
+    DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
+    DB_CONN_MAX_AGE        секунды жизни соединения; 0 — соединение на запрос,
+                           none — без ограничения
+    DB_CONN_HEALTH_CHECKS  1/0, проверка соединения в начале запроса
+    DB_CONNECT_TIMEOUT     таймаут подключения к MySQL, секунды
+    DB_POOL_SIZE           >0 включает пул соединений процесса (dasauto.db)
+    DB_POOL_TIMEOUT        сколько ждать свободного соединения, секунды
+    DB_POOL_RECYCLE        через сколько секунд соединение пересоздается
+    DB_POOL_PING_AFTER     простаивавшее дольше соединение проверяется перед выдачей
+    DB_REPLICAS            хосты реплик MySQL (или файлы SQLite) через запятую;
+                           становятся псевдонимами replica1, replica2, ...
+    DB_REPLICA_STICKY_SECONDS  сколько секунд после записи браузер читает из
+                           основной БД (допустимое отставание реплики)
+
+Постоянные соединения Django привязаны к потоку: у gthread-воркера каждый
+поток держит свое. Под ASGI синхронный код выполняется в общем пуле потоков,
+и там удобнее пул (DB_POOL_SIZE): соединение берется из пула на запрос и
+возвращается в конце, число соединений процесса ограничено размером пула.
+"""
+import os
+
+ENGINES = {
+    'mysql': 'django.db.backends.mysql',
+    'sqlite': 'django.db.backends.sqlite3',
+}
+POOLED_ENGINES = {
+    'mysql': 'dasauto.db.mysql',
+    'sqlite': 'dasauto.db.sqlite3',
+}
+
+
+def env_bool(environ, name, default):
+    value = environ.get(name)
+    if value is None or value == '':
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def env_int(environ, name, default):
+    value = environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def env_float(environ, name, default):
+    value = environ.get(name)
+    return float(value) if value not in (None, '') else default
+
+
+def database_settings(environ=None):
+    """Словарь для DATABASES['default']"""
+    environ = os.environ if environ is None else environ
+    engine = environ.get('DB_ENGINE', 'mysql')
+    if engine not in ENGINES:
+        raise ValueError(f'Неизвестный DB_ENGINE: {engine!r}, допустимо: {", ".join(ENGINES)}')
+
+    max_age = environ.get('DB_CONN_MAX_AGE', '60')
+    pool_size = env_int(environ, 'DB_POOL_SIZE', 0)
+
+    config = {
+        'ENGINE': POOLED_ENGINES[engine] if pool_size > 0 else ENGINES[engine],
+        # С пулом соединение возвращается в пул в конце каждого запроса,
+        # а временем жизни управляет DB_POOL_RECYCLE
+        'CONN_MAX_AGE': 0 if pool_size > 0 else (None if max_age.lower() == 'none' else int(max_age)),
+        'CONN_HEALTH_CHECKS': env_bool(environ, 'DB_CONN_HEALTH_CHECKS', True),
+    }
+    if engine == 'sqlite':
+        config['NAME'] = environ.get('DB_NAME', 'db.sqlite3')
+        config['OPTIONS'] = {'timeout': env_int(environ, 'DB_CONNECT_TIMEOUT', 20)}
+    else:
+        config.update({
+            'NAME': environ.get('DB_NAME', 'dasauto'),
+            'USER': environ.get('DB_USER', 'dasauto'),
+            'PASSWORD': environ.get('DB_PASSWORD', 'password'),
+            'HOST': environ.get('DB_HOST', '192.168.1.21'),
+            'PORT': environ.get('DB_PORT', '3306'),
+            'OPTIONS': {
+                'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
+                'charset': 'utf8mb4',
+                'connect_timeout': env_int(environ, 'DB_CONNECT_TIMEOUT', 5),
+            },
+        })
+    if pool_size > 0:
+        config['POOL'] = {
+            'SIZE': pool_size,
+            'TIMEOUT': env_float(environ, 'DB_POOL_TIMEOUT', 10),
+            'RECYCLE': env_int(environ, 'DB_POOL_RECYCLE', 1800),
+            'PING_AFTER': env_int(environ, 'DB_POOL_PING_AFTER', 30),
+        }
+    return config
+
+
+def replica_settings(primary, environ=None):
+    """Реплики из DB_REPLICAS: {псевдоним: настройки}; остальное берется у основной БД"""
+    environ = os.environ if environ is None else environ
+    locations = [location.strip() for location in environ.get('DB_REPLICAS', '').split(',') if location.strip()]
+    sqlite = primary['ENGINE'] in (ENGINES['sqlite'], POOLED_ENGINES['sqlite'])
+    replicas = {}
+    for index, location in enumerate(locations, start=1):
+        config = {
+            **primary,
+            'OPTIONS': dict(primary.get('OPTIONS', {})),
+            # В тестах реплика — та же тестовая БД
+            'TEST': {'MIRROR': 'default'},
+        }
+        if 'POOL' in primary:
+            config['POOL'] = dict(primary['POOL'])
+        if sqlite:
+            config['NAME'] = location
+        else:
+            host, _, port = location.partition(':')
+            config['HOST'] = host
+            config['PORT'] = port or primary['PORT']
+        replicas[f'replica{index}'] = config
+    return replicas
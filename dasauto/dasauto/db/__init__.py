@@ -0,0 +1 @@
+"""Бэкенды БД с пулом соединений процесса (см. dasauto.db.pool)"""
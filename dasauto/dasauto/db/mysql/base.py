@@ -0,0 +1,17 @@
+from django.db.backends.mysql import base
+
+from dasauto.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """MySQL с пулом соединений"""
+
+    def get_pooled_connection(self, conn_params):
+        return base.DatabaseWrapper.get_new_connection(self, conn_params)
+
+    def pooled_connection_usable(self, connection):
+        try:
+            connection.ping()
+        except base.Database.Error:
+            return False
+        return True
@@ -0,0 +1,211 @@
+"""
+Пул соединений с БД внутри процесса.
+
+Бэкенды dasauto.db.mysql и dasauto.db.sqlite3 берут соединение из пула в
+get_new_connection() и возвращают его в _close(), которое Django вызывает в
+конце запроса (CONN_MAX_AGE=0). Соединение, закрытое посреди транзакции,
+после ошибки или с измененным autocommit, в пул не возвращается.
+
+Перед выдачей соединение, простаивавшее дольше PING_AFTER секунд,
+проверяется (для MySQL — ping); нерабочее заменяется новым. Соединения
+старше RECYCLE секунд пересоздаются. Пулы привязаны к процессу: после fork
+воркер gunicorn заводит свой пул и не трогает соединения родителя.
+
+Статистика (выдачи, ожидания, переподключения) доступна через pool_stats()
+и попадает в /metrics.
+"""
+import os
+import threading
+import time
+
+from django.db.utils import OperationalError
+
+DEFAULT_POOL_OPTIONS = {
+    'SIZE': 10,
+    'TIMEOUT': 10,
+    'RECYCLE': 1800,
+    'PING_AFTER': 30,
+}
+
+STAT_FIELDS = ('checkouts', 'connects', 'reconnects', 'recycled', 'discarded', 'waits', 'wait_seconds', 'timeouts')
+
+
+class PoolTimeout(OperationalError):
+    """Свободное соединение не появилось за TIMEOUT секунд"""
+
+
+class ConnectionPool:
+    """
+    Ограниченный пул соединений. connect() открывает новое соединение,
+    is_usable(connection) проверяет простаивавшее.
+    """
+
+    def __init__(self, connect, is_usable, size, timeout, recycle, ping_after):
+        self._connect = connect
+        self._is_usable = is_usable
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._condition = threading.Condition()
+        # Стек свободных соединений (соединение, время создания, время возврата):
+        # последним возвращенное выдается первым и реже простаивает
+        self._idle = []
+        self._created_at = {}
+        self._in_use = 0
+        self.stats = dict.fromkeys(STAT_FIELDS, 0)
+        self.stats['wait_seconds'] = 0.0
+
+    def _open(self):
+        connection = self._connect()
+        with self._condition:
+            self._created_at[id(connection)] = time.monotonic()
+            self.stats['connects'] += 1
+        return connection
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        """Соединение из пула; ждет свободное не дольше timeout"""
+        waited = None
+        with self._condition:
+            while not self._idle and self._in_use + len(self._idle) >= self.size:
+                if waited is None:
+                    waited = time.monotonic()
+                remaining = self.timeout - (time.monotonic() - waited)
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    if not self._idle and self._in_use >= self.size:
+                        self.stats['timeouts'] += 1
+                        raise PoolTimeout(f'Нет свободного соединения в пуле за {self.timeout} с')
+            if waited is not None:
+                self.stats['waits'] += 1
+                self.stats['wait_seconds'] += time.monotonic() - waited
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            self.stats['checkouts'] += 1
+
+        try:
+            if entry is None:
+                return self._open()
+            connection, created_at, returned_at = entry
+            now = time.monotonic()
+            if now - created_at >= self.recycle:
+                self._forget(connection, 'recycled')
+                return self._open()
+            if now - returned_at >= self.ping_after and not self._is_usable(connection):
+                self._forget(connection, 'reconnects')
+                return self._open()
+            return connection
+        except BaseException:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+    def _forget(self, connection, reason):
+        with self._condition:
+            self._created_at.pop(id(connection), None)
+            self.stats[reason] += 1
+        self._close_quietly(connection)
+
+    def checkin(self, connection, discard=False):
+        """Возвращает соединение; discard=True закрывает его вместо возврата"""
+        with self._condition:
+            self._in_use -= 1
+            created_at = self._created_at.get(id(connection))
+            if discard or created_at is None:
+                self._created_at.pop(id(connection), None)
+                self.stats['discarded'] += 1
+            else:
+                self._idle.append((connection, created_at, time.monotonic()))
+            self._condition.notify()
+        if discard or created_at is None:
+            self._close_quietly(connection)
+
+    def close_all(self):
+        """Закрывает свободные соединения (занятые закроются при возврате)"""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            for connection, _, _ in idle:
+                self._created_at.pop(id(connection), None)
+        for connection, _, _ in idle:
+            self._close_quietly(connection)
+
+    def snapshot(self):
+        with self._condition:
+            return dict(self.stats, size=self.size, in_use=self._in_use, idle=len(self._idle))
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, options, connect, is_usable):
+    """Пул псевдонима БД текущего процесса; создается при первом обращении"""
+    key = (alias, os.getpid())
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                options = {**DEFAULT_POOL_OPTIONS, **(options or {})}
+                pool = _pools[key] = ConnectionPool(
+                    connect, is_usable,
+                    size=options['SIZE'], timeout=options['TIMEOUT'],
+                    recycle=options['RECYCLE'], ping_after=options['PING_AFTER'],
+                )
+    return pool
+
+
+def pool_stats():
+    """{псевдоним БД: статистика пула} для пулов текущего процесса"""
+    pid = os.getpid()
+    return {alias: pool.snapshot() for (alias, owner), pool in list(_pools.items()) if owner == pid}
+
+
+def close_pools():
+    """Закрывает свободные соединения всех пулов процесса (тесты, бенчмарк)"""
+    pid = os.getpid()
+    with _pools_lock:
+        pools = [pool for (_, owner), pool in _pools.items() if owner == pid]
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
+
+
+class PooledDatabaseWrapperMixin:
+    """Подмешивается к DatabaseWrapper бэкенда Django: соединения берутся из пула"""
+
+    def _pool(self, conn_params=None):
+        return get_pool(
+            self.alias,
+            self.settings_dict.get('POOL'),
+            lambda: self.get_pooled_connection(conn_params),
+            self.pooled_connection_usable,
+        )
+
+    def get_pooled_connection(self, conn_params):
+        """Новое соединение средствами бэкенда Django"""
+        raise NotImplementedError
+
+    def pooled_connection_usable(self, connection):
+        return True
+
+    def get_new_connection(self, conn_params):
+        return self._pool(conn_params).checkout()
+
+    def _close(self):
+        if self.connection is None:
+            return
+        # Соединение в неизвестном состоянии в пул не возвращается
+        discard = (
+            self.in_atomic_block
+            or self.errors_occurred
+            or self.autocommit != self.settings_dict['AUTOCOMMIT']
+        )
+        self._pool().checkin(self.connection, discard=discard)
@@ -0,0 +1,230 @@
+"""
+Чтение с реплик для отчетов и списков.
+
+ReplicaMiddleware для GET/HEAD-запросов к представлениям из
+DATABASE_REPLICA_VIEWS (дашборд, список и карточка клиента, выгрузки,
+changelist админки) включает чтение с реплики; ReplicaRouter направляет
+туда чтения, все записи идут в основную БД. Правила:
+
+- после первой записи в запросе оставшиеся чтения идут в основную БД
+  (read-your-writes), внутри transaction.atomic() — тоже;
+- запрос, который писал в БД, ставит cookie: следующие
+  DATABASE_REPLICA_STICKY_SECONDS секунд запросы этого браузера читают из
+  основной БД, пока реплика догоняет (допустимое отставание реплики);
+- сессии и пользователи всегда читаются из основной БД;
+- реплика выбирается случайно один раз на запрос; постоянное соединение
+  с ней перед выбором проверяется ping'ом. Недоступная реплика исключается
+  на DATABASE_REPLICA_RETRY_SECONDS, при отсутствии живых реплик чтение
+  идет в основную БД;
+- если реплика упала посреди запроса, представление (только читающее —
+  записей в запросе не было) повторяется один раз с чтением из основной БД,
+  синхронное и асинхронное одинаково. Потоковые ответы после начала отдачи
+  не повторяются.
+
+Вне запроса (команды) реплика включается контекстом replica_reads().
+"""
+import fnmatch
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+PIN_COOKIE = 'db_primary_until'
+# Эти приложения читаются только из основной БД: вход и сессия не должны зависеть от отставания реплики
+PRIMARY_ONLY_APPS = {'sessions', 'auth', 'accounts', 'contenttypes', 'admin'}
+
+
+class ReplicaState:
+    """Состояние маршрутизации запроса; изменяемый объект, чтобы запись в потоке sync_to_async была видна"""
+
+    def __init__(self, replicas):
+        self.replicas = list(replicas)
+        self.alias = None
+        self.wrote = False
+        # Представление для повтора при сбое реплики: (view_func, args, kwargs)
+        self.view = None
+
+
+_state = ContextVar('replica_state', default=None)
+
+_down_until = {}
+_down_lock = threading.Lock()
+
+
+def replica_aliases():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+
+def _mark_down(alias):
+    with _down_lock:
+        _down_until[alias] = time.monotonic() + getattr(settings, 'DATABASE_REPLICA_RETRY_SECONDS', 30)
+
+
+def _replica_available(alias):
+    """Реплика отвечает; после сбоя не проверяется DATABASE_REPLICA_RETRY_SECONDS секунд"""
+    with _down_lock:
+        if _down_until.get(alias, 0) > time.monotonic():
+            return False
+    connection = connections[alias]
+    try:
+        # Постоянное соединение (CONN_MAX_AGE) могло умереть вместе с репликой: ensure_connection его не проверяет
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
+        connection.ensure_connection()
+    except DatabaseError:
+        _mark_down(alias)
+        return False
+    return True
+
+
+def _replica_failed(alias):
+    """Ошибка запроса пришла от реплики: соединение с ней больше не отвечает"""
+    connection = connections[alias]
+    try:
+        if connection.connection is not None and connection.is_usable():
+            return False
+        connection.close()
+    except DatabaseError:
+        pass
+    _mark_down(alias)
+    return True
+
+
+def _choose_replica(state):
+    if state.alias is None:
+        candidates = state.replicas[:]
+        random.shuffle(candidates)
+        state.alias = next((alias for alias in candidates if _replica_available(alias)), DEFAULT_DB_ALIAS)
+    return state.alias
+
+
+@contextmanager
+def replica_reads(replicas=None):
+    """Чтения внутри блока идут на реплику (по тем же правилам, что и в запросе)"""
+    state = ReplicaState(replica_aliases() if replicas is None else replicas)
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if (
+            state is None or state.wrote or not state.replicas
+            or model._meta.app_label in PRIMARY_ONLY_APPS
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        return _choose_replica(state)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики — копии основной БД
+        return True
+
+
+def _view_uses_replica(request):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return False
+    patterns = getattr(settings, 'DATABASE_REPLICA_VIEWS', [])
+    return any(fnmatch.fnmatchcase(match.view_name, pattern) for pattern in patterns)
+
+
+def _pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaMiddleware:
+    """Включает чтение с реплики для представлений из DATABASE_REPLICA_VIEWS"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = ReplicaState([])
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self._finish(request, response, state)
+
+    async def __acall__(self, request):
+        state = ReplicaState([])
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self._finish(request, response, state)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # resolver_match известен только здесь; state уже лежит в контексте запроса
+        state = _state.get()
+        if state is not None and replica_aliases() and _view_uses_replica(request) and not _pinned(request):
+            state.replicas = replica_aliases()
+            state.view = (view_func, view_args, view_kwargs)
+
+    def process_exception(self, request, exception):
+        # Реплика упала посреди запроса: повторяем представление один раз, читая из основной БД.
+        # Django вызывает process_exception синхронно (для асинхронных представлений — в потоке
+        # sync_to_async), поэтому корутину представления выполняем через async_to_sync
+        state = _state.get()
+        if (
+            not isinstance(exception, DatabaseError) or state is None or state.wrote or state.view is None
+            or state.alias in (None, DEFAULT_DB_ALIAS) or not _replica_failed(state.alias)
+        ):
+            return None
+        view_func, view_args, view_kwargs = state.view
+        state.view = None
+        state.replicas = []
+        state.alias = DEFAULT_DB_ALIAS
+        if iscoroutinefunction(view_func):
+            view_func = async_to_sync(view_func)
+        response = view_func(request, *view_args, **view_kwargs)
+        if hasattr(response, 'render') and callable(response.render):
+            response = response.render()
+        return response
+
+    def _finish(self, request, response, state):
+        if state.wrote:
+            sticky = getattr(settings, 'DATABASE_REPLICA_STICKY_SECONDS', 5)
+            response.set_cookie(PIN_COOKIE, f'{time.time() + sticky:.3f}', max_age=sticky, httponly=True,
+                                samesite='Lax')
+        if state.replicas and response.streaming and not response.is_async:
+            # Потоковая выгрузка читает БД уже после выхода из middleware
+            response.streaming_content = _with_state(response.streaming_content, state)
+        return response
+
+
+def _with_state(iterator, state):
+    token = _state.set(state)
+    try:
+        yield from iterator
+    finally:
+        _state.reset(token)
@@ -0,0 +1,17 @@
+from django.db.backends.sqlite3 import base
+
+from dasauto.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """SQLite с пулом соединений (локальная замена MySQL для замеров)"""
+
+    def get_pooled_connection(self, conn_params):
+        return base.DatabaseWrapper.get_new_connection(self, conn_params)
+
+    def pooled_connection_usable(self, connection):
+        try:
+            connection.execute('SELECT 1')
+        except base.Database.Error:
+            return False
+        return True
@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from .database import database_settings, env_bool, env_int, replica_settings
+
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -45,6 +48,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Профилирование запросов; работает только при PROFILING_ENABLED
+    'clients.profiling.ProfilingMiddleware',
+    # Чтение с реплик для отчетов и списков; должен стоять до сессий, чтобы видеть их запись
+    'dasauto.db.routing.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -52,22 +59,40 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Записи истории клиентов копятся за запрос и сохраняются одним INSERT
+    'clients.history.HistoryBufferMiddleware',
     # 'django.template.context_processors.request',
 ]
 
 ROOT_URLCONF = 'dasauto.urls'
 
+# Режим рендеринга для продакшена (по умолчанию при DEBUG=False, или
+# DASAUTO_TEMPLATE_CACHE=1): шаблоны компилируются один раз на процесс
+# (cached loader), строки списков клиентов и заказов кэшируются фрагментами
+# (тег {% cache %}, кэш template_fragments). При разработке шаблоны
+# перечитываются на каждый запрос
+TEMPLATE_CACHE_ENABLED = env_bool(os.environ, 'DASAUTO_TEMPLATE_CACHE', not DEBUG)
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+# Сколько секунд хранится фрагмент; 0 — фрагмент истекает сразу, то есть не кэшируется.
+# В шаблоны попадает через clients.context_processors.template_cache
+TEMPLATE_FRAGMENT_CACHE_TIMEOUT = 60 * 60 if TEMPLATE_CACHE_ENABLED else 0
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            'loaders': [('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)]
+            if TEMPLATE_CACHE_ENABLED else TEMPLATE_LOADERS,
             'context_processors': [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'django.template.context_processors.request',
+                'clients.context_processors.template_cache',
             ],
         },
     },
@@ -76,22 +101,90 @@ TEMPLATES = [
 WSGI_APPLICATION = 'dasauto.wsgi.application'
 AUTH_USER_MODEL = 'accounts.CustomUser'
 
-# База данных MySQL
+# База данных: MySQL с постоянными соединениями, параметры из окружения
+# (DB_HOST, DB_CONN_MAX_AGE, DB_POOL_SIZE и др., см. dasauto/database.py)
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.mysql',
-        'NAME': 'dasauto',          # Имя базы данных
-        'USER': 'dasauto',              # Имя пользователя
-        'PASSWORD': 'password',      # Пароль
-        'HOST': '192.168.1.21',           # Хост (обычно localhost)
-        'PORT': '3306',                # Порт MySQL (по умолчанию 3306)
-        'OPTIONS': {
-            'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
-            'charset': 'utf8mb4',
-        }
+    'default': database_settings(),
+}
+DATABASES.update(replica_settings(DATABASES['default']))
+
+# Чтение с реплик (dasauto.db.routing): только GET-запросы к этим представлениям
+DATABASE_ROUTERS = ['dasauto.db.routing.ReplicaRouter']
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_REPLICA_VIEWS = [
+    'dashboard',
+    'client_list',
+    'client_detail',
+    'clients_export',
+    'admin:*_changelist',
+]
+# После записи браузер столько секунд читает из основной БД, пока реплика догоняет
+DATABASE_REPLICA_STICKY_SECONDS = env_int(os.environ, 'DB_REPLICA_STICKY_SECONDS', 5)
+# Недоступная реплика не используется столько секунд
+DATABASE_REPLICA_RETRY_SECONDS = 30
+
+
+# Кэш (данные дашборда и счетчики попаданий) и кэш сессий с пользователями.
+# Оба общие для всех воркеров gunicorn, поэтому сброс кэша в одном процессе
+# виден остальным. DASAUTO_REDIS_URL (redis://host:6379/0, нужен пакет redis) —
+# Redis для production; без него — файловые кэши на этом хосте. Сессии лежат
+# в отдельном кэше: дашборд и счетчики тегов не вытесняют их при заполнении
+REDIS_URL = os.environ.get('DASAUTO_REDIS_URL')
+if REDIS_URL:
+    DEFAULT_CACHE = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'dasauto',
+        'TIMEOUT': 600,
     }
+    SESSIONS_CACHE = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'sessions',
+    }
+else:
+    # MAX_ENTRIES по умолчанию (300) — меньше, чем ключей дашборда у пары десятков пользователей.
+    # dasauto.cache.FileBasedCache: incr под файловой блокировкой (счетчики попаданий дашборда)
+    DEFAULT_CACHE = {
+        'BACKEND': 'dasauto.cache.FileBasedCache',
+        'LOCATION': BASE_DIR / '.django_cache' / 'default',
+        'TIMEOUT': 600,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+    SESSIONS_CACHE = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / '.django_cache' / 'sessions',
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    }
+
+CACHES = {
+    'default': DEFAULT_CACHE,
+    # Сессии (cached_db) и пользователи сессий (accounts.backends.CachedModelBackend)
+    'sessions': SESSIONS_CACHE,
+    # Фрагменты шаблонов: ключ содержит updated_at, поэтому устаревшие фрагменты
+    # просто перестают читаться. Кэш в памяти процесса не переживает деплой,
+    # и измененная разметка не смешивается со старой
+    'template_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'template-fragments',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
 }
 
+# Хранение сессий (DASAUTO_SESSION_ENGINE):
+#   cached_db      — кэш с записью в БД (по умолчанию): чтение сессии без запроса к БД
+#   db             — только БД, запрос на каждый запрос пользователя
+#   signed_cookies — данные в подписанной cookie, без обращений к серверу;
+#                    выход не отзывает cookie, украденную раньше
+SESSION_ENGINES = {
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'db': 'django.contrib.sessions.backends.db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+SESSION_ENGINE = SESSION_ENGINES[os.environ.get('DASAUTO_SESSION_ENGINE', 'cached_db')]
+SESSION_CACHE_ALIAS = 'sessions'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -137,6 +230,83 @@ STATICFILES_DIRS = [
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Настройки аутентификации
+# Пользователь сессии берется из кэша сессий (без хэша пароля) и сбрасывается при сохранении CustomUser
+AUTHENTICATION_BACKENDS = ['accounts.backends.CachedModelBackend']
+AUTH_USER_CACHE_TIMEOUT = 60 * 5
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'home'
-LOGOUT_REDIRECT_URL = 'home'
\ No newline at end of file
+LOGOUT_REDIRECT_URL = 'home'
+
+# Changelist клиентов в админке для больших таблиц (clients.admin.ClientAdmin):
+# оценка числа строк по статистике таблицы и поиск через поисковый индекс
+ADMIN_PERFORMANCE_MODE = env_bool(os.environ, 'DASAUTO_ADMIN_PERFORMANCE', True)
+
+# Импорт из админки выполняется прямо в запросе: файлы больше этого размера (байт)
+# загружаются командой import_clients
+ADMIN_IMPORT_MAX_UPLOAD_SIZE = env_int(os.environ, 'DASAUTO_ADMIN_IMPORT_MAX_UPLOAD_SIZE', 5 * 1024 * 1024)
+
+# Сколько номеров заказов процесс забирает из счетчика за раз: строка счетчика
+# блокируется один раз на блок. Недоиспользованные номера пропадают при перезапуске;
+# 1 — пропуски только от откаченных транзакций (clients.sequences)
+ORDER_NUMBER_BLOCK_SIZE = env_int(os.environ, 'DASAUTO_ORDER_NUMBER_BLOCK_SIZE', 20)
+
+# Брокер событий живой доски заказов (SSE). DatabaseBroker общий для всех
+# процессов: таблицу событий читает один опросчик на процесс, сколько бы экранов
+# ни было открыто; InMemoryBroker обходится без БД, но работает только с одним процессом
+ORDER_EVENTS_BACKEND = os.environ.get('DASAUTO_EVENTS_BACKEND', 'clients.events.DatabaseBroker')
+
+# Профилирование запросов (clients.profiling): метрики по /metrics и лог
+# медленных и выборочных запросов. Включается переменной окружения
+PROFILING_ENABLED = os.environ.get('DASAUTO_PROFILING') == '1'
+# Доля запросов, которые пишутся в лог со стеками SQL
+PROFILING_SAMPLE_RATE = float(os.environ.get('DASAUTO_PROFILING_SAMPLE_RATE', '0.01'))
+# Запросы дольше этого порога пишутся в лог всегда
+PROFILING_SLOW_REQUEST_MS = 1000
+PROFILING_SLOW_QUERIES = 5
+# Как часто воркер сохраняет свои метрики в общий кэш, секунды
+PROFILING_FLUSH_INTERVAL = 10
+# Токен для Prometheus (Authorization: Bearer ...); без него /metrics доступен только персоналу
+PROFILING_METRICS_TOKEN = os.environ.get('DASAUTO_METRICS_TOKEN')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {
+            'format': '{asctime} {levelname} {name} {message}',
+            'style': '{',
+        },
+        'message': {
+            'format': '{message}',
+            'style': '{',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'simple',
+        },
+        # Каждая запись — одна JSON-строка. Ротация по размеру безопасна для
+        # одного процесса; при нескольких воркерах лучше отдельный файл на воркер
+        'profiling_file': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': os.environ.get('DASAUTO_PROFILING_LOG', BASE_DIR / 'profiling.log'),
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'encoding': 'utf-8',
+            'delay': True,
+            'formatter': 'message',
+        },
+    },
+    'loggers': {
+        'clients': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'dasauto.profiling': {
+            'handlers': ['profiling_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -0,0 +1,67 @@
+"""
+Конфигурация gunicorn для dasauto.
+
+WSGI (синхронные воркеры с потоками):
+    gunicorn -c gunicorn.conf.py dasauto.wsgi
+
+ASGI (uvicorn-воркеры; асинхронные dashboard, client_detail, API автомобилей
+и поток событий доски заказов не занимают воркер, пока ждут MySQL):
+    GUNICORN_ASGI=1 gunicorn -c gunicorn.conf.py dasauto.asgi
+
+Без gunicorn (разработка или один контейнер):
+    uvicorn dasauto.asgi:application --host 0.0.0.0 --port 8000 --workers 4
+
+Доска заказов: под ASGI события приходят постоянным потоком SSE, под WSGI
+браузер опрашивает сервер каждые несколько секунд (поток не держит воркер).
+Брокер по умолчанию (DatabaseBroker) общий для всех воркеров; с
+InMemoryBroker (DASAUTO_EVENTS_BACKEND) gunicorn запускается только с одним
+воркером, иначе события терялись бы между процессами.
+
+Сравнить WSGI и ASGI на своих данных:
+    python manage.py benchmark_views --compare-handlers --concurrency 20
+
+Соединения с MySQL (см. dasauto/database.py): по умолчанию постоянные,
+CONN_MAX_AGE=60 на поток. Под ASGI лучше пул процесса, например
+DB_POOL_SIZE=10; сравнить режимы:
+    python manage.py benchmark_views --compare-connections --connect-latency-ms 5
+"""
+import multiprocessing
+import os
+
+ASGI = os.environ.get('GUNICORN_ASGI') == '1'
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+
+if ASGI:
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    worker_class = 'gthread'
+    threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# SSE-соединения доски живут долго; keep-alive отправляется каждые 15 секунд
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+# Перезапуск воркеров ограничивает рост памяти
+max_requests = 2000
+max_requests_jitter = 200
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    """Не запускаемся с брокером событий внутри процесса и несколькими воркерами"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dasauto.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    from clients.events import IN_MEMORY_BACKEND
+
+    if server.cfg.workers > 1 and settings.ORDER_EVENTS_BACKEND == IN_MEMORY_BACKEND:
+        raise RuntimeError(
+            f'{IN_MEMORY_BACKEND} доставляет события только внутри процесса, а воркеров '
+            f'{server.cfg.workers}: укажите GUNICORN_WORKERS=1 или другой DASAUTO_EVENTS_BACKEND'
+        )